@@ -0,0 +1 @@
+from nebel.api import Repository, NebelError
@@ -0,0 +1,102 @@
+'''
+Created on October 19, 2026
+
+Python API for running Nebel from a long-lived process, such as a batch job.
+Importing it has no side effects, and a Repository keeps its context, caches,
+and scanned tables (such as the include graph) in memory from one call to the
+next.
+'''
+
+from __future__ import absolute_import
+import io
+import os
+import contextlib
+import nebel.log
+import nebel.commands
+
+log = nebel.log.logger
+
+
+class NebelError(Exception):
+    # Raised where the command-line tool would exit with an error. The error itself is logged
+    # (see nebel.log.configure), and 'status' is the exit status of the command-line tool.
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class Repository:
+    def __init__(self, path=os.curdir, configfile='nebel.cfg', log_stream=None):
+        # Log messages of each call are written to 'log_stream' (standard error by default)
+        self.path = os.path.abspath(path)
+        self.log_stream = log_stream
+        configpath = os.path.join(self.path, configfile)
+        if not os.path.exists(configpath):
+            raise NebelError('No ' + configfile + ' file found in ' + self.path)
+        with self._in_repository():
+            self.context = nebel.commands.new_context(configpath)
+        self.factory = self.context.moduleFactory
+        self.tasks = nebel.commands.Tasks(self.context)
+        self.parser = nebel.commands.build_parser(self.tasks)
+
+    @contextlib.contextmanager
+    def _in_repository(self):
+        # Nebel works with paths relative to the root directory of the repository
+        cwd = os.getcwd()
+        os.chdir(self.path)
+        try:
+            yield
+        finally:
+            os.chdir(cwd)
+
+    def _call(self, description, function, *args):
+        # Each call has its own log handler, so that messages are neither dropped nor sent to
+        # the handlers of the host program, and the host's logging configuration is restored after it
+        with self._in_repository(), nebel.log.configured(stream=self.log_stream):
+            try:
+                return function(*args)
+            except SystemExit as e:
+                if e.code == 0:
+                    return None
+                raise NebelError(description + ' failed', e.code)
+
+    def run(self, *argv):
+        # Runs a command with the same arguments as the command-line tool, and returns what it
+        # writes to standard output. For example: repository.run('toc', 'book1/master.adoc')
+        # The logging options (such as '-q', before the command name) apply to this call only.
+        def parse_and_run():
+            args = self.parser.parse_args(argv)
+            with nebel.log.configured(quiet=args.quiet, verbose=args.verbose, format=args.log_format, stream=self.log_stream):
+                args.func(args)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self._call('nebel ' + ' '.join(argv), parse_and_run)
+        return output.getvalue()
+
+    def create(self, type, category, moduleid, **metadata):
+        # Creates an assembly or module from its template and returns its path. For example:
+        #   repository.create('procedure', 'cat1', 'install-it', Title='Install it')
+        # Each assembly in a ParentAssemblies value (space-separated) also gets an include of the new file.
+        metadata = dict(metadata, Type=type, Category=category, ModuleID=moduleid)
+        def create_and_include():
+            filepath = self.factory.create(metadata)
+            for assemblyfile in metadata.get('ParentAssemblies', '').split():
+                self.tasks.add_include_to_assembly(assemblyfile, filepath)
+            return filepath
+        return self._call('Creating ' + moduleid, create_and_include)
+
+    def resolved_lines(self, filepath, attribute_files=None):
+        # Returns the lines of a book or assembly with all includes resolved, as (line, sourcefile, lineno)
+        # tuples, as written by 'nebel flatten'
+        def resolve():
+            self.context.clear_attributes()
+            if attribute_files:
+                self.context.parse_attribute_files(attribute_files)
+            lines = list(self.tasks._iter_resolved_lines(os.path.relpath(os.path.realpath(filepath))))
+            self.tasks._fragment_cache().save()
+            return lines
+        return self._call('Resolving ' + filepath, resolve)
+
+    def include_graph(self, attribute_files=None):
+        # Returns the nebel.graph.IncludeGraph of every book in the repository
+        return self._call('Building the include graph', self.tasks._build_include_graph, attribute_files)
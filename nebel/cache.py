@@ -0,0 +1,113 @@
+'''
+Created on October 19, 2026
+
+Persistent per-file cache. Each entry is stored together with the
+modification time and size of the file it was derived from, so that an
+entry is discarded as soon as the file changes.
+'''
+
+from __future__ import absolute_import
+import os
+import pickle
+import tempfile
+import nebel.log
+
+log = nebel.log.logger
+
+
+def stamp(filepath):
+    # Modification time and size of the file, which identify a version of its contents
+    st = os.stat(filepath)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def unchanged(stamps):
+    # Returns True if none of the files in 'stamps' (file path -> stamp) has changed or disappeared.
+    # A stamp of None stands for a file that did not exist, and that must still not exist.
+    for filepath, filestamp in stamps.items():
+        if not os.path.exists(filepath):
+            if filestamp is not None:
+                return False
+        elif (filestamp is None) or (stamp(filepath) != filestamp):
+            return False
+    return True
+
+
+class FileCache:
+    def __init__(self, context, name, version=1):
+        self.path = os.path.join(context.CACHE_DIR, name + '.pickle')
+        self.version = version
+        self.entries = {}
+        self.dirty = False
+        # Entries put since the last call to take_new(), for a worker process to hand back to its parent
+        self.new_entries = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                version, entries = pickle.load(f)
+        except Exception:
+            log.warning('Ignoring unreadable cache file: ' + self.path)
+            return
+        if version == self.version:
+            self.entries = entries
+
+    def save(self):
+        if not self.dirty:
+            return
+        cachedir = os.path.dirname(self.path)
+        if cachedir and not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        # Write to a temp file first, so that an interrupted run cannot corrupt the cache
+        fh, abs_path = tempfile.mkstemp(dir=cachedir or os.curdir)
+        with os.fdopen(fh, 'wb') as f:
+            pickle.dump((self.version, self.entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(abs_path, self.path)
+        self.dirty = False
+        self.new_entries = {}
+
+    def stamp(self, filepath):
+        return stamp(filepath)
+
+    def get(self, filepath, stamp=None):
+        # Returns the cached data for filepath, or None if the file has changed since it was cached
+        entry = self.entries.get(filepath)
+        if entry is None:
+            return None
+        if stamp is None:
+            stamp = self.stamp(filepath)
+        if entry[0] != stamp:
+            return None
+        return entry[1]
+
+    def stale(self, filepath):
+        # Returns the cached data for filepath, even if the file has changed since it was cached, or None
+        entry = self.entries.get(filepath)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def put(self, filepath, data, stamp=None):
+        if stamp is None:
+            stamp = self.stamp(filepath)
+        self.entries[filepath] = self.new_entries[filepath] = (stamp, data)
+        self.dirty = True
+
+    def take_new(self):
+        # Returns the entries put since the last call, as a dict that can be passed to update()
+        entries = self.new_entries
+        self.new_entries = {}
+        return entries
+
+    def update(self, entries):
+        # Adds entries returned by take_new(), typically from the cache of a worker process
+        if entries:
+            self.entries.update(entries)
+            self.dirty = True
+
+    def discard(self, filepath):
+        if self.entries.pop(filepath, None) is not None:
+            self.dirty = True
@@ -0,0 +1,108 @@
+'''
+Created on October 19, 2026
+
+Checkpoints of long-running updates, so that an interrupted run can resume
+where it stopped. A checkpoint is a directory under the cache directory with
+the results of completed phases, and a journal of the files that are done.
+'''
+
+from __future__ import absolute_import
+import os
+import pickle
+import shutil
+import hashlib
+import tempfile
+import nebel.log
+
+log = nebel.log.logger
+
+
+class Checkpoint:
+    JOURNAL = 'journal.txt'
+    KEY = 'key.txt'
+
+    def __init__(self, context, name, key):
+        # The 'key' describes the run (for example, its options and files): only a run with
+        # the same key can resume from the checkpoint
+        self.path = os.path.join(context.CACHE_DIR, 'checkpoints', name)
+        self.name = name
+        self.key = hashlib.sha256(repr(key).encode('UTF-8')).hexdigest()
+        self.completed = set()
+        self.journal = None
+
+    def start(self, resume=False):
+        # Opens the checkpoint, and returns True if the run resumes from an earlier checkpoint
+        resumed = False
+        if resume:
+            if self._stored_key() == self.key:
+                self._load_journal()
+                resumed = True
+                log.info('Resuming ' + self.name + ': ' + str(len(self.completed)) + ' file(s) already done')
+            elif os.path.exists(self.path):
+                log.warning('Cannot resume ' + self.name + ', because the previous run had different options or files: starting over')
+            else:
+                log.warning('No interrupted ' + self.name + ' run to resume: starting over')
+        if not resumed:
+            self._clear()
+            os.makedirs(self.path)
+            with open(os.path.join(self.path, self.KEY), 'w') as f:
+                f.write(self.key + '\n')
+        self.journal = open(os.path.join(self.path, self.JOURNAL), 'a')
+        return resumed
+
+    def load_phase(self, phase):
+        # Returns the saved results of 'phase', or None
+        phasepath = os.path.join(self.path, phase + '.pickle')
+        if not os.path.exists(phasepath):
+            return None
+        try:
+            with open(phasepath, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            log.warning('Ignoring unreadable checkpoint file: ' + phasepath)
+            return None
+
+    def save_phase(self, phase, data):
+        # Write to a temp file first, so that an interrupted run cannot leave a partial file
+        fh, abs_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fh, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(abs_path, os.path.join(self.path, phase + '.pickle'))
+
+    def is_done(self, filepath):
+        return filepath in self.completed
+
+    def done(self, filepath):
+        # Records that 'filepath' is done, immediately, so that the record survives a crash
+        self.completed.add(filepath)
+        self.journal.write(filepath + '\n')
+        self.journal.flush()
+
+    def close(self):
+        # Keeps the checkpoint, for a later run with resume=True
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def finish(self):
+        # Removes the checkpoint of a run that completed
+        self.close()
+        self._clear()
+
+    def _stored_key(self):
+        keypath = os.path.join(self.path, self.KEY)
+        if not os.path.exists(keypath):
+            return None
+        with open(keypath, 'r') as f:
+            return f.read().strip()
+
+    def _load_journal(self):
+        journalpath = os.path.join(self.path, self.JOURNAL)
+        if os.path.exists(journalpath):
+            with open(journalpath, 'r') as f:
+                # A line without a newline was cut short by the interruption
+                self.completed = set(line[:-1] for line in f if line.endswith('\n'))
+
+    def _clear(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
@@ -14,17 +14,118 @@ import shutil
 import argparse
 import nebel.context
 import nebel.factory
+import nebel.decisions
+import nebel.parallel
+import nebel.log
+import nebel.cache
+import nebel.export
+import nebel.scan
+import nebel.registry
+import nebel.graph
+import nebel.checkpoint
+import nebel.trigrams
 import datetime
 import glob
 import hashlib
+import bisect
 import subprocess
+import json
+import csv
 from six.moves import map
 from six.moves import zip
 from six.moves import input
 
+log = nebel.log.logger
+
+
+class SplitError(Exception):
+    # Raised when an annotated file cannot be split
+    pass
+
+
+class AnnotatedSplitState:
+    # Parsing state for splitting one annotated file (see Tasks._parse_from_annotated)
+    regexp_ifdef    = re.compile(r'^ifdef::([^\[]+)\[\]')
+    regexp_ifdef_single = re.compile(r'^ifdef::([^\[]+)\[([^\]]+)\]')
+    regexp_ifndef   = re.compile(r'^ifndef::([^\[]+)\[\]')
+    regexp_ifndef_single = re.compile(r'^ifndef::([^\[]+)\[([^\]]+)\]')
+    regexp_ifeval   = re.compile(r'^ifeval::\[([^\]]*)\]')
+    regexp_endif    = re.compile(r'^endif::([^\[]*)\[\]')
+
+    def __init__(self, lines, selectedconditions = None):
+        self.lines = lines
+        self.indexofnextline = 0
+        self.parsing_state = 0
+        self.expecting_title_line = False
+        self.tentativecontentlines = []
+        self.blockmetadata = {}
+        if (selectedconditions is not None) and (len(selectedconditions) > 0):
+            self.isconditionalizeactive = True
+            self.selectedconditions = selectedconditions
+        else:
+            self.isconditionalizeactive = False
+            self.selectedconditions = []
+        self.showcontent = True
+        self.showcontentstack = []
+        self.currconditionstack = []
+
+
 class Tasks:
+    # Matches <<id,text>>, xref:id[text] and link:{attr}#id[text] (or {link-prefix}:) in a single pass
+    regexp_links = re.compile(
+        r'<<(?P<angleid>[^,>]+),?(?P<angletext>[^>]*)>>'
+        r'|xref:(?P<xrefid>[\w\-]+)\[(?P<xreftext>[^\]]*)\]'
+        r'|(?:link|\{link\-prefix\}):(?P<bookattr>\{[\w\-]+\})#(?P<linkid>[^\[]+)\[(?P<linktext>[^\]]*)\]'
+    )
+    # Matches the same links as regexp_links, including xref:id_{context}[text], for finding the links to an ID
+    regexp_link_targets = re.compile(
+        r'<<(?P<angleid>[^,>]+)[^>]*>>'
+        r'|xref:(?P<xrefid>[\w\-]+(?:_\{context\})?)\[[^\]]*\]'
+        r'|(?:link|\{link\-prefix\}):\{[\w\-]+\}#(?P<linkid>[^\[]+)\[[^\]]*\]'
+    )
+    # Line types recognised when resolving includes
+    regexp_attribute_line = re.compile(r'^:([\w\-]+):\s+(.*)')
+    regexp_include_line = re.compile(r'^\s*include::([^\[]+)\[([^\]]*)\]')
+    regexp_title_line = re.compile(r'^(=+)\s+(\S.*)')
+    regexp_tag_begin = re.compile(r'tag::([^\[]+)\[\]')
+    regexp_tag_end = re.compile(r'end::([^\[]+)\[\]')
+    # Whole-file prefilters for the line-based scanners (see nebel.scan)
+    prefilter_title = nebel.scan.prefilter(nebel.scan.TITLE)
+    prefilter_anchor = nebel.scan.prefilter(nebel.scan.ANCHOR)
+    prefilter_title_or_anchor = nebel.scan.prefilter(nebel.scan.TITLE, nebel.scan.ANCHOR)
+    prefilter_contexts = nebel.scan.prefilter(nebel.scan.TITLE, nebel.scan.ANCHOR, nebel.scan.ATTRIBUTE, (True, rb'ifdef::context\['))
+    prefilter_anchorids = nebel.scan.prefilter(nebel.scan.COMMENT, nebel.scan.ANCHOR, nebel.scan.TITLE, nebel.scan.ATTRIBUTE, nebel.scan.INCLUDE)
+
     def __init__(self, context):
         self.context = context
+        self.disambiguator = None
+        self.context_registry = None
+        self._file_caches = {}
+        self.trigram_index = None
+        # (key, stamps, graph, images) of the last include graph built, see _build_include_graph()
+        self._include_graph_memo = None
+
+    def _file_cache(self, name, version=1):
+        # Each cache is loaded once, so that a long-lived Tasks instance (see nebel.api) keeps it in memory
+        cache = self._file_caches.get(name)
+        if cache is None:
+            cache = self._file_caches[name] = nebel.cache.FileCache(self.context, name, version)
+        return cache
+
+    def _trigram_index(self):
+        # Loaded once per Tasks instance (see _file_cache), but brought up to date on every call
+        if self.trigram_index is None:
+            self.trigram_index = nebel.trigrams.TrigramIndex(self.context)
+        self.trigram_index.refresh()
+        return self.trigram_index
+
+    def _files_containing(self, index, text, filelist):
+        # Returns the files in 'filelist' that can contain 'text', according to the trigram index. A file that
+        # the index does not cover (for example, one that it reached by another path) is always returned.
+        candidates = index.candidates(text)
+        if candidates is None:
+            return filelist
+        return [filepath for filepath in filelist if (os.path.normpath(filepath) in candidates) or not index.covers(filepath)]
 
     def _create(self, args, metadata):
         metadata['Category'] = args.CATEGORY
@@ -60,7 +161,7 @@ class Tasks:
 
     def add_include_to_assembly(self, assemblyfile, includedfile, leveloffset=1):
         if not os.path.exists(assemblyfile):
-            print('WARN: Referenced assembly file does not exist:' + assemblyfile)
+            log.warning('Referenced assembly file does not exist:' + assemblyfile)
             return
         # Create temp file
         fh, abs_path = tempfile.mkstemp()
@@ -104,7 +205,7 @@ class Tasks:
             self._create_from_assembly(args)
             return
         else:
-            print('ERROR: Unknown file type [' + fromfile + ']: must end either in .csv or .adoc')
+            log.error('Unknown file type [' + fromfile + ']: must end either in .csv or .adoc')
             sys.exit()
 
     def type_of_file(self, basename):
@@ -154,7 +255,7 @@ class Tasks:
                     category, basename = os.path.split(modulefile)
                     type = self.type_of_file(basename)
                     if type is not None and basename.endswith('.adoc'):
-                        print(modulefile)
+                        log.info(modulefile)
                         metadata = {}
                         metadata['Type'] = type
                         metadata['Category'] = category
@@ -165,7 +266,8 @@ class Tasks:
 
     def adoc_split(self, args):
         frompattern = os.path.normpath(args.FROM_FILE)
-        fromfiles = glob.glob(frompattern.replace('{}', '*'))
+        # Sorted, so that the output does not depend on directory order or on the number of jobs
+        fromfiles = sorted(glob.glob(frompattern.replace('{}', '*')))
         if args.attribute_files:
             attrfilelist = args.attribute_files.strip().split(',')
             self.context.parse_attribute_files(attrfilelist)
@@ -175,386 +277,449 @@ class Tasks:
             selectedconditions = args.conditions.strip().split(',')
         else:
             selectedconditions = None
+        if args.legacybasedir and not os.path.exists(args.legacybasedir):
+            log.error('No such base directory: ' + args.legacybasedir)
+            sys.exit()
+        # Every file starts from the attributes defined in the attribute files
+        attributes = dict((name, list(duple)) for name, duple in self.context.attributeDict.items())
+        splitargs = []
         for fromfile in fromfiles:
-            metadata = {}
             categoryname = 'default'
             if args.legacybasedir:
-                if not os.path.exists(args.legacybasedir):
-                    print('ERROR: No such base directory: ' + args.legacybasedir)
-                    sys.exit()
                 relativedir = os.path.dirname(os.path.relpath(fromfile, args.legacybasedir))
                 categoryname = relativedir.replace(os.path.sep, '-')
             if args.category_prefix:
                 categoryname = args.category_prefix + '-' + categoryname
-            metadata['Category'] = categoryname
-            equalssigncount = 0
+            splitargs.append((fromfile, categoryname, selectedconditions, args.timestamp, attributes))
+        # Files are split in parallel, but the generated files are written here, in the order of 'fromfiles'.
+        # Worker processes cannot save the fragment cache themselves, so they return the fragments that they parsed.
+        fragment_cache = self._fragment_cache()
+        generatedfrom = {}
+        collisions = 0
+        failures = 0
+        results = nebel.parallel.map_tasks(self, '_split_file', splitargs, nebel.parallel.jobs_count(args.jobs))
+        for fromfile, (generated, fragments) in zip(fromfiles, results):
+            fragment_cache.update(fragments)
+            if generated is None:
+                # Nothing is written for a file that could not be split
+                failures += 1
+                continue
+            for filepath, contents in generated:
+                if filepath in generatedfrom and generatedfrom[filepath] != fromfile:
+                    log.error('Not overwriting ' + filepath + ' (generated from ' + generatedfrom[filepath] + ') with content from ' + fromfile, extra={'file': filepath})
+                    collisions += 1
+                    continue
+                generatedfrom[filepath] = fromfile
+                self.context.moduleFactory.write_collected(filepath, contents)
+        fragment_cache.save()
+        if collisions > 0:
+            log.error(str(collisions) + ' generated files collided between source files')
+        if failures > 0:
+            log.error(str(failures) + ' of ' + str(len(fromfiles)) + ' files could not be split')
+        if collisions > 0 or failures > 0:
+            sys.exit(1)
+
+    def _split_file(self, fromfile, categoryname, selectedconditions, timestamp, attributes):
+        # Returns (generated, fragments), where 'generated' is the list of (filepath, contents) pairs generated
+        # by splitting 'fromfile' (or None on error), and 'fragments' holds the new entries of the fragment cache
+        self.context.attributeDict = dict((name, list(duple)) for name, duple in attributes.items())
+        self.context.moduleFactory.collector = []
+        try:
+            metadata = {'Category': categoryname}
             lines = self._resolve_includes(fromfile)
-            indexofnextline = 0
-            self._parse_from_annotated(metadata, fromfile, lines, indexofnextline, equalssigncount, selectedconditions, args.timestamp)
-
-    def _parse_from_annotated(
-            self,
-            metadata,
-            fromfilepath,
-            lines,
-            indexofnextline,
-            equalssigncount,
-            selectedconditions = None,
-            timestamp = False,
-            showcontentstack = [],
-            currconditionstack = []
-    ):
+            self._parse_from_annotated(metadata, fromfile, lines, selectedconditions, timestamp)
+            return self.context.moduleFactory.collector, self._fragment_cache().take_new()
+        except SplitError as e:
+            log.error('Cannot split ' + fromfile + ': ' + str(e), extra={'file': fromfile})
+            return None, self._fragment_cache().take_new()
+        finally:
+            self.context.moduleFactory.collector = None
+
+    def _parse_from_annotated(self, metadata, fromfilepath, lines, selectedconditions = None, timestamp = False):
+        # Splits the resolved 'lines' of an annotated file into modules and assemblies, in a single pass.
+        # Open modules are kept on an explicit stack of frames, innermost last, where each frame holds
+        # the metadata, heading level, and content lines of a module. Raises SplitError on bad input.
         # Define some enums for state machine
         REGULAR_LINES = 0
         TENTATIVE_PARSING = 1
 
         # Define action enums
-        NO_ACTION = 0
         CREATE_SUBSECTION = 1
         CREATE_MODULE_OR_ASSEMBLY = 2
         END_CURRENT_MODULE = 3
 
-        # Initialize Boolean state variables
-        parsing_state = REGULAR_LINES
-        expecting_title_line = False
-        module_complete = False
-        if (selectedconditions is not None) and (len(selectedconditions) > 0):
-            isconditionalizeactive = True
-            showcontent = True
-        else:
-            isconditionalizeactive = False
-            showcontent = True
+        state = AnnotatedSplitState(lines, selectedconditions)
 
         # Define regular expressions
         regexp_metadata = re.compile(r'^\s*//\s*(\w+)\s*:\s*(.*)')
         regexp_id_line1 = re.compile(r'^\s*\[\[\s*(\S+)\s*\]\]\s*$')
         regexp_id_line2 = re.compile(r'^\s*\[id\s*=\s*[\'"]\s*(\S+)\s*[\'"]\]\s*$')
-        regexp_ifdef    = re.compile(r'^ifdef::([^\[]+)\[\]')
-        regexp_ifdef_single = re.compile(r'^ifdef::([^\[]+)\[([^\]]+)\]')
-        regexp_ifndef   = re.compile(r'^ifndef::([^\[]+)\[\]')
-        regexp_ifndef_single = re.compile(r'^ifndef::([^\[]+)\[([^\]]+)\]')
-        regexp_ifeval   = re.compile(r'^ifeval::\[([^\]]*)\]')
-        regexp_endif    = re.compile(r'^endif::([^\[]*)\[\]')
         regexp_title = re.compile(r'^(=+)\s+(\S.*)')
 
-        childmetadata = {}
-        parsedcontentlines = []
-
-        while not module_complete:
-            # Check for end of file
-            if indexofnextline >= len(lines):
-                if ('Type' in metadata) and (metadata['Type'].lower() == 'skip'):
-                    # Don't save current content
-                    return ('', len(lines))
-                elif 'Type' in metadata:
-                    generated_file = self.context.moduleFactory.create(metadata, parsedcontentlines, clobber=True)
-                    return (generated_file, len(lines))
-                else:
-                    return ('', len(lines))
-
-            if isconditionalizeactive:
-                line = lines[indexofnextline]
-                result = regexp_ifdef_single.search(line)
-                if result is not None:
-                    conditionname = result.group(1)
-                    conditionline = result.group(2)
-                    if conditionname in selectedconditions:
-                        # Replace current line with conditional text
-                        lines[indexofnextline] = conditionline
-                    else:
-                        # Skip to next line
-                        indexofnextline += 1
-                    continue
-                result = regexp_ifndef_single.search(line)
-                if result is not None:
-                    conditionname = result.group(1)
-                    conditionline = result.group(2)
-                    if conditionname not in selectedconditions:
-                        # Replace current line with conditional text
-                        lines[indexofnextline] = conditionline
-                    else:
-                        # Skip to next line
-                        indexofnextline += 1
-                    continue
-                result = regexp_ifdef.search(line)
-                if result is not None:
-                    conditionname = result.group(1)
-                    currconditionstack.append(conditionname)
-                    showcontentstack.append(showcontent)
-                    if conditionname not in selectedconditions:
-                        showcontent = False
-                    # Do not include tagged line in output
-                    indexofnextline += 1
-                    continue
-                result = regexp_ifndef.search(line)
-                if result is not None:
-                    conditionname = result.group(1)
-                    currconditionstack.append(conditionname)
-                    showcontentstack.append(showcontent)
-                    if conditionname in selectedconditions:
-                        showcontent = False
-                    # Do not include tagged line in output
-                    indexofnextline += 1
-                    continue
-                result = regexp_ifeval.search(line)
-                if result is not None:
-                    currconditionstack.append('')
-                    showcontentstack.append(showcontent)
-                    print ('WARNING: ifeval not supported: defaults to showing content')
-                    # Do not include tagged line in output
-                    indexofnextline += 1
-                    continue
-                result = regexp_endif.search(line)
-                if result is not None:
-                    conditionname = result.group(1)
-                    matchcondition = currconditionstack.pop()
-                    showcontent = showcontentstack.pop()
-                    if (conditionname) and (conditionname != matchcondition):
-                        print(('WARNING: Unmatched condition tags: ' + conditionname + '!=' + matchcondition))
-                    # Do not include tagged line in output
-                    indexofnextline += 1
-                    continue
-            if not showcontent:
+        stack = [{'metadata': metadata, 'level': 0, 'lines': []}]
+        while state.indexofnextline < len(lines):
+            if state.isconditionalizeactive and self._apply_split_condition(state):
+                continue
+            if not state.showcontent:
                 # Content is currently tagged off - skip this line
-                indexofnextline += 1
+                state.indexofnextline += 1
                 continue
 
-            if parsing_state == REGULAR_LINES:
-                line = lines[indexofnextline]
+            line = lines[state.indexofnextline]
+            frame = stack[-1]
+            if state.parsing_state == REGULAR_LINES:
                 if (regexp_metadata.search(line) is None) and (regexp_id_line1.search(line) is None) and (regexp_id_line2.search(line) is None) and (regexp_title.search(line) is None):
                     # Regular line
-                    parsedcontentlines.append(line)
-                    indexofnextline += 1
+                    frame['lines'].append(line)
+                    state.indexofnextline += 1
                 else:
                     # Switch state
-                    parsing_state = TENTATIVE_PARSING
-                    expecting_title_line = False
-                    index_of_tentative_block = indexofnextline
-                    tentativecontentlines = []
-            elif parsing_state == TENTATIVE_PARSING:
-                line = lines[indexofnextline]
-                tentativecontentlines.append(line)
-                indexofnextline += 1
-                # Skip blank lines
-                if line.strip() == '':
-                    continue
-                # Parse title line
-                result = regexp_title.search(line)
-                if result is not None:
-                    childequalssigncount = len(result.group(1))
-                    title = result.group(2)
+                    state.parsing_state = TENTATIVE_PARSING
+                    state.expecting_title_line = False
+                    state.tentativecontentlines = []
+                    state.blockmetadata = {}
+                continue
+
+            # parsing_state == TENTATIVE_PARSING
+            state.tentativecontentlines.append(line)
+            state.indexofnextline += 1
+            # Skip blank lines
+            if line.strip() == '':
+                continue
+            # Parse title line
+            result = regexp_title.search(line)
+            if result is not None:
+                childequalssigncount = len(result.group(1))
+                title = result.group(2)
+                while True:
+                    frame = stack[-1]
+                    childmetadata = dict(state.blockmetadata)
                     if 'Title' not in childmetadata:
                         childmetadata['Title'] = title
                     else:
                         childmetadata['ConvertedFromTitle'] = title
-                    if ('Type' in metadata) and (metadata['Type'].lower() == 'skip'):
+                    if ('Type' in frame['metadata']) and (frame['metadata']['Type'].lower() == 'skip'):
                         childmetadata['Type'] = 'skip'
-                    action = NO_ACTION
                     # Decide how to proceed based on level of new heading
-                    if childequalssigncount > equalssigncount:
+                    if childequalssigncount > frame['level']:
                         if 'Type' not in childmetadata:
                             action = CREATE_SUBSECTION
                         else:
                             action = CREATE_MODULE_OR_ASSEMBLY
-                    elif childequalssigncount == equalssigncount:
-                        if ('Type' in childmetadata) and (childmetadata['Type'].lower() == 'continue'):
-                            action = CREATE_SUBSECTION
-                        else:
-                            action = END_CURRENT_MODULE
+                    elif (childequalssigncount == frame['level']) and ('Type' in childmetadata) and (childmetadata['Type'].lower() == 'continue'):
+                        action = CREATE_SUBSECTION
                     else:
-                        # childequalssigncount < equalssigncount
                         action = END_CURRENT_MODULE
-                    # Perform action
-                    if action == CREATE_SUBSECTION:
-                        # It's a simple subsection, not a module or assembly
-                        # Reformat heading as a simple heading (starts with .)
-                        lastline = tentativecontentlines.pop()
-                        lastline = '.' + lastline.replace('=', '').lstrip() + '\n'
-                        # Put back tentative lines
-                        for tentativeline in tentativecontentlines:
-                            parsedcontentlines.append(tentativeline)
-                        parsedcontentlines.append(lastline)
-                    elif action == CREATE_MODULE_OR_ASSEMBLY:
-                        if ('ModuleID' not in childmetadata):
-                            print('ERROR: Heading ' + title + ' must have a module ID.')
-                            sys.exit()
-                        if ('Category' not in childmetadata):
-                            childmetadata['Category'] = metadata['Category']
-                        childmetadata['ConversionStatus'] = 'raw'
-                        if timestamp: childmetadata['ConversionDate'] = str(datetime.datetime.now())
-                        childmetadata['ConvertedFromFile'] = fromfilepath
-                        (generated_file, indexofnextline) = self._parse_from_annotated(
-                            childmetadata,
-                            fromfilepath,
-                            lines,
-                            indexofnextline,
-                            childequalssigncount,
-                            selectedconditions,
-                            timestamp,
-                            showcontentstack,
-                            currconditionstack
-                        )
-                        #if ('Type' in childmetadata) and (childmetadata['Type'].lower() == 'assembly'):
-                        #    print ('include::' + generated_file + '[leveloffset=+1]')
-                        childmetadata = {}
-                        parsedcontentlines.append('\n')
-                        if generated_file:
-                            parsedcontentlines.append('include::../../' + generated_file + '[leveloffset=+1]\n\n')
-                    elif action == END_CURRENT_MODULE:
-                        if metadata['Type'].lower() == 'skip':
-                            # Don't save current content and back up to the start of the tentative block
-                            return ('', index_of_tentative_block)
-                        # Save the current content
-                        generated_file = self.context.moduleFactory.create(metadata, parsedcontentlines, clobber=True)
-                        return (generated_file, index_of_tentative_block)
-                    # Switch state
-                    parsing_state = REGULAR_LINES
-                    expecting_title_line = False
-                    childmetadata = {}
-                    continue
-                # Parse metadata line
-                result = regexp_metadata.search(line)
-                if (result is not None) and not expecting_title_line:
-                    metadata_name = result.group(1)
-                    metadata_value = result.group(2)
-                    # Make 'TopicType' an alias for 'Type' (preferred upstream)
-                    if metadata_name == 'TopicType':
-                        metadata_name = 'Type'
-                    if metadata_name in self.context.allMetadataFields:
-                        childmetadata[metadata_name] = metadata_value
-                    else:
-                        print('WARNING: Unknown metadata "' + metadata_name + '" in file ' + fromfilepath)
-                    #print 'Metadata: ' + metadata_name + ' = ' + metadata_value
-                    continue
-                # Parse ID line
-                original_id = ''
-                result = regexp_id_line1.search(line)
-                if result is not None:
-                    original_id = result.group(1)
-                result = regexp_id_line2.search(line)
-                if result is not None:
-                    original_id = result.group(1)
-                if original_id and not expecting_title_line:
-                    if 'ModuleID' not in childmetadata:
-                        childmetadata['ModuleID'] = original_id
-                    else:
-                        childmetadata['ConvertedFromID'] = original_id
-                    # An ID line should be followed by a title line
-                    expecting_title_line = True
-                    continue
-                else:
-                    # Failed to match any of the tentative block line types!
-                    # Abort the tentative block parsing
+                    if action != END_CURRENT_MODULE:
+                        break
+                    # Save the current module, then hand the same heading to the enclosing module
+                    stack.pop()
+                    self._end_split_frame(frame, stack[-1])
+                # Perform action
+                if action == CREATE_SUBSECTION:
+                    # It's a simple subsection, not a module or assembly
+                    # Reformat heading as a simple heading (starts with .)
+                    lastline = state.tentativecontentlines.pop()
+                    lastline = '.' + lastline.replace('=', '').lstrip() + '\n'
                     # Put back tentative lines
-                    for tentativeline in tentativecontentlines:
-                        parsedcontentlines.append(tentativeline)
-                    # Switch state
-                    parsing_state = REGULAR_LINES
-                    expecting_title_line = False
-                    childmetadata = {}
-
-
-
-    def _scan_file_for_includes(self, asfile, recursive=False):
+                    frame['lines'].extend(state.tentativecontentlines)
+                    frame['lines'].append(lastline)
+                else:
+                    if ('ModuleID' not in childmetadata):
+                        raise SplitError('Heading ' + title + ' must have a module ID.')
+                    if ('Category' not in childmetadata):
+                        childmetadata['Category'] = frame['metadata']['Category']
+                    childmetadata['ConversionStatus'] = 'raw'
+                    if timestamp: childmetadata['ConversionDate'] = str(datetime.datetime.now())
+                    childmetadata['ConvertedFromFile'] = fromfilepath
+                    stack.append({'metadata': childmetadata, 'level': childequalssigncount, 'lines': []})
+                # Switch state
+                state.parsing_state = REGULAR_LINES
+                state.expecting_title_line = False
+                continue
+            # Parse metadata line
+            result = regexp_metadata.search(line)
+            if (result is not None) and not state.expecting_title_line:
+                metadata_name = result.group(1)
+                metadata_value = result.group(2)
+                # Make 'TopicType' an alias for 'Type' (preferred upstream)
+                if metadata_name == 'TopicType':
+                    metadata_name = 'Type'
+                if metadata_name in self.context.allMetadataFields:
+                    state.blockmetadata[metadata_name] = metadata_value
+                else:
+                    log.warning('Unknown metadata "' + metadata_name + '" in file ' + fromfilepath)
+                continue
+            # Parse ID line
+            original_id = ''
+            result = regexp_id_line1.search(line)
+            if result is not None:
+                original_id = result.group(1)
+            result = regexp_id_line2.search(line)
+            if result is not None:
+                original_id = result.group(1)
+            if original_id and not state.expecting_title_line:
+                if 'ModuleID' not in state.blockmetadata:
+                    state.blockmetadata['ModuleID'] = original_id
+                else:
+                    state.blockmetadata['ConvertedFromID'] = original_id
+                # An ID line should be followed by a title line
+                state.expecting_title_line = True
+                continue
+            # Failed to match any of the tentative block line types!
+            # Abort the tentative block parsing and put back tentative lines
+            frame['lines'].extend(state.tentativecontentlines)
+            state.parsing_state = REGULAR_LINES
+            state.expecting_title_line = False
+
+        # End of file: save all of the open modules, innermost first
+        while len(stack) > 1:
+            frame = stack.pop()
+            self._end_split_frame(frame, stack[-1])
+        return self._save_split_frame(stack[0])
+
+    def _apply_split_condition(self, state):
+        # Processes a conditional directive at the current line, returning True if it was one
+        line = state.lines[state.indexofnextline]
+        if not line.startswith(('ifdef::', 'ifndef::', 'ifeval::', 'endif::')):
+            return False
+        result = state.regexp_ifdef_single.search(line)
+        if result is not None:
+            if result.group(1) in state.selectedconditions:
+                # Replace current line with conditional text
+                state.lines[state.indexofnextline] = result.group(2)
+            else:
+                # Skip to next line
+                state.indexofnextline += 1
+            return True
+        result = state.regexp_ifndef_single.search(line)
+        if result is not None:
+            if result.group(1) not in state.selectedconditions:
+                # Replace current line with conditional text
+                state.lines[state.indexofnextline] = result.group(2)
+            else:
+                # Skip to next line
+                state.indexofnextline += 1
+            return True
+        ifdef_result = state.regexp_ifdef.search(line)
+        ifndef_result = state.regexp_ifndef.search(line)
+        endif_result = state.regexp_endif.search(line)
+        if ifdef_result is not None:
+            state.currconditionstack.append(ifdef_result.group(1))
+            state.showcontentstack.append(state.showcontent)
+            if ifdef_result.group(1) not in state.selectedconditions:
+                state.showcontent = False
+        elif ifndef_result is not None:
+            state.currconditionstack.append(ifndef_result.group(1))
+            state.showcontentstack.append(state.showcontent)
+            if ifndef_result.group(1) in state.selectedconditions:
+                state.showcontent = False
+        elif state.regexp_ifeval.search(line) is not None:
+            state.currconditionstack.append('')
+            state.showcontentstack.append(state.showcontent)
+            log.warning('ifeval not supported: defaults to showing content')
+        elif endif_result is not None:
+            conditionname = endif_result.group(1)
+            if not state.currconditionstack:
+                raise SplitError('Unmatched endif::' + conditionname + '[]')
+            matchcondition = state.currconditionstack.pop()
+            state.showcontent = state.showcontentstack.pop()
+            if (conditionname) and (conditionname != matchcondition):
+                log.warning('Unmatched condition tags: ' + conditionname + '!=' + matchcondition)
+        else:
+            return False
+        # Do not include tagged line in output
+        state.indexofnextline += 1
+        return True
+
+    def _end_split_frame(self, frame, parentframe):
+        # Saves the module in 'frame' and includes it in the enclosing module
+        generated_file = self._save_split_frame(frame)
+        parentframe['lines'].append('\n')
+        if generated_file:
+            parentframe['lines'].append('include::../../' + generated_file + '[leveloffset=+1]\n\n')
+
+    def _save_split_frame(self, frame):
+        # Returns the path of the generated file, or '' if nothing is generated
+        metadata = frame['metadata']
+        if ('Type' not in metadata) or (metadata['Type'].lower() == 'skip'):
+            # Don't save current content
+            return ''
+        if metadata['Type'].lower() not in ['assembly', 'procedure', 'concept', 'reference', 'module']:
+            raise SplitError('Unknown module Type: ' + metadata['Type'] + ' (in module ' + metadata['ModuleID'] + ')')
+        return self.context.moduleFactory.create(metadata, frame['lines'], clobber=True)
+
+    def _scan_file_for_includes(self, asfile, recursive=False, cache=None):
+        # If a FileCache 'cache' is provided, the raw include targets of unchanged files are taken from
+        # the cache. They are resolved against the current attributes on every call.
         includedfilelist = []
-        regexp = re.compile(r'^\s*include::([^\[]+)\[[^\]]*\]')
-        with open(asfile, 'r') as f:
-            for line in f:
-                result = regexp.search(line)
-                if result is not None:
-                    includedfile = self.context.resolve_raw_attribute_value(result.group(1))
-                    directory = os.path.dirname(asfile)
-                    path_to_included_file = os.path.relpath(os.path.realpath(os.path.normpath(os.path.join(directory, includedfile))))
-                    if includedfile.endswith('.adoc'):
-                        includedfilelist.append(path_to_included_file)
+        rawincludefiles = cache.get(asfile) if cache is not None else None
+        if rawincludefiles is None:
+            rawincludefiles = []
+            regexp = re.compile(r'^\s*include::([^\[]+)\[[^\]]*\]')
+            with open(asfile, 'r') as f:
+                for line in f:
+                    result = regexp.search(line)
+                    if result is not None:
+                        rawincludefiles.append(result.group(1))
+            if cache is not None:
+                cache.put(asfile, rawincludefiles)
+        for rawincludefile in rawincludefiles:
+            includedfile = self.context.resolve_raw_attribute_value(rawincludefile)
+            directory = os.path.dirname(asfile)
+            path_to_included_file = os.path.relpath(os.path.realpath(os.path.normpath(os.path.join(directory, includedfile))))
+            if includedfile.endswith('.adoc'):
+                includedfilelist.append(path_to_included_file)
         allincludedfilelist = includedfilelist
         if (recursive):
             for file in includedfilelist:
                 if not os.path.exists(file):
-                    print('ERROR: While scanning ' + asfile + ': included file, ' + file + ', does not exist')
+                    log.error('While scanning ' + asfile + ': included file, ' + file + ', does not exist')
                     sys.exit()
-                childincludedfilelist = self._scan_file_for_includes(file, recursive=True)
+                childincludedfilelist = self._scan_file_for_includes(file, recursive=True, cache=cache)
                 allincludedfilelist.extend(childincludedfilelist)
         return allincludedfilelist
 
     def _resolve_includes(self, file, baselevel=0, selectedtags=None):
         # Resolve all of the nested includes in 'file' to plain text and return a plain text array of all the lines in the file
+        return [line for line, sourcefile, lineno in self._iter_resolved_lines(file, baselevel, selectedtags)]
+
+    def _iter_resolved_lines(self, file, baselevel=0, selectedtags=None):
+        # Generator over the lines of 'file' with all nested includes resolved, yielding (line, sourcefile, lineno).
+        # Headings are shifted by 'baselevel' (and lose their line ending), and if 'selectedtags' is given,
+        # only the lines in those tagged regions are included.
         if not os.path.exists(file):
-            print('ERROR: Include file not found: ' + file)
+            log.error('Include file not found: ' + file)
             sys.exit()
+        fragment, tagindex = self._resolved_fragment(file)
         if (selectedtags is not None) and (len(selectedtags) > 0):
             istaggingactive = True
-            showcontent = False
-            currtagname = ''
+            entries = self._tagged_entries(fragment, tagindex, selectedtags)
         else:
             istaggingactive = False
-            showcontent = True
-            currtagname = ''
-        linesinfile = []
-        regexp_attribute = re.compile(r'^:([\w\-]+):\s+(.*)')
-        regexp_include = re.compile(r'^\s*include::([^\[]+)\[([^\]]*)\]')
-        regexp_title = re.compile(r'^(=+)\s+(\S.*)')
-        regexp_tag_begin = re.compile(r'tag::([^\[]+)\[\]')
-        regexp_tag_end   = re.compile(r'end::([^\[]+)\[\]')
-        with open(file, 'r') as f:
-            for line in f:
+            entries = fragment
+        for entry in entries:
+            kind = entry[0]
+            if kind == 'tag' or kind == 'end':
                 if istaggingactive:
-                    result = regexp_tag_begin.search(line)
-                    if result is not None:
-                        tagname = result.group(1)
-                        # Checks 'currtagname' in order to ignore nested tags
-                        if (not currtagname) and (tagname in selectedtags):
-                            showcontent = True
-                            currtagname = tagname
-                        # Do not include tagged line in output
-                        continue
-                    result = regexp_tag_end.search(line)
-                    if result is not None:
-                        tagname = result.group(1)
-                        if tagname == currtagname:
-                            showcontent = False
-                            currtagname = ''
-                        # Do not include tagged line in output
-                        continue
-                if not showcontent:
-                    # Content is currently tagged off - skip this line
-                    continue
-                result = regexp_attribute.search(line)
-                if result is not None:
-                    name = result.group(1)
-                    value = result.group(2).strip()
-                    self.context.update_attribute(name, value)
-                    linesinfile.append(line)
+                    # Do not include tagged line in output
                     continue
-                result = regexp_title.search(line)
+                # Without tag filtering, a tag line is processed like any other line
+                entry = self._classify_resolved_line(entry[2], entry[1])
+                kind = entry[0]
+            if kind == 'lines':
+                firstlineno = entry[1]
+                for offset, line in enumerate(entry[2]):
+                    yield line, file, firstlineno + offset
+            elif kind == 'attribute':
+                self.context.update_attribute(entry[3], entry[4])
+                yield entry[2], file, entry[1]
+            elif kind == 'title':
+                yield '=' * (entry[2] + baselevel) + ' ' + entry[3], file, entry[1]
+            elif kind == 'include':
+                path_to_included_file, childbaselevel, taglist = self._include_target(file, entry[2], entry[3], baselevel)
+                for resolved in self._iter_resolved_lines(path_to_included_file, childbaselevel, taglist):
+                    yield resolved
+
+    def _fragment_cache(self):
+        return self._file_cache('resolved', version=2)
+
+    def _resolved_fragment(self, file):
+        # Returns (fragment, tagindex) for a single file (without following includes). The fragment is a list of entries:
+        #   ('lines', firstlineno, [line, ...]) for a run of ordinary lines, ('attribute', lineno, line, name, value),
+        #   ('title', lineno, equalssigncount, title), ('include', lineno, rawincludefile, options),
+        #   and ('tag', lineno, line, tagname) or ('end', lineno, line, tagname) for tag directives.
+        # The tag index maps each tag name to the sorted fragment indexes of its 'tag' entries and of its 'end'
+        # entries, as {tagname: ([tagindex, ...], [endindex, ...])}, or is None for a file without tags.
+        # Both are cached, so that a file is only parsed once, however many times it is included.
+        cache = self._fragment_cache()
+        stamp = cache.stamp(file)
+        cached = cache.get(file, stamp)
+        if cached is not None:
+            return cached
+        fragment = []
+        tagindex = {}
+        with open(file, 'r') as f:
+            for lineno, line in enumerate(f, 1):
+                result = self.regexp_tag_begin.search(line)
                 if result is not None:
-                    childequalssigncount = len(result.group(1))
-                    title = result.group(2)
-                    linesinfile.append('=' * (childequalssigncount + baselevel) + ' ' + title)
+                    tagindex.setdefault(result.group(1), ([], []))[0].append(len(fragment))
+                    fragment.append(('tag', lineno, line, result.group(1)))
                     continue
-                result = regexp_include.search(line)
+                result = self.regexp_tag_end.search(line)
                 if result is not None:
-                    includedfile = self.context.resolve_raw_attribute_value(result.group(1))
-                    options      = result.group(2)
-                    optmap = self._parse_include_opts(options)
-                    childbaselevel = baselevel
-                    if 'leveloffset' in optmap:
-                        leveloffset = optmap['leveloffset'].strip()
-                        if leveloffset.startswith('+'):
-                            childbaselevel = baselevel + int(leveloffset)
-                        else:
-                            childbaselevel = int(leveloffset)
-                    directory = os.path.dirname(file)
-                    path_to_included_file = os.path.relpath(os.path.realpath(os.path.normpath(os.path.join(directory, includedfile))))
-                    taglist = []
-                    if ('tag' in optmap):
-                        taglist.append(optmap['tag'].strip())
-                    if ('tags' in optmap):
-                        taglist.extend(optmap['tags'].split(';'))
-                    linesinfile.extend(self._resolve_includes(path_to_included_file, baselevel=childbaselevel, selectedtags=taglist))
+                    tagindex.setdefault(result.group(1), ([], []))[1].append(len(fragment))
+                    fragment.append(('end', lineno, line, result.group(1)))
                     continue
-                linesinfile.append(line)
-        return linesinfile
+                entry = self._classify_resolved_line(line, lineno)
+                if entry[0] == 'lines' and fragment and fragment[-1][0] == 'lines':
+                    fragment[-1][2].append(line)
+                else:
+                    fragment.append(entry)
+        cached = (fragment, tagindex or None)
+        cache.put(file, cached, stamp)
+        return cached
+
+    def _tagged_entries(self, fragment, tagindex, selectedtags):
+        # Yields the fragment entries inside the regions of 'selectedtags'. A region starts at the first
+        # selected tag after the previous region, and ends at the next end of that same tag, so that any
+        # tags nested inside the region are ignored. The content of an unclosed region runs to the end of file.
+        if tagindex is None:
+            return
+        position = 0
+        while True:
+            start = None
+            for tagname in selectedtags:
+                if tagname in tagindex:
+                    starts = tagindex[tagname][0]
+                    k = bisect.bisect_left(starts, position)
+                    if k < len(starts) and (start is None or starts[k] < start):
+                        start = starts[k]
+                        currtagname = tagname
+            if start is None:
+                return
+            ends = tagindex[currtagname][1]
+            k = bisect.bisect_right(ends, start)
+            end = ends[k] if k < len(ends) else len(fragment)
+            for entry in fragment[start + 1:end]:
+                yield entry
+            position = end + 1
+
+    def _classify_resolved_line(self, line, lineno):
+        result = self.regexp_attribute_line.search(line)
+        if result is not None:
+            return ('attribute', lineno, line, result.group(1), result.group(2).strip())
+        result = self.regexp_title_line.search(line)
+        if result is not None:
+            return ('title', lineno, len(result.group(1)), result.group(2))
+        result = self.regexp_include_line.search(line)
+        if result is not None:
+            return ('include', lineno, result.group(1), result.group(2))
+        return ('lines', lineno, [line])
+
+    def _include_target(self, file, rawincludefile, options, baselevel=0):
+        # Returns (path_to_included_file, childbaselevel, taglist) for an include directive in 'file'
+        includedfile = self.context.resolve_raw_attribute_value(rawincludefile)
+        optmap = self._parse_include_opts(options)
+        childbaselevel = self._child_baselevel(optmap, baselevel)
+        directory = os.path.dirname(file)
+        path_to_included_file = os.path.relpath(os.path.realpath(os.path.normpath(os.path.join(directory, includedfile))))
+        taglist = []
+        if ('tag' in optmap):
+            taglist.append(optmap['tag'].strip())
+        if ('tags' in optmap):
+            taglist.extend(optmap['tags'].split(';'))
+        return path_to_included_file, childbaselevel, taglist
+
+    def _child_baselevel(self, optmap, baselevel):
+        childbaselevel = baselevel
+        if 'leveloffset' in optmap:
+            leveloffset = optmap['leveloffset'].strip()
+            if leveloffset.startswith('+'):
+                childbaselevel = baselevel + int(leveloffset)
+            else:
+                childbaselevel = int(leveloffset)
+        return childbaselevel
 
     def _parse_include_opts(self, optstring):
         # Returns a map of property, value pairs
@@ -583,7 +748,7 @@ class Tasks:
                 headinglist[k] = 'ModuleID'
             # Check plausibility of headinglist
             if ('Category' not in headinglist) or ('ModuleID' not in headinglist):
-                print('ERROR: CSV file does not have correct format')
+                log.error('CSV file does not have correct format')
                 sys.exit()
             if 'Level' in headinglist:
                 USING_LEVELS = True
@@ -605,7 +770,7 @@ class Tasks:
                     metadata = dict(zip(headinglist, fieldlist))
                     # Skip rows with Implement field set to 'no'
                     if ('Implement' in metadata) and (metadata['Implement'].lower() == 'no'):
-                        print('INFO: Skipping unimplemented module/assembly: ' + metadata['ModuleID'])
+                        log.info('Skipping unimplemented module/assembly: ' + metadata['ModuleID'])
                         continue
                     # Weed out irrelevant metadata entries
                     for field,value in metadata.items():
@@ -676,7 +841,7 @@ class Tasks:
 
     def book(self,args):
         if self.context.ASSEMBLIES_DIR == '.' or self.context.MODULES_DIR == '.':
-            print('ERROR: book command is only usable for a standard directory layout, with defined assemblies and modules directories')
+            log.error('book command is only usable for a standard directory layout, with defined assemblies and modules directories')
             sys.exit()
         if args.create:
             # Create book and (optionally) add categories
@@ -685,13 +850,13 @@ class Tasks:
             # Add categories
             self._book_categories(args)
         else:
-            print('ERROR: No options specified')
+            log.error('No options specified')
 
 
     def _book_create(self,args):
         bookdir = args.BOOK_DIR
         if os.path.exists(bookdir):
-            print('ERROR: Book directory already exists: ' + bookdir)
+            log.error('Book directory already exists: ' + bookdir)
             sys.exit()
         os.mkdir(bookdir)
         os.mkdir(os.path.join(bookdir, self.context.ASSEMBLIES_DIR))
@@ -714,7 +879,7 @@ class Tasks:
     def _book_categories(self, args):
         bookdir = args.BOOK_DIR
         if not os.path.exists(bookdir):
-            print('ERROR: Book directory does not exist: ' + bookdir)
+            log.error('Book directory does not exist: ' + bookdir)
             sys.exit()
         imagesdir = os.path.join(bookdir, self.context.IMAGES_DIR)
         modulesdir = os.path.join(bookdir, self.context.MODULES_DIR)
@@ -747,7 +912,7 @@ class Tasks:
 
     def update(self,args):
         if (not args.fix_includes) and (not args.parent_assemblies) and (not args.fix_links) and (not args.generate_ids) and (not args.add_contexts):
-            print('ERROR: Missing required option(s)')
+            log.error('Missing required option(s)')
             sys.exit()
         if args.attribute_files:
             attrfilelist = args.attribute_files.strip().split(',')
@@ -769,7 +934,7 @@ class Tasks:
                     assemblyfiles = []
                     modulefiles = [args.FILE]
                 else:
-                    print('ERROR: File must be a module or an assembly: ' + args.FILE)
+                    log.error('File must be a module or an assembly: ' + args.FILE)
                     sys.exit()
         else:
             # Determine the set of categories to update
@@ -779,7 +944,7 @@ class Tasks:
                 list(map(str.strip, categoryset))
             elif args.book:
                 if not os.path.exists(args.book):
-                    print('ERROR: ' + args.book + ' directory does not exist.')
+                    log.error(args.book + ' directory does not exist.')
                     sys.exit()
                 categoryset = self.scan_for_categories(os.path.join(args.book, self.context.MODULES_DIR))\
                               | self.scan_for_categories(os.path.join(args.book, self.context.ASSEMBLIES_DIR))
@@ -787,18 +952,26 @@ class Tasks:
                 categoryset = self.scan_for_categories(self.context.MODULES_DIR) | self.scan_for_categories(self.context.ASSEMBLIES_DIR)
             assemblyfiles = self.scan_for_categorised_files(self.context.ASSEMBLIES_DIR, categoryset, filefilter='assembly')
             modulefiles = self.scan_for_categorised_files(self.context.MODULES_DIR, categoryset, filefilter='module')
-            imagefiles = self.scan_for_categorised_files(self.context.IMAGES_DIR, categoryset)
+        # Configure how ambiguous include paths and link targets are resolved
+        if args.collect and not args.decisions:
+            log.error('--collect requires a --decisions FILE to write to')
+            sys.exit()
+        heuristics = [h.strip() for h in args.resolve.split(',')] if args.resolve else []
+        self.disambiguator = nebel.decisions.Disambiguator(self.context, heuristics, args.decisions, args.collect)
         # Select the kind of update to implement
         if args.fix_includes:
             self._update_fix_includes(assemblyfiles, modulefiles)
         if args.fix_links:
-            self._update_fix_links(assemblyfiles, modulefiles, attrfilelist)
+            self._update_fix_links(assemblyfiles, modulefiles, attrfilelist, args.resume, scoped=bool(args.FILE))
+        if args.collect:
+            self.disambiguator.save()
+            log.info('Recorded ' + str(len(self.disambiguator.unresolved)) + ' unresolved choice(s) in ' + args.decisions)
         if args.parent_assemblies:
             self._update_parent_assemblies(assemblyfiles)
         if args.generate_ids:
             if fixfileset is None:
                 fixfileset = set(assemblyfiles) | set(modulefiles)
-            self._update_generate_ids(fixfileset, args.id_prefix)
+            self._update_generate_ids(fixfileset, args.id_prefix, nebel.parallel.jobs_count(args.jobs))
         if args.add_contexts:
             self._add_contexts(assemblyfiles, modulefiles, attrfilelist, args)
 
@@ -857,7 +1030,7 @@ class Tasks:
 
 
     def _update_include_directives(self, file, assemblyfiledict, modulefiledict):
-        print('Updating include directives for file: ' + file)
+        log.info('Updating include directives for file: %s', file, extra={'file': file})
         regexp = re.compile(r'^\s*include::([^\[\{]+)\[([^\]]*)\]')
         dirname = os.path.dirname(file)
         # Create temp file
@@ -878,33 +1051,61 @@ class Tasks:
                                     # Assembly case
                                     if normincludefile in assemblyfiledict:
                                         pathlist = assemblyfiledict[normincludefile]
-                                        new_includepath = self.choose_includepath(dirname, pathlist)
+                                        new_includepath = self.choose_includepath(dirname, pathlist, file, includepath)
                                         if new_includepath is not None:
                                             new_file.write('include::' + new_includepath + '[' + result.group(2) + ']\n')
-                                            print('Replacing: ' + includepath + ' with ' + new_includepath)
+                                            log.info('Replacing: ' + includepath + ' with ' + new_includepath, extra={'file': file})
                                             continue
                                 else:
                                     # Module case
                                     if normincludefile in modulefiledict:
                                         pathlist = modulefiledict[normincludefile]
-                                        new_includepath = self.choose_includepath(dirname, pathlist)
+                                        new_includepath = self.choose_includepath(dirname, pathlist, file, includepath)
                                         if new_includepath is not None:
                                             new_file.write('include::' + new_includepath + '[' + result.group(2) + ']\n')
-                                            print('Replacing: ' + includepath + ' with ' + new_includepath)
+                                            log.info('Replacing: ' + includepath + ' with ' + new_includepath, extra={'file': file})
                                             continue
                         else:
-                            print('WARN: Unparsable include:' + line.strip())
+                            log.warning('Unparsable include:' + line.strip())
                     new_file.write(line)
+        if self._is_collecting():
+            # First pass of a batch run: record choices only, leave the file unchanged
+            os.remove(abs_path)
+            return
         # Remove original file
         os.remove(file)
         # Move new file
         shutil.move(abs_path, file)
 
 
-    def choose_includepath(self, basedir, pathlist):
+    def _is_collecting(self):
+        return (self.disambiguator is not None) and self.disambiguator.collect
+
+
+    def _choose_without_prompt(self, kind, fixfile, key, candidates, **hints):
+        # Returns (resolved, choice), where resolved is False if the user must be prompted
+        if self.disambiguator is None:
+            return False, None
+        choice = self.disambiguator.resolve(kind, fixfile, key, candidates, **hints)
+        if choice is not None:
+            return True, choice
+        if self.disambiguator.is_interactive():
+            return False, None
+        if self.disambiguator.collect:
+            self.disambiguator.record(kind, fixfile, key, candidates)
+        else:
+            log.warning('Unresolved choice for ' + key + ' in ' + str(fixfile) + ' - left unchanged')
+        return True, None
+
+
+    def choose_includepath(self, basedir, pathlist, fixfile=None, includepath=None):
         if len(pathlist) == 1:
             return os.path.relpath(pathlist[0], basedir)
         else:
+            resolved, choice = self._choose_without_prompt('includes', fixfile, includepath, pathlist)
+            if resolved:
+                return os.path.relpath(choice, basedir) if choice is not None else None
+            nebel.log.flush()
             print('\tChoose the correct path for the included file or S to skip:')
             for k, path in enumerate(pathlist):
                 print('\t' + str(k) + ') ' + path)
@@ -923,30 +1124,26 @@ class Tasks:
             return None
 
 
-    def _scan_for_parent_assemblies(self, assemblylist):
-        # Create dictionary of modules included by assemblies
-        assemblyincludes = {}
+    def _scan_for_parent_assemblies(self, assemblylist, cache=None):
+        # Returns the graph of the files directly included by each assembly, where graph.parents(file)
+        # lists the assemblies that include the file and graph.children(assembly) the files it includes
+        includegraph = nebel.graph.IncludeGraph()
         for assemblyfile in assemblylist:
-            assemblyincludes[assemblyfile] = self._scan_file_for_includes(assemblyfile)
-        # print assemblyincludes
-        # Invert dictionary
-        parentassemblies = {}
-        for assemblyfile in assemblyincludes:
-            for modulefile in assemblyincludes[assemblyfile]:
-                if modulefile not in parentassemblies:
-                    parentassemblies[modulefile] = [assemblyfile]
-                else:
-                    parentassemblies[modulefile].append(assemblyfile)
-        return parentassemblies, assemblyincludes
+            includegraph.node(assemblyfile)
+            for modulefile in self._scan_file_for_includes(assemblyfile, cache=cache):
+                includegraph.add_edge(assemblyfile, modulefile, unique=False)
+        return includegraph
 
 
     def _update_parent_assemblies(self, assemblylist):
-        parentassemblies, assemblyincludes = self._scan_for_parent_assemblies(assemblylist)
+        includegraph = self._scan_for_parent_assemblies(assemblylist)
         # Update the ParentAssemblies metadata in each of the module files
         metadata = {}
-        for modulefile in parentassemblies:
-            metadata['ParentAssemblies'] = ','.join(parentassemblies[modulefile])
-            self.update_metadata(modulefile, metadata)
+        for modulefile in includegraph.paths.strings:
+            parentassemblies = includegraph.parents(modulefile)
+            if parentassemblies:
+                metadata['ParentAssemblies'] = ','.join(parentassemblies)
+                self.update_metadata(modulefile, metadata)
 
     def _scan_for_bookfiles(self):
         # Scan current dir for top-level book files
@@ -960,142 +1157,275 @@ class Tasks:
                     booklist.append(bookfile)
         return booklist
 
-    def _update_fix_links(self, assemblyfiles, modulefiles, attrfilelist = None):
+    def _update_fix_links(self, assemblyfiles, modulefiles, attrfilelist = None, resume = False, scoped = False):
         # Set of files whose links should be fixed
         fixfileset = set(assemblyfiles) | set(modulefiles)
+        # The checkpoint holds the tables and the files already updated, for resuming an interrupted run.
+        # A first pass that only collects choices changes no files, so it does not need one.
+        checkpoint = None
+        tables = None
+        if not self._is_collecting():
+            # Choices depend on the resolution options and on the recorded decisions, so they are part of the key
+            disambiguator = self.disambiguator
+            choices = None
+            if disambiguator is not None:
+                decisionsfile = disambiguator.decisionsfile
+                decisionsstamp = nebel.cache.stamp(decisionsfile) if (decisionsfile and os.path.exists(decisionsfile)) else None
+                choices = (disambiguator.heuristics, decisionsfile, decisionsstamp, disambiguator.collect)
+            checkpoint = nebel.checkpoint.Checkpoint(self.context, 'fix-links', ('fix-links', sorted(fixfileset), attrfilelist, choices))
+            if checkpoint.start(resume):
+                tables = checkpoint.load_phase('tables')
         # Identify top-level book files to scan
         booklist = self._scan_for_bookfiles()
-        # Initialize anchor ID dictionary, legacy ID, and root of ID lookup
-        anchorid_dict = {}
-        legacyid_dict = {}
-        rootofid_dict = {}
-        metadata_list = []
-        # Process each book in the list
-        for bookfile in booklist:
-            booktitle = self._scan_for_title(bookfile)
-            booktitle_slug = self._convert_title_to_slug(booktitle)
-            #print 'Title URL slug: ' + booktitle_slug
-            print('Title: ' + booktitle)
-            self.context.clear_attributes()
-            anchorid_dict, legacyid_dict, rootofid_dict, metadata_list = self._parse_file_for_anchorids(anchorid_dict, legacyid_dict, rootofid_dict, metadata_list, booktitle_slug, bookfile)
-            #print anchorid_dict.keys()
-        #print anchorid_dict
-        self.anchorid_dict = anchorid_dict
-        self.legacyid_dict = legacyid_dict
-        self.rootofid_dict = rootofid_dict
-
-        # Generate parentassemblies dictionary for all assemblies
         categoryset = self.scan_for_categories(self.context.ASSEMBLIES_DIR)
         assemblyfiles = self.scan_for_categorised_files(self.context.ASSEMBLIES_DIR, categoryset, filefilter='assembly')
         assemblyfiles.extend(booklist)
-        parentassemblies, assemblyincludes = self._scan_for_parent_assemblies(assemblyfiles)
-        self.parentassemblies = parentassemblies
-
+        if tables is not None:
+            # The tables are only valid if no book or assembly was added or removed, and no file that they were
+            # built from changed since, except for the files that the interrupted run already updated itself
+            self.anchors, self.parentassemblies, tablefiles, stamps = tables
+            stamps = dict((filepath, filestamp) for filepath, filestamp in stamps.items() if not checkpoint.is_done(filepath))
+            if (tablefiles != sorted(assemblyfiles)) or not nebel.cache.unchanged(stamps):
+                log.info('Files changed since the interrupted run: scanning the books again')
+                tables = None
+        if tables is None:
+            includes_cache = self._file_cache('includes')
+            # In scoped mode, the books in scope are found from the full include graph of every book, so that a
+            # book that includes a file through modules (and not only through assemblies) is in scope too
+            scope = None
+            if scoped:
+                initial = self._copy_attributes(self.context.attributeDict)
+                scope = self._link_scope(fixfileset, booklist, self._build_include_graph(attrfilelist), attrfilelist)
+                self.context.attributeDict = initial
+            self.anchors = self._harvest_anchors(booklist, scope)
+
+            # Generate the graph of parent assemblies for all assemblies, where include paths in assemblies
+            # are resolved with the attributes of the last book
+            self.parentassemblies = self._scan_for_parent_assemblies(assemblyfiles, includes_cache)
+            includes_cache.save()
+            if checkpoint is not None:
+                # Record the state of every file that the tables were built from
+                tablefiles = set(assemblyfiles) | set(attrfilelist or [])
+                anchors_cache = self._file_cache('anchors', version=3)
+                for bookfile in booklist:
+                    entry = anchors_cache.stale(bookfile)
+                    if entry is not None:
+                        tablefiles.update(entry[1])
+                stamps = dict((filepath, nebel.cache.stamp(filepath) if os.path.exists(filepath) else None) for filepath in tablefiles)
+                checkpoint.save_phase('tables', (self.anchors, self.parentassemblies, sorted(assemblyfiles), stamps))
+        # Parent sets (of node numbers) are memoized, for constant time _{context} decisions in _repair_anchorid()
+        self._parent_sets = {}
+        self._target_parents = {}
+        self._context_suffix_memo = {}
+
+        try:
+            for fixfile in sorted(fixfileset):
+                if (checkpoint is not None) and checkpoint.is_done(fixfile):
+                    continue
+                log.info('Updating links for file: %s', fixfile, extra={'file': fixfile})
+                dirname = os.path.dirname(fixfile)
+                # Create temp file
+                fh, abs_path = tempfile.mkstemp()
+                with os.fdopen(fh, 'w') as new_file:
+                    with open(fixfile) as old_file:
+                        for line in old_file:
+                            new_file.write(self._rewrite_links(line, fixfile))
+                if self._is_collecting():
+                    # First pass of a batch run: record choices only, leave the file unchanged
+                    os.remove(abs_path)
+                    continue
+                # Remove original file
+                os.remove(fixfile)
+                # Move new file
+                shutil.move(abs_path, fixfile)
+                checkpoint.done(fixfile)
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
+        if checkpoint is not None:
+            checkpoint.finish()
+
+
+    def _link_scope(self, fixfileset, booklist, includegraph=None, attrfilelist=None):
+        # Returns the books whose anchors the links in 'fixfileset' can point to: the books that include any
+        # of the files, directly or indirectly (according to the IncludeGraph 'includegraph' of every book, see
+        # _build_include_graph), and the title slugs of the books named by the {attr} of a link:{attr}#id link,
+        # where the attribute is a book URL (see bookUrlAttributes). Without the graph, every book is in scope.
+        if includegraph is None:
+            scopebooks = set(booklist)
+        else:
+            ancestors = includegraph.ancestors(set(os.path.relpath(os.path.realpath(fixfile)) for fixfile in fixfileset))
+            scopebooks = set(bookfile for bookfile in booklist if os.path.relpath(os.path.realpath(bookfile)) in ancestors)
+        if attrfilelist is not None:
+            self.context.clear_attributes()
+            self.context.parse_attribute_files(attrfilelist)
+        booksofattribute = {}
+        for producturls in self.context.bookUrlAttributes.values():
+            for bookslug, name in producturls.items():
+                booksofattribute.setdefault('{' + name + '}', set()).add(self._convert_title_to_slug(bookslug))
+        linkedslugs = set()
         for fixfile in fixfileset:
-            print('Updating links for file: ' + fixfile)
-            dirname = os.path.dirname(fixfile)
-            # Create temp file
-            fh, abs_path = tempfile.mkstemp()
-            with os.fdopen(fh, 'w') as new_file:
-                with open(fixfile) as old_file:
-                    for line in old_file:
-                        # Smuggle the 'fixfile' value into the _on_match_*() functions
-                        self._on_match_fixfile = fixfile
-                        line = self._regexp_replace_angles(line)
-                        line = self._regexp_replace_xref(line)
-                        line = self._regexp_replace_link(line)
-                        new_file.write(line)
-            # Remove original file
-            os.remove(fixfile)
-            # Move new file
-            shutil.move(abs_path, fixfile)
-
-
-    def _regexp_replace_angles(self, value):
-        regexp = re.compile(r'<<([^,>]+),?([^>]*)>>')
-        new_value = regexp.sub(self._on_match_xref, value)
-        return new_value
-
-
-    def _regexp_replace_xref(self, value):
-        regexp = re.compile(r'xref:([\w\-]+)\[([^\]]*)\]')
-        new_value = regexp.sub(self._on_match_xref, value)
-        return new_value
-
-
-    def _on_match_xref(self, match_obj):
-        anchorid = match_obj.group(1)
-        optionaltext = match_obj.group(2)
-        new_anchorid = self._repair_anchorid(anchorid, self._on_match_fixfile)
-        if optionaltext:
+            with open(fixfile, 'r') as f:
+                for line in f:
+                    if 'link' not in line:
+                        continue
+                    for match_obj in self.regexp_links.finditer(line):
+                        if match_obj.group('bookattr') is not None:
+                            linkedslugs |= booksofattribute.get(match_obj.group('bookattr'), set())
+        return scopebooks, linkedslugs
+
+    def _harvest_anchors(self, booklist, scope=None):
+        # Returns the AnchorIndex of every book in 'booklist'. The anchors of each book are cached, and a book
+        # is only parsed again if any of its files changed. With a 'scope' (see _link_scope), only the books in
+        # scope are checked for changes: the anchors of the other books are taken from the previous run.
+        # The cache stays in memory, so a long-lived Tasks instance (see nebel.api) does not read it again.
+        anchors_cache = self._file_cache('anchors', version=3)
+        anchors = nebel.graph.AnchorIndex()
+        if scope is not None:
+            scopebooks, linkedslugs = scope
+        for bookfile in booklist:
+            # The title is resolved with the attributes of the previous book, as it always was
+            booktitle = self._scan_for_title(bookfile)
+            booktitle_slug = self._convert_title_to_slug(booktitle)
+            #print 'Title URL slug: ' + booktitle_slug
+            log.info('Title: %s', booktitle, extra={'file': bookfile})
+            entry = anchors_cache.stale(bookfile)
+            if (entry is not None) and (entry[0] != booktitle_slug):
+                entry = None
+            if (entry is not None) and ((scope is None) or (bookfile in scopebooks) or (booktitle_slug in linkedslugs)):
+                # A book in scope must be up to date
+                if not nebel.cache.unchanged(entry[1]):
+                    entry = None
+            if entry is None:
+                self.context.clear_attributes()
+                bookanchors = nebel.graph.AnchorIndex()
+                visited = set()
+                # The warnings about the book are cached too, and logged again whenever the entry is used
+                with nebel.log.recorded() as warnings:
+                    self._parse_file_for_anchorids(bookanchors, None, booktitle_slug, bookfile, visited=visited)
+                attributes = self._copy_attributes(self.context.attributeDict)
+                stamps = dict((filepath, anchors_cache.stamp(filepath)) for filepath in visited)
+                entry = (booktitle_slug, stamps, bookanchors, attributes, warnings)
+                anchors_cache.put(bookfile, entry)
+            else:
+                log.debug('Using the cached anchors of book: %s', bookfile, extra={'file': bookfile})
+                self.context.attributeDict = self._copy_attributes(entry[3])
+                nebel.log.replay(entry[4])
+            for anchorid in anchors.extend(entry[2]):
+                log.warning('Anchor ID: ' + anchorid + ' appears more than once in book: ' + booktitle_slug)
+        anchors_cache.save()
+        return anchors
+
+    def _copy_attributes(self, attributes):
+        # Copy of an attribute dictionary, whose values are [value, resolved_value] lists
+        return dict((name, list(duple)) for name, duple in attributes.items())
+
+    def _rewrite_links(self, line, fixfile):
+        # Cheap substring test first: most lines contain no links at all
+        if ('<<' not in line) and ('xref:' not in line) and ('link:' not in line) and ('{link-prefix}:' not in line):
+            return line
+        return self.regexp_links.sub(lambda match_obj: self._on_match_link(match_obj, fixfile), line)
+
+    def _on_match_link(self, match_obj, fixfile):
+        if match_obj.group('linkid') is None:
+            # Either <<anchorid,text>> or xref:anchorid[text] - both are rewritten as xref:
+            if match_obj.group('angleid') is not None:
+                anchorid = match_obj.group('angleid')
+                optionaltext = match_obj.group('angletext')
+            else:
+                anchorid = match_obj.group('xrefid')
+                optionaltext = match_obj.group('xreftext')
+            new_anchorid = self._repair_anchorid(anchorid, fixfile)
             return 'xref:' + new_anchorid + '[' + optionaltext + ']'
         else:
-            return 'xref:' + new_anchorid + '[]'
-
-    def _regexp_replace_link(self, value):
-        # Check for {link-prefix}:, which is used in Debezium docs instead of link:
-        regexp = re.compile(r'(?:link|\{link\-prefix\}):(\{[\w\-]+\})#([^\[]+)\[([^\]]*)\]')
-        new_value = regexp.sub(self._on_match_link, value)
-        return new_value
-
-    def _on_match_link(self, match_obj):
-        bookattribute = match_obj.group(1)
-        anchorid = match_obj.group(2)
-        optionaltext = match_obj.group(3)
-        new_anchorid = self._repair_anchorid(anchorid, self._on_match_fixfile)
-        if optionaltext:
+            bookattribute = match_obj.group('bookattr')
+            anchorid = match_obj.group('linkid')
+            optionaltext = match_obj.group('linktext')
+            new_anchorid = self._repair_anchorid(anchorid, fixfile)
             return 'link:' + bookattribute + '#' + new_anchorid + '[' + optionaltext + ']'
-        else:
-            return 'link:' + bookattribute + '#' + new_anchorid + '[]'
 
     def _repair_anchorid(self, anchorid, fixfile):
         if anchorid.endswith('_{context}'):
             plainanchorid = anchorid.replace('_{context}','')
         else:
             plainanchorid = anchorid
-        if plainanchorid in self.anchorid_dict:
+        if plainanchorid in self.anchors:
             target_anchorid = plainanchorid
-        elif plainanchorid in self.legacyid_dict:
-            target_anchorid = self.legacyid_dict[plainanchorid]
-        elif plainanchorid in self.rootofid_dict:
-            target_anchorid = self.choose_anchorid_from_rootofid_dict(plainanchorid)
+        elif self.anchors.legacy_target(plainanchorid) is not None:
+            target_anchorid = self.anchors.legacy_target(plainanchorid)
+        elif self.anchors.has_root(plainanchorid):
+            target_anchorid = self.choose_anchorid_from_rootofid_dict(plainanchorid, fixfile)
             if target_anchorid is None:
                 # Leave the ID unchanged
                 target_anchorid = anchorid
         elif '_' in plainanchorid:
                 # Last attempt to fix - ID might have wrong context value after the '_' char
                 rootofid, contextval = plainanchorid.rsplit('_', 1)
-                if rootofid in self.rootofid_dict:
-                    target_anchorid = self.choose_anchorid_from_rootofid_dict(rootofid)
+                if self.anchors.has_root(rootofid):
+                    target_anchorid = self.choose_anchorid_from_rootofid_dict(rootofid, fixfile)
                     if target_anchorid is None:
                         # Leave the ID unchanged
                         target_anchorid = anchorid
                 else:
                     target_anchorid = anchorid
         else:
-            print('WARNING: link to unknown ID: ' + anchorid)
+            log.warning('link to unknown ID: ' + anchorid)
             target_anchorid = anchorid
 
         # Special case: if the file containing the xref and the file containing the target ID have the *same* parent assembly,
         #   then the ID in the xref *should* use _{context} (this facilitates content sharing between products)
         if '_' in target_anchorid:
             rootofid, contextval = target_anchorid.rsplit('_', 1)
-            use_context_suffix = False
-            for parent in self.parentassemblies[fixfile]:
-                if target_anchorid in self.anchorid_dict:
-                    for booktitle_slug in self.anchorid_dict[target_anchorid]:
-                        targetfile = self.anchorid_dict[target_anchorid][booktitle_slug]['FilePath']
-                        if (targetfile.startswith(self.context.MODULES_DIR)) and (parent in self.parentassemblies[targetfile]):
-                            use_context_suffix = True
-            if use_context_suffix:
+            if self._use_context_suffix(fixfile, target_anchorid):
                 target_anchorid = rootofid + '_{context}'
         return target_anchorid
 
-    def choose_anchorid_from_rootofid_dict(self, anchorid):
-        idlist = self.rootofid_dict[anchorid]
+    def _use_context_suffix(self, fixfile, target_anchorid):
+        # Memoized per (fixfile, target ID), because the same link typically recurs many times in a file
+        key = (fixfile, target_anchorid)
+        if key not in self._context_suffix_memo:
+            fixparents = self._parent_set(fixfile)
+            if fixparents:
+                self._context_suffix_memo[key] = not fixparents.isdisjoint(self._parents_of_target(target_anchorid))
+            else:
+                self._context_suffix_memo[key] = False
+        return self._context_suffix_memo[key]
+
+    def _parent_set(self, filepath):
+        # Node numbers of the assemblies that include 'filepath'
+        if filepath not in self._parent_sets:
+            self._parent_sets[filepath] = frozenset(self.parentassemblies.parent_nodes(filepath))
+        return self._parent_sets[filepath]
+
+    def _parents_of_target(self, target_anchorid):
+        # Union of the parent assemblies of every module file that defines the target ID (in any book)
+        if target_anchorid not in self._target_parents:
+            parents = set()
+            for targetfile in self.anchors.files_of(target_anchorid):
+                if targetfile.startswith(self.context.MODULES_DIR):
+                    parents |= self._parent_set(targetfile)
+            self._target_parents[target_anchorid] = frozenset(parents)
+        return self._target_parents[target_anchorid]
+
+    def choose_anchorid_from_rootofid_dict(self, anchorid, fixfile=None):
+        idlist = self.anchors.ids_of_root(anchorid)
         if len(idlist) == 1:
             return idlist[0]
         else:
+            candidatefiles = {}
+            candidatebooks = {}
+            for targetid in idlist:
+                candidatefiles[targetid] = self.anchors.files_of(targetid)
+                candidatebooks[targetid] = self.anchors.books_of(targetid)
+            resolved, choice = self._choose_without_prompt(
+                'anchors', fixfile, anchorid, idlist,
+                candidatefiles=candidatefiles,
+                candidatebooks=candidatebooks,
+                filebooks=self._books_of_file(fixfile)
+            )
+            if resolved:
+                return choice
+            nebel.log.flush()
             print('\tChoose the correct target ID for the link or S to skip:')
             for k, targetid in enumerate(idlist):
                 print('\t' + str(k) + ') ' + targetid)
@@ -1113,21 +1443,29 @@ class Tasks:
                     response = ''
             return None
 
-    def _scan_for_title(self, filepath):
+    def _books_of_file(self, filepath):
+        if filepath is None:
+            return set()
+        return self.anchors.books_of_file(os.path.relpath(os.path.realpath(filepath)))
+
+    def _scan_for_title(self, filepath, required=True):
         if not os.path.exists(filepath):
-            print('ERROR: _scan_for_title: No such file: ' + filepath)
+            log.error('_scan_for_title: No such file: ' + filepath)
             sys.exit()
         rawtitle = ''
         regexp = re.compile(r'^=\s+(\S.*)')
-        with open(filepath, 'r') as f:
-            for line in f:
-                result = regexp.search(line)
-                if result is not None:
-                    rawtitle = result.group(1)
-                    break
-            if rawtitle == '':
-                print('ERROR: _scan_for_title: No title found in file: ' + filepath)
-                sys.exit()
+        for lineno, line in nebel.scan.interesting_lines(filepath, self.prefilter_title):
+            if line is None:
+                continue
+            result = regexp.search(line)
+            if result is not None:
+                rawtitle = result.group(1)
+                break
+        if rawtitle == '':
+            if not required:
+                return None
+            log.error('_scan_for_title: No title found in file: ' + filepath)
+            sys.exit()
         return self.context.resolve_raw_attribute_value(rawtitle)
 
 
@@ -1135,7 +1473,12 @@ class Tasks:
         return title.strip().lower().replace(' ', '_').replace('-', '_')
 
 
-    def _parse_file_for_anchorids(self, anchorid_dict, legacyid_dict, rootofid_dict, metadata_list, booktitle_slug, filepath):
+    def _parse_file_for_anchorids(self, anchors, metadata_list, booktitle_slug, filepath, issues=None, visited=None, baselevel=0):
+        # Adds the anchor IDs defined in the file (and the files it includes) to the AnchorIndex 'anchors'
+        # and, unless 'metadata_list' is None, a MetadataRecord for each heading with an ID to 'metadata_list'.
+        # If an 'issues' list is provided, problems are collected in the list instead of aborting,
+        # and if a 'visited' set is provided, it collects the path of every file parsed.
+        # The 'baselevel' is the accumulated leveloffset of the includes that led to this file.
         # Define action enums
         NO_ACTION = 0
         ORDINARY_LINE = 1
@@ -1156,194 +1499,272 @@ class Tasks:
         regexp_blank = re.compile(r'^\s*$')
 
         if not os.path.exists(filepath):
-            print('ERROR: _parse_file_for_anchorids: File does not exist: ' + filepath)
+            log.error('_parse_file_for_anchorids: File does not exist: ' + filepath)
             sys.exit()
-        with open(filepath, 'r') as filehandle:
-            tentative_metadata = {}
-            tentative_anchor_id = ''
-            for line in filehandle:
-                action = NO_ACTION
-                # Parse the current line
-                while action == NO_ACTION:
-                    result = regexp_metadata.search(line)
-                    if result is not None:
-                        property = result.group(1)
-                        value = result.group(2)
-                        action = METADATA_LINE
-                        continue
-                    result = regexp_id_line1.search(line)
-                    if result is not None:
-                        rawanchorid = result.group(1)
-                        action = ID_LINE
-                        continue
-                    result = regexp_id_line2.search(line)
-                    if result is not None:
-                        rawanchorid = result.group(1).strip()
-                        action = ID_LINE
-                        continue
-                    result = regexp_title.search(line)
-                    if result is not None:
-                        rawtitle = result.group(2)
-                        title = self.context.resolve_raw_attribute_value(rawtitle)
-                        action = TITLE_LINE
-                        continue
-                    result = regexp_attribute.search(line)
-                    if result is not None:
-                        name = result.group(1)
-                        value = result.group(2).strip()
-                        self.context.update_attribute(name, value)
-                        action = ATTRIBUTE_LINE
-                        continue
-                    result = regexp_include.search(line)
-                    if result is not None:
-                        rawincludefile = result.group(1)
-                        includefile = self.context.resolve_raw_attribute_value(rawincludefile)
-                        action = INCLUDE_LINE
-                        continue
-                    result = regexp_blank.search(line)
-                    if result is not None:
-                        action = BLANK_LINE
-                        continue
-                    # Default action is ordinary line
+        # Interned, so that the records of all the anchors and headings in the file share one copy of the path
+        relfilepath = anchors.path(os.path.relpath(os.path.realpath(filepath)))
+        if visited is not None:
+            visited.add(relfilepath)
+        tentative_metadata = {}
+        tentative_anchor_id = ''
+        tentative_lineno = 0
+        # Only the lines that can match one of the regular expressions are read, and each run of
+        # other lines that is not blank is passed as a single ordinary line (None)
+        for lineno, line in nebel.scan.interesting_lines(filepath, self.prefilter_anchorids):
+            action = NO_ACTION
+            # Parse the current line
+            while action == NO_ACTION:
+                if line is None:
                     action = ORDINARY_LINE
-                # Take action
-                if action == BLANK_LINE or action == ATTRIBUTE_LINE:
-                    # It's a noop
-                    pass
-                elif (action == ORDINARY_LINE) and tentative_anchor_id:
-                    # Define an anchor ID that is not associated with a heading
-                    if tentative_anchor_id not in anchorid_dict:
-                        # Initialize the sub-dictionary
-                        anchorid_dict[tentative_anchor_id] = {}
-                    if booktitle_slug in anchorid_dict[tentative_anchor_id]:
-                        print('WARNING: Anchor ID: ' + tentative_anchor_id + 'appears more than once in book: ' + booktitle_slug)
+                    continue
+                result = regexp_metadata.search(line)
+                if result is not None:
+                    property = result.group(1)
+                    value = result.group(2)
+                    action = METADATA_LINE
+                    continue
+                result = regexp_id_line1.search(line)
+                if result is not None:
+                    rawanchorid = result.group(1)
+                    action = ID_LINE
+                    continue
+                result = regexp_id_line2.search(line)
+                if result is not None:
+                    rawanchorid = result.group(1).strip()
+                    action = ID_LINE
+                    continue
+                result = regexp_title.search(line)
+                if result is not None:
+                    equalssigncount = len(result.group(1))
+                    rawtitle = result.group(2)
+                    title = self.context.resolve_raw_attribute_value(rawtitle)
+                    action = TITLE_LINE
+                    continue
+                result = regexp_attribute.search(line)
+                if result is not None:
+                    name = result.group(1)
+                    value = result.group(2).strip()
+                    self.context.update_attribute(name, value)
+                    action = ATTRIBUTE_LINE
+                    continue
+                result = regexp_include.search(line)
+                if result is not None:
+                    rawincludefile = result.group(1)
+                    includefile = self.context.resolve_raw_attribute_value(rawincludefile)
+                    includeoptions = result.group(2)
+                    action = INCLUDE_LINE
+                    continue
+                result = regexp_blank.search(line)
+                if result is not None:
+                    action = BLANK_LINE
+                    continue
+                # Default action is ordinary line
+                action = ORDINARY_LINE
+            # Take action
+            if action == BLANK_LINE or action == ATTRIBUTE_LINE:
+                # It's a noop
+                pass
+            elif (action == ORDINARY_LINE) and tentative_anchor_id:
+                # Define an anchor ID that is not associated with a heading
+                if not anchors.add(tentative_anchor_id, booktitle_slug, relfilepath):
+                    message = 'Anchor ID: ' + tentative_anchor_id + ' appears more than once in book: ' + booktitle_slug
+                    if issues is not None:
+                        issues.append(self._issue('duplicate-id', filepath, tentative_lineno, message))
                     else:
-                        anchorid_dict[tentative_anchor_id][booktitle_slug] = { 'FilePath': os.path.relpath(os.path.realpath(filepath)) }
-                    tentative_anchor_id = ''
-                    tentative_root_of_id = ''
-                    tentative_context_of_id = None
-                    tentative_metadata = {}
-                elif action == ORDINARY_LINE:
-                    # After hitting an ordinary line, preceding metadata is no longer current
-                    tentative_metadata = {}
-                elif action == METADATA_LINE:
-                    if property in self.context.optionalMetadataFields:
-                        tentative_metadata[property] = value
-                elif action == ID_LINE:
-                    if rawanchorid.endswith('}'):
-                        currentcontext = self.context.lookup_attribute('context')
-                        if currentcontext is not None:
-                            anchorid = rawanchorid.replace('{context}', currentcontext)
-                            rootofid = rawanchorid.replace('_{context}', '')
-                        else:
-                            print('ERROR: Found ID with embedded {context}, but no context attribute defined')
-                            print('    file: ' + filepath)
-                            print('    ID:   ' + rawanchorid)
-                            sys.exit()
+                        log.warning(message)
+                tentative_anchor_id = ''
+                tentative_root_of_id = ''
+                tentative_context_of_id = None
+                tentative_metadata = {}
+            elif action == ORDINARY_LINE:
+                # After hitting an ordinary line, preceding metadata is no longer current
+                tentative_metadata = {}
+            elif action == METADATA_LINE:
+                if property in self.context.optionalMetadataFields:
+                    tentative_metadata[property] = value
+            elif action == ID_LINE:
+                if rawanchorid.endswith('}'):
+                    currentcontext = self.context.lookup_attribute('context')
+                    if currentcontext is not None:
+                        anchorid = rawanchorid.replace('{context}', currentcontext)
+                        rootofid = rawanchorid.replace('_{context}', '')
+                    elif issues is not None:
+                        issues.append(self._issue('context-misuse', filepath, lineno, 'Found ID ' + rawanchorid + ' with embedded {context}, but no context attribute defined'))
+                        continue
                     else:
-                        anchorid = rawanchorid
-                        rootofid = rawanchorid
-                        currentcontext = None
-                    tentative_anchor_id = anchorid
-                    tentative_root_of_id = rootofid
-                    tentative_context_of_id = currentcontext
-                elif (action == TITLE_LINE) and tentative_anchor_id:
-                    # Define an anchor ID that is associated with a heading
-                    if tentative_anchor_id not in anchorid_dict:
-                        # Initialize the sub-dictionary
-                        anchorid_dict[tentative_anchor_id] = {}
-                    if booktitle_slug in anchorid_dict[tentative_anchor_id]:
-                        print('WARNING: Anchor ID: ' + tentative_anchor_id + 'appears more than once in book: ' + booktitle_slug)
+                        log.error('Found ID with embedded {context}, but no context attribute defined\n    file: ' + filepath + '\n    ID:   ' + rawanchorid)
+                        sys.exit()
+                else:
+                    anchorid = rawanchorid
+                    rootofid = rawanchorid
+                    currentcontext = None
+                tentative_lineno = lineno
+                tentative_anchor_id = anchorid
+                tentative_root_of_id = rootofid
+                tentative_context_of_id = currentcontext
+            elif (action == TITLE_LINE) and tentative_anchor_id:
+                # Define an anchor ID that is associated with a heading
+                if not anchors.add(tentative_anchor_id, booktitle_slug, relfilepath, title, tentative_context_of_id):
+                    message = 'Anchor ID: ' + tentative_anchor_id + ' appears more than once in book: ' + booktitle_slug
+                    if issues is not None:
+                        issues.append(self._issue('duplicate-id', filepath, tentative_lineno, message))
                     else:
-                        anchorid_dict[tentative_anchor_id][booktitle_slug] = { 'FilePath': os.path.relpath(os.path.realpath(filepath)), 'Title': title, 'Context': tentative_context_of_id }
-                        if 'ConvertedFromID' in tentative_metadata:
-                            anchorid_dict[tentative_anchor_id][booktitle_slug]['ConvertedFromID'] = tentative_metadata['ConvertedFromID']
-                            legacyid_dict[tentative_metadata['ConvertedFromID']] = tentative_anchor_id
-                        if tentative_root_of_id != tentative_anchor_id:
-                            if tentative_root_of_id not in rootofid_dict:
-                                # Initialize list of anchor IDs in this slot
-                                rootofid_dict[tentative_root_of_id] = [ tentative_anchor_id ]
-                            else:
-                                rootofid_dict[tentative_root_of_id].append(tentative_anchor_id)
+                        log.warning(message)
+                else:
+                    if 'ConvertedFromID' in tentative_metadata:
+                        anchors.add_legacy_id(tentative_metadata['ConvertedFromID'], tentative_anchor_id)
+                    if tentative_root_of_id != tentative_anchor_id:
+                        anchors.add_to_root(tentative_root_of_id, tentative_anchor_id)
+                if metadata_list is not None:
                     head, tail = os.path.split(filepath)
                     type = self.type_of_file(tail)
                     if type == 'module': type = None
-                    tentative_metadata['Type'] = type
-                    tentative_metadata['Title'] = title
-                    tentative_metadata['ModuleID'] = tentative_anchor_id
-                    tentative_metadata['Context'] = tentative_context_of_id
-                    tentative_metadata['FilePath'] = os.path.relpath(os.path.realpath(filepath))
-                    file_pieces = tentative_metadata['FilePath'].split(os.sep)
+                    metadata = nebel.graph.MetadataRecord(tentative_metadata)
+                    metadata['Type'] = type
+                    metadata['Title'] = title
+                    metadata['ModuleID'] = tentative_anchor_id
+                    metadata['Context'] = tentative_context_of_id
+                    # Section level of the heading in the book, after applying leveloffsets (the title is level 0),
+                    # unless the author gave the heading a Level metadata comment, which is kept
+                    level = str(equalssigncount - 1 + baselevel)
+                    if 'Level' not in tentative_metadata:
+                        metadata['Level'] = level
+                    elif tentative_metadata['Level'] != level:
+                        log.warning('Level ' + tentative_metadata['Level'] + ' of ' + tentative_anchor_id + ' differs from its level in the book: ' + level, extra={'file': relfilepath})
+                    metadata['FilePath'] = relfilepath
+                    file_pieces = relfilepath.split(os.sep)
                     if (file_pieces[0] == self.context.ASSEMBLIES_DIR) or (file_pieces[0] == self.context.MODULES_DIR):
-                        tentative_metadata['Category'] = os.sep.join(file_pieces[1:-1])
-                    metadata_list.append(tentative_metadata)
-                    # Clear dictionaries and lists
-                    tentative_anchor_id = ''
-                    tentative_root_of_id = ''
-                    tentative_context_of_id = None
-                    tentative_metadata = {}
-                elif (action == TITLE_LINE) and not tentative_anchor_id:
-                    tentative_anchor_id = ''
-                    tentative_root_of_id = ''
-                    tentative_context_of_id = None
-                    tentative_metadata = {}
-                elif action == INCLUDE_LINE:
-                    currentdir, basename = os.path.split(filepath)
-                    includefile = os.path.normpath(os.path.join(currentdir, includefile))
-                    if not os.path.exists(includefile):
-                        print('ERROR: Included file does not exist: ' + includefile)
+                        metadata['Category'] = os.sep.join(file_pieces[1:-1])
+                    metadata_list.append(metadata)
+                # Clear dictionaries and lists
+                tentative_anchor_id = ''
+                tentative_root_of_id = ''
+                tentative_context_of_id = None
+                tentative_metadata = {}
+            elif (action == TITLE_LINE) and not tentative_anchor_id:
+                tentative_anchor_id = ''
+                tentative_root_of_id = ''
+                tentative_context_of_id = None
+                tentative_metadata = {}
+            elif action == INCLUDE_LINE:
+                currentdir, basename = os.path.split(filepath)
+                includefile = os.path.normpath(os.path.join(currentdir, includefile))
+                if not os.path.exists(includefile):
+                    if issues is None:
+                        log.error('Included file does not exist: ' + includefile)
                         sys.exit()
-                    anchorid_dict, legacyid_dict, rootofid_dict, metadata_list = self._parse_file_for_anchorids(anchorid_dict, legacyid_dict, rootofid_dict, metadata_list, booktitle_slug, includefile)
-                    tentative_anchor_id = ''
-                    tentative_root_of_id = ''
-                    tentative_context_of_id = None
-                    tentative_metadata = {}
-        return anchorid_dict, legacyid_dict, rootofid_dict, metadata_list
-
-    def _update_generate_ids(self, fixfileset, customprefix=None):
-        # Define regular expressions
-        regexp_id_line1 = re.compile(r'^\s*\[\[\s*(\S+)\s*\]\]\s*$')
-        regexp_id_line2 = re.compile(r'^\s*\[id\s*=\s*[\'"]\s*(\S+)\s*[\'"]\]\s*$')
-        regexp_title = re.compile(r'^(=+)\s+(\S.*)')
-
-        for fixfile in fixfileset:
-            print('Adding missing IDs to file: ' + fixfile)
+                    issues.append(self._issue('missing-include', filepath, lineno, 'Included file does not exist: ' + includefile))
+                else:
+                    childbaselevel = self._child_baselevel(self._parse_include_opts(includeoptions), baselevel)
+                    self._parse_file_for_anchorids(anchors, metadata_list, booktitle_slug, includefile, issues, visited, childbaselevel)
+                tentative_anchor_id = ''
+                tentative_root_of_id = ''
+                tentative_context_of_id = None
+                tentative_metadata = {}
+
+    def _update_generate_ids(self, fixfileset, customprefix=None, jobs=1):
+        # Pre-scan the files in parallel, so that files whose headings all have IDs are not rewritten
+        fixfilelist = sorted(fixfileset)
+        scans = nebel.parallel.map_tasks(self, '_scan_for_headings_without_ids', [(fixfile,) for fixfile in fixfilelist], jobs, chunksize=16)
+        headingsbyfile = [(fixfile, headings) for fixfile, headings in zip(fixfilelist, scans) if headings]
+        if not headingsbyfile:
+            log.info('No missing IDs found in ' + str(len(fixfilelist)) + ' file(s)')
+            return
+        # New IDs must not collide with any ID already defined in the repository
+        usedids = self._scan_repository_for_ids(fixfilelist, jobs)
+        writeargs = []
+        for fixfile, headings in headingsbyfile:
+            log.info('Adding missing IDs to file: %s', fixfile, extra={'file': fixfile})
             dirname, basename = os.path.split(os.path.normpath(fixfile))
             if customprefix is None:
                 idprefix = dirname.replace(os.sep, '-').replace('_', '-') + '-' + self.moduleid_of_file(basename)
             else:
                 idprefix = customprefix
-            # Create temp file
-            fh, abs_path = tempfile.mkstemp()
-            with os.fdopen(fh, 'w') as new_file:
-                with open(fixfile) as old_file:
-                    prevline = ''
-                    newidlist = []
-                    disambig_suffix = 1
-                    for line in old_file:
-                        if (regexp_title.search(line) is not None)\
-                                and (regexp_id_line1.search(prevline) is None)\
-                                and (regexp_id_line2.search(prevline) is None):
-                            # Parse title line
-                            result = regexp_title.search(line)
-                            title = result.group(2)
-                            # Insert module ID
-                            newid = idprefix + '-' + self.title_to_id(title)
-                            if newid in newidlist:
-                                newid = newid + '-' + '{0:0>3}'.format(disambig_suffix)
-                                disambig_suffix += 1
-                            newidlist.append(newid)
-                            new_file.write('[id="' + newid + '"]\n')
-                        new_file.write(line)
-                        prevline = line
-            # Remove original file
-            os.remove(fixfile)
-            # Move new file
-            shutil.move(abs_path, fixfile)
+            newids = {}
+            disambig_suffix = 1
+            for lineno, title in headings:
+                # Insert module ID
+                newid = idprefix + '-' + self.title_to_id(title)
+                candidateid = newid
+                while candidateid in usedids:
+                    candidateid = newid + '-' + '{0:0>3}'.format(disambig_suffix)
+                    disambig_suffix += 1
+                usedids.add(candidateid)
+                newids[lineno] = candidateid
+            writeargs.append((fixfile, newids))
+        for result in nebel.parallel.map_tasks(self, '_insert_ids', writeargs, jobs, chunksize=16):
+            pass
+
+    def _scan_for_headings_without_ids(self, fixfile):
+        # Returns the list of (lineno, title) for the headings in 'fixfile' that are not preceded by an ID line
+        regexp_id_line1 = re.compile(r'^\s*\[\[\s*(\S+)\s*\]\]\s*$')
+        regexp_id_line2 = re.compile(r'^\s*\[id\s*=\s*[\'"]\s*(\S+)\s*[\'"]\]\s*$')
+        regexp_title = re.compile(r'^(=+)\s+(\S.*)')
+        headings = []
+        prevlineno = 0
+        prevline = ''
+        for lineno, line in nebel.scan.interesting_lines(fixfile, self.prefilter_title_or_anchor):
+            if line is None:
+                continue
+            if lineno != prevlineno + 1:
+                prevline = ''
+            result = regexp_title.search(line)
+            if (result is not None)\
+                    and (regexp_id_line1.search(prevline) is None)\
+                    and (regexp_id_line2.search(prevline) is None):
+                headings.append((lineno, result.group(2)))
+            prevlineno = lineno
+            prevline = line
+        return headings
+
+    def _scan_repository_for_ids(self, extrafiles=None, jobs=1):
+        # Returns the set of IDs defined in the book, assembly, and module files, including
+        # the form of each ID without its _{context} suffix
+        filelist = set(self._scan_for_bookfiles())
+        for rootdir in [self.context.ASSEMBLIES_DIR, self.context.MODULES_DIR]:
+            for root, dirs, files in os.walk(rootdir):
+                for file in files:
+                    if file.endswith('.adoc'):
+                        filelist.add(os.path.join(root, file))
+        if extrafiles is not None:
+            filelist |= set(extrafiles)
+        filelist = sorted(filelist)
+        idset = set()
+        for ids in nebel.parallel.map_tasks(self, '_scan_file_for_ids', [(filepath,) for filepath in filelist], jobs, chunksize=16):
+            for rawid in ids:
+                idset.add(rawid)
+                idset.add(rawid.replace('_{context}', ''))
+        return idset
+
+    def _scan_file_for_ids(self, filepath):
+        regexp_id_line1 = re.compile(r'\[\[\s*([^\s,\]]+)')
+        regexp_id_line2 = re.compile(r'\[id\s*=\s*[\'"]\s*([^\s\'"]+)\s*[\'"]')
+        ids = []
+        for lineno, line in nebel.scan.interesting_lines(filepath, self.prefilter_anchor):
+            if line is None:
+                continue
+            ids.extend(regexp_id_line1.findall(line))
+            ids.extend(regexp_id_line2.findall(line))
+        return ids
+
+    def _insert_ids(self, fixfile, newids):
+        # Inserts an ID line before each line number in 'newids'
+        # Create temp file
+        fh, abs_path = tempfile.mkstemp()
+        with os.fdopen(fh, 'w') as new_file:
+            with open(fixfile) as old_file:
+                for lineno, line in enumerate(old_file, 1):
+                    if lineno in newids:
+                        new_file.write('[id="' + newids[lineno] + '"]\n')
+                    new_file.write(line)
+        # Remove original file
+        os.remove(fixfile)
+        # Move new file
+        shutil.move(abs_path, fixfile)
 
 
     def update_metadata(self, file, metadata):
-        print('Updating metadata for file: ' + file)
+        log.info('Updating metadata for file: %s', file, extra={'file': file})
         regexp = re.compile(r'^\s*//\s*(\w+)\s*:.*')
         # Scan file for pre-existing metadata settings
         preexisting = set()
@@ -1403,6 +1824,11 @@ class Tasks:
         if args.attribute_files:
             attrfilelist = args.attribute_files.strip().split(',')
             self.context.parse_attribute_files(attrfilelist)
+        else:
+            attrfilelist = None
+        if args.images:
+            self._orphan_image_search(filtercategoryset, attrfilelist)
+            return
         booklist = self._scan_for_bookfiles()
         # Find the set of all included files
         allincludedfileset = set()
@@ -1415,33 +1841,143 @@ class Tasks:
             categoryset &= filtercategoryset
         assemblyfiles = self.scan_for_categorised_files(self.context.ASSEMBLIES_DIR, categoryset, filefilter='assembly')
         modulefiles = self.scan_for_categorised_files(self.context.MODULES_DIR, categoryset, filefilter='module')
-        #imagefiles = self.scan_for_categorised_files(self.context.IMAGES_DIR, categoryset)
         orphanassemblyfiles = set(assemblyfiles) - allincludedfileset
         orphanmodulefiles   = set(modulefiles) - allincludedfileset
         # Report
-        for orphanassemblyfile in orphanassemblyfiles:
-            print(orphanassemblyfile)
-        for orphanmodulefile in orphanmodulefiles:
-            print(orphanmodulefile)
+        nebel.log.flush()
+        sys.stdout.writelines(orphanfile + '\n' for orphanfile in orphanassemblyfiles)
+        sys.stdout.writelines(orphanfile + '\n' for orphanfile in orphanmodulefiles)
+
+    def _orphan_image_search(self, filtercategoryset, attrfilelist):
+        # Reports the image files that no book references, and warns about references to missing images.
+        # Image files are only listed, never read.
+        images = nebel.graph.ImageIndex()
+        self._build_include_graph(attrfilelist, images)
+        for imagepath in images.images():
+            if not os.path.exists(imagepath):
+                for filepath, lineno in images.references(imagepath):
+                    log.warning('Image not found: ' + imagepath + ' (referenced in ' + filepath + ':' + str(lineno) + ')', extra={'file': filepath, 'line': lineno})
+        categoryset = self.scan_for_categories(self.context.IMAGES_DIR)
+        if filtercategoryset is not None:
+            categoryset &= filtercategoryset
+        imagefiles = sorted(self.scan_for_categorised_files(self.context.IMAGES_DIR, categoryset))
+        orphanimagefiles = [imagefile for imagefile in imagefiles if not images.is_referenced(os.path.relpath(os.path.realpath(imagefile)))]
+        nebel.log.flush()
+        sys.stdout.writelines(orphanfile + '\n' for orphanfile in orphanimagefiles)
+
+
+    def validate(self, args):
+        if args.attribute_files:
+            attrfilelist = args.attribute_files.strip().split(',')
+        else:
+            attrfilelist = None
+        jobs = nebel.parallel.jobs_count(args.jobs)
+        if args.BOOK_FILE:
+            booklist = args.BOOK_FILE
+            for bookfile in booklist:
+                if not os.path.exists(bookfile):
+                    log.error('File does not exist: ' + bookfile)
+                    sys.exit(2)
+        else:
+            booklist = sorted(self._scan_for_bookfiles())
+        # Phase 1: Harvest anchor tables and include graph for each book (in parallel)
+        anchors = nebel.graph.AnchorIndex()
+        issues = []
+        visited = set()
+        harvests = nebel.parallel.map_tasks(self, '_harvest_book_for_validation', [(bookfile, attrfilelist) for bookfile in booklist], jobs)
+        for booktitle_slug, book_anchors, book_issues, book_visited in harvests:
+            anchors.merge(book_anchors)
+            issues.extend(book_issues)
+            visited.update(book_visited)
+        # Phase 2: Check every link in every included file against the anchor tables (in parallel)
+        filelist = sorted(visited)
+        linkscans = nebel.parallel.map_tasks(self, '_scan_file_for_links', [(filepath,) for filepath in filelist], jobs, chunksize=32)
+        for filepath, links in zip(filelist, linkscans):
+            for lineno, anchorid in links:
+                issue = self._check_link(filepath, lineno, anchorid, anchors)
+                if issue is not None:
+                    issues.append(issue)
+        # Report
+        issues.sort(key=lambda issue: (issue['file'], issue['line'], issue['type']))
+        nebel.log.flush()
+        if args.format == 'json':
+            json.dump({'books': len(booklist), 'files': len(filelist), 'issues': issues}, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        else:
+            for issue in issues:
+                sys.stdout.write(issue['file'] + ':' + str(issue['line']) + ': ' + issue['type'] + ': ' + issue['message'] + '\n')
+            sys.stdout.write(str(len(issues)) + ' problem(s) found in ' + str(len(booklist)) + ' book(s), ' + str(len(filelist)) + ' file(s)\n')
+        if issues:
+            sys.exit(1)
 
+    def _issue(self, type, filepath, lineno, message):
+        return {'type': type, 'file': os.path.relpath(os.path.realpath(filepath)), 'line': lineno, 'message': message}
+
+    def _harvest_book_for_validation(self, bookfile, attrfilelist=None):
+        # Read-only counterpart of the anchor harvesting in _update_fix_links(): never exits or prompts
+        self.context.clear_attributes()
+        if attrfilelist is not None:
+            self.context.parse_attribute_files(attrfilelist)
+        issues = []
+        visited = set()
+        booktitle = self._scan_for_title(bookfile, required=False)
+        if booktitle is None:
+            issues.append(self._issue('missing-title', bookfile, 0, 'No title found in book file'))
+            booktitle = os.path.dirname(os.path.normpath(bookfile))
+        booktitle_slug = self._convert_title_to_slug(booktitle)
+        anchors = nebel.graph.AnchorIndex()
+        self._parse_file_for_anchorids(anchors, None, booktitle_slug, bookfile, issues, visited)
+        return booktitle_slug, anchors, issues, visited
+
+    def _scan_file_for_links(self, filepath):
+        # Returns a list of (lineno, anchorid) pairs for every link in the file
+        links = []
+        with open(filepath, 'r') as f:
+            for lineno, line in enumerate(f, 1):
+                if ('<<' not in line) and ('xref:' not in line) and ('link:' not in line) and ('{link-prefix}:' not in line):
+                    continue
+                for match_obj in self.regexp_links.finditer(line):
+                    anchorid = match_obj.group('angleid') or match_obj.group('xrefid') or match_obj.group('linkid')
+                    links.append((lineno, anchorid.strip()))
+        return links
+
+    def _check_link(self, filepath, lineno, anchorid, anchors):
+        if anchorid.endswith('_{context}'):
+            plainanchorid = anchorid.replace('_{context}', '')
+            if not anchors.has_root(plainanchorid):
+                if plainanchorid in anchors:
+                    return self._issue('context-misuse', filepath, lineno, 'Link to ' + anchorid + ', but the target ID is not defined with _{context}')
+                return self._issue('unknown-id', filepath, lineno, 'Link to unknown ID: ' + anchorid)
+            return None
+        if '{' in anchorid:
+            # Cannot check IDs that depend on other attributes
+            return None
+        if anchorid in anchors:
+            return None
+        if anchors.has_root(anchorid):
+            return self._issue('context-misuse', filepath, lineno, 'Link to ' + anchorid + ', but the target ID is only defined with _{context}')
+        if anchors.legacy_target(anchorid) is not None:
+            return self._issue('legacy-id', filepath, lineno, 'Link to legacy ID: ' + anchorid + ' (now ' + anchors.legacy_target(anchorid) + ')')
+        return self._issue('unknown-id', filepath, lineno, 'Link to unknown ID: ' + anchorid)
 
     def mv(self, args):
         frompattern = os.path.normpath(args.FROM_FILE)
         topattern = os.path.normpath(args.TO_FILE)
+        index = self._trigram_index()
         # Move each file
         if frompattern.find('{}') == -1:
             # No glob patterns => move a single file
-            # Generate a database of parent assemblies
+            # Generate a database of parent assemblies, from the assemblies that contain the file name
             categoryset = self.scan_for_categories(self.context.ASSEMBLIES_DIR)
             assemblyfiles = self.scan_for_categorised_files(self.context.ASSEMBLIES_DIR, categoryset)
             bookfiles = glob.glob('*/master.adoc')
-            parentassemblies, assemblyincludes = self._scan_for_parent_assemblies(assemblyfiles + bookfiles)
-            self._mv_single_file(parentassemblies, fromfile=frompattern, tofile=topattern)
+            includegraph = self._scan_for_parent_assemblies(self._files_containing(index, os.path.basename(frompattern), assemblyfiles + bookfiles))
+            self._mv_single_file(includegraph, fromfile=frompattern, tofile=topattern)
         elif frompattern.count('{}') != 1:
-            print('ERROR: More than one glob pattern {} is not allowed in FROM_FILE')
+            log.error('More than one glob pattern {} is not allowed in FROM_FILE')
             sys.exit()
         elif topattern.count('{}') != 1:
-            print('ERROR: TO_FILE must contain a {} substitution pattern')
+            log.error('TO_FILE must contain a {} substitution pattern')
             sys.exit()
         else:
             fromprefix, fromsuffix = frompattern.split('{}')
@@ -1455,21 +1991,26 @@ class Tasks:
                     fromfilling = fromfile[fromprefixlen : -fromsuffixlen]
                 toprefix, tosuffix = topattern.split('{}')
                 tofile = toprefix + fromfilling + tosuffix
-                # Generate a database of parent assemblies
+                # Generate a database of parent assemblies, from the assemblies that contain the file name
                 categoryset = self.scan_for_categories(self.context.ASSEMBLIES_DIR)
                 assemblyfiles = self.scan_for_categorised_files(self.context.ASSEMBLIES_DIR, categoryset)
                 bookfiles = glob.glob('*/master.adoc')
-                parentassemblies, assemblyincludes = self._scan_for_parent_assemblies(assemblyfiles + bookfiles)
-                self._mv_single_file(parentassemblies, fromfile, tofile)
+                includegraph = self._scan_for_parent_assemblies(self._files_containing(index, os.path.basename(fromfile), assemblyfiles + bookfiles))
+                self._mv_single_file(includegraph, fromfile, tofile)
+                # Later files can be included by the files that were moved or updated
+                for filepath in [fromfile, tofile] + includegraph.parents(fromfile):
+                    if filepath.endswith('.adoc'):
+                        index.update(os.path.normpath(filepath))
+        index.save()
 
 
-    def _mv_single_file(self, parentassemblies, fromfile, tofile):
+    def _mv_single_file(self, includegraph, fromfile, tofile):
         # Perform basic sanity checks
         if not os.path.exists(fromfile):
-            print('WARN: Origin file does not exist (skipping): ' + fromfile)
+            log.warning('Origin file does not exist (skipping): ' + fromfile)
             return
         if os.path.exists(tofile):
-            print('WARN: File already exists at destination (skipping)' + tofile)
+            log.warning('File already exists at destination (skipping)' + tofile)
             return
         # Make sure that the destination directory exists
         destination_dir, basename = os.path.split(tofile)
@@ -1478,9 +2019,8 @@ class Tasks:
         # Move the file
         os.rename(fromfile, tofile)
         # Update the affected 'include' directives in other files
-        if fromfile in parentassemblies:
-            for parentassembly in parentassemblies[fromfile]:
-                self._rename_included_file(parentassembly, fromfile, tofile)
+        for parentassembly in includegraph.parents(fromfile):
+            self._rename_included_file(parentassembly, fromfile, tofile)
 
 
     def _rename_included_file(self, file, fromfile, tofile):
@@ -1519,8 +2059,73 @@ class Tasks:
         if attrfilelist is not None:
             self.context.parse_attribute_files(attrfilelist)
         else:
-            print('WARNING: No attribute files specified')
-
+            log.warning('No attribute files specified')
+        unchanged = 0
+        # The checkpoint records the files already done, for resuming an interrupted run
+        checkpoint = nebel.checkpoint.Checkpoint(self.context, 'add-contexts', ('add-contexts', sorted(fixfileset), sorted(assemblyfiles), attrfilelist, args.hash_contexts))
+        checkpoint.start(args.resume)
+        # Hashes are recorded as they are assigned, so the registry is saved even if the run is interrupted
+        self.context_registry = self._context_registry()
+        try:
+            for fixfile in sorted(fixfileset):
+                if checkpoint.is_done(fixfile):
+                    continue
+                is_assembly = fixfile in assemblyfiles
+                status = None
+                if not is_assembly:
+                    # Most modules can be classified without running the full state machine
+                    status = self._scan_module_for_contexts(fixfile)
+                if status is None:
+                    status, contents = self._add_contexts_to_file(fixfile, is_assembly, args.hash_contexts)
+                if status == 'legacy':
+                    # Leave legacy files unchanged!
+                    log.info('Legacy file detected - no changes made: %s', fixfile, extra={'file': fixfile})
+                elif status == 'unchanged':
+                    log.debug('Contexts already present: %s', fixfile, extra={'file': fixfile})
+                    unchanged += 1
+                else:
+                    log.info('Adding contexts to file: %s', fixfile, extra={'file': fixfile})
+                    self._replace_file_contents(fixfile, contents)
+                checkpoint.done(fixfile)
+        finally:
+            self.context_registry.save()
+            checkpoint.close()
+        checkpoint.finish()
+        if unchanged > 0:
+            log.info('Contexts already present in ' + str(unchanged) + ' file(s)')
+
+    def _scan_module_for_contexts(self, fixfile):
+        # Returns 'legacy' or 'unchanged' if the lines that _add_contexts_to_file would act on show that the
+        # module is a legacy file or already has contexts, and returns None if the module must be processed
+        regexp_id_line1 = re.compile(r'^\s*\[\[\s*(\S+)\s*\]\]\s*$')
+        regexp_id_line2 = re.compile(r'^\s*\[id\s*=\s*[\'"]\s*(\S+)\s*[\'"]\]\s*$')
+        regexp_title = re.compile(r'^(=+)\s+(\S.*)')
+        found_any_id = False
+        for lineno, line in nebel.scan.interesting_lines(fixfile, self.prefilter_contexts):
+            if line is None:
+                continue
+            if line.startswith(':parent-context:') or line.startswith('ifdef::context[:parent-context:') or line.startswith(':context:'):
+                return 'legacy'
+            found_id = ''
+            result = regexp_id_line1.search(line)
+            if result is not None:
+                found_id = result.group(1)
+            result = regexp_id_line2.search(line)
+            if result is not None:
+                found_id = result.group(1)
+            if found_id:
+                if not found_id.endswith('_{context}'):
+                    return None
+                found_any_id = True
+            elif (regexp_title.search(line) is not None) and not found_any_id:
+                # Let the state machine report the missing ID
+                return None
+        return 'unchanged'
+
+    def _add_contexts_to_file(self, fixfile, is_assembly, hash_contexts=False):
+        # Returns (status, contents), where status is 'legacy', 'unchanged', or 'changed', and
+        # contents is the new text of the file, with _{context} added to IDs and (in assemblies)
+        # boilerplate added around include directives
         # Define some enums for state machine
         REGULAR_LINES = 0
         EXPECTING_CONTEXT_SET = 1
@@ -1533,132 +2138,135 @@ class Tasks:
         regexp_id_line2 = re.compile(r'^\s*\[id\s*=\s*[\'"]\s*(\S+)\s*[\'"]\]\s*$')
         regexp_title = re.compile(r'^(=+)\s+(\S.*)')
 
-        for fixfile in fixfileset:
-            print('Adding contexts to file: ' + fixfile)
-            # Initialize Boolean state variables
-            parsing_state = REGULAR_LINES
-            # Initialize loop variables
-            title = ''
-            most_recent_root_id = ''
-            title_id = ''
-            title_id_sha = ''
-            if fixfile in assemblyfiles:
-                is_assembly = True
-            else:
-                is_assembly = False
-            dirname = os.path.dirname(fixfile)
-            # Create temp file
-            fh, abs_path = tempfile.mkstemp()
+        # Initialize Boolean state variables
+        parsing_state = REGULAR_LINES
+        # Initialize loop variables
+        title = ''
+        most_recent_root_id = ''
+        title_id = ''
+        title_id_sha = ''
+        newlines = []
+        with open(fixfile) as old_file:
+            oldlines = old_file.readlines()
+        for line in oldlines:
+            # Ignore blank lines
+            if line.strip() == '':
+                newlines.append(line)
+                continue
+            # Ignore comment lines
+            if line.strip().startswith('//'):
+                newlines.append(line)
+                continue
+            # Detect legacy context files (not added using Nebel)
+            if line.startswith(':parent-context:') or line.startswith('ifdef::context[:parent-context:'):
+                parsing_state = LEGACY_MODE
+                break
+            if parsing_state == REGULAR_LINES:
+                # Process *unexpected* context definition - signals legacy mode!
+                if line.startswith(':context:'):
+                    parsing_state = LEGACY_MODE
+                    break
+                # Process ID line
+                found_id = ''
+                result = regexp_id_line1.search(line)
+                if result is not None:
+                    found_id = result.group(1)
+                result = regexp_id_line2.search(line)
+                if result is not None:
+                    found_id = result.group(1)
+                if found_id:
+                    most_recent_root_id = found_id.replace('_{context}', '')
+                    # Add _{context} to ID
+                    if not found_id.endswith('_{context}'):
+                        line = line.replace(found_id, found_id + '_{context}')
+                    newlines.append(line)
+                    continue
+                # Process title line
+                result = regexp_title.search(line)
+                if result is not None:
+                    equalssigncount = len(result.group(1))
+                    title = self.context.resolve_raw_attribute_value(result.group(2))
+                    if most_recent_root_id != '':
+                        title_id = most_recent_root_id
+                        # Only the hashes written to assemblies are registered (see _context_hash)
+                        title_id_sha = self._generate_hash(title_id)
+                    else:
+                        log.error('Expected ID definition before heading = ' + title)
+                        sys.exit()
+                    newlines.append(line)
+                    continue
+                # Process include:: line
+                if is_assembly and line.startswith('include::'):
+                    if title_id_sha:
+                        title_id_sha, ctx_segment = self._context_hash(title_id, hash_contexts)
+                        newlines.append(':parent-of-context-' + title_id_sha + ': {context}\n')
+                        newlines.append(':context: {context}-' + ctx_segment + '\n')
+                        newlines.append(line)
+                        newlines.append(':context: {parent-of-context-' + title_id_sha + '}\n')
+                        continue
+                    else:
+                        log.error('Expected assembly title before first include')
+                        sys.exit()
+                # Process :parent-of-context-<SHA>: {context} line
+                if is_assembly and line.startswith(':parent-of-context-'):
+                    if title_id_sha:
+                        title_id_sha, ctx_segment = self._context_hash(title_id, hash_contexts)
+                        parsing_state = EXPECTING_CONTEXT_SET
+                        newlines.append(':parent-of-context-' + title_id_sha + ': {context}\n')
+                        continue
+                    else:
+                        log.error('Expected assembly title before first instance of :parent-of-context-<SHA>:')
+                        sys.exit()
+                # Process regular line
+                newlines.append(line)
+                continue
+            elif parsing_state == EXPECTING_CONTEXT_SET:
+                # Process :context: {context}-<SEGMENT> line
+                if line.startswith(':context:'):
+                    parsing_state = EXPECTING_INCLUDE
+                    newlines.append(':context: {context}-' + ctx_segment + '\n')
+                    continue
+                else:
+                    log.error('Expected context definition')
+                    sys.exit()
+            elif parsing_state == EXPECTING_INCLUDE:
+                # Process include:: line
+                if line.startswith('include::'):
+                    parsing_state = EXPECTING_CONTEXT_RESTORE
+                    newlines.append(line)
+                    continue
+                else:
+                    log.error('Expected include line')
+                    sys.exit()
+            elif parsing_state == EXPECTING_CONTEXT_RESTORE:
+                # Process :context: {parent-of-context-<SHA>} line
+                if line.startswith(':context: {parent-of-context-'):
+                    parsing_state = REGULAR_LINES
+                    newlines.append(':context: {parent-of-context-' + title_id_sha + '}\n')
+                    continue
+                else:
+                    log.error('Expected context restore line')
+                    sys.exit()
+        if parsing_state == LEGACY_MODE:
+            return 'legacy', None
+        contents = ''.join(newlines)
+        if contents == ''.join(oldlines):
+            return 'unchanged', contents
+        return 'changed', contents
+
+    def _replace_file_contents(self, filepath, contents):
+        # Create temp file, removing it if anything goes wrong
+        fh, abs_path = tempfile.mkstemp()
+        try:
             with os.fdopen(fh, 'w') as new_file:
-                with open(fixfile) as old_file:
-                    for line in old_file:
-                        # Ignore blank lines
-                        if line.strip() == '':
-                            new_file.write(line)
-                            continue
-                        # Ignore comment lines
-                        if line.strip().startswith('//'):
-                            new_file.write(line)
-                            continue
-                        # Detect legacy context files (not added using Nebel)
-                        if line.startswith(':parent-context:') or line.startswith('ifdef::context[:parent-context:'):
-                            parsing_state = LEGACY_MODE
-                            break
-                        if parsing_state == REGULAR_LINES:
-                            # Process *unexpected* context definition - signals legacy mode!
-                            if line.startswith(':context:'):
-                                parsing_state = LEGACY_MODE
-                                break
-                            # Process ID line
-                            found_id = ''
-                            result = regexp_id_line1.search(line)
-                            if result is not None:
-                                found_id = result.group(1)
-                            result = regexp_id_line2.search(line)
-                            if result is not None:
-                                found_id = result.group(1)
-                            if found_id:
-                                most_recent_root_id = found_id.replace('_{context}', '')
-                                # Add _{context} to ID
-                                if not found_id.endswith('_{context}'):
-                                    line = line.replace(found_id, found_id + '_{context}')
-                                new_file.write(line)
-                                continue
-                            # Process title line
-                            result = regexp_title.search(line)
-                            if result is not None:
-                                equalssigncount = len(result.group(1))
-                                title = self.context.resolve_raw_attribute_value(result.group(2))
-                                if most_recent_root_id != '':
-                                    title_id = most_recent_root_id
-                                    title_id_sha = self._generate_hash(title_id)
-                                    if args.hash_contexts:
-                                        ctx_segment = title_id_sha
-                                    else:
-                                        ctx_segment = title_id
-                                else:
-                                    print('ERROR: Expected ID definition before heading = ' + title)
-                                    sys.exit()
-                                new_file.write(line)
-                                continue
-                            # Process include:: line
-                            if is_assembly and line.startswith('include::'):
-                                if title_id_sha:
-                                    new_file.write(':parent-of-context-' + title_id_sha + ': {context}\n')
-                                    new_file.write(':context: {context}-' + ctx_segment + '\n')
-                                    new_file.write(line)
-                                    new_file.write(':context: {parent-of-context-' + title_id_sha + '}\n')
-                                    continue
-                                else:
-                                    print('ERROR: Expected assembly title before first include')
-                                    sys.exit()
-                            # Process :parent-of-context-<SHA>: {context} line
-                            if is_assembly and line.startswith(':parent-of-context-'):
-                                if title_id_sha:
-                                    parsing_state = EXPECTING_CONTEXT_SET
-                                    new_file.write(':parent-of-context-' + title_id_sha + ': {context}\n')
-                                    continue
-                                else:
-                                    print('ERROR: Expected assembly title before first instance of :parent-of-context-<SHA>:')
-                                    sys.exit()
-                            # Process regular line
-                            new_file.write(line)
-                            continue
-                        elif parsing_state == EXPECTING_CONTEXT_SET:
-                            # Process :context: {context}-<SEGMENT> line
-                            if line.startswith(':context:'):
-                                parsing_state = EXPECTING_INCLUDE
-                                new_file.write(':context: {context}-' + ctx_segment + '\n')
-                                continue
-                            else:
-                                print('ERROR: Expected context definition')
-                                sys.exit()
-                        elif parsing_state == EXPECTING_INCLUDE:
-                            # Process include:: line
-                            if line.startswith('include::'):
-                                parsing_state = EXPECTING_CONTEXT_RESTORE
-                                new_file.write(line)
-                                continue
-                            else:
-                                print('ERROR: Expected include line')
-                                sys.exit()
-                        elif parsing_state == EXPECTING_CONTEXT_RESTORE:
-                            # Process :context: {parent-of-context-<SHA>} line
-                            if line.startswith(':context: {parent-of-context-'):
-                                parsing_state = REGULAR_LINES
-                                new_file.write(':context: {parent-of-context-' + title_id_sha + '}\n')
-                                continue
-                            else:
-                                print('ERROR: Expected context restore line')
-                                sys.exit()
-            if parsing_state == LEGACY_MODE:
-                # Leave legacy files unchanged!
-                print('  - legacy file detected - no changes made')
-            else:
-                # Remove original file
-                os.remove(fixfile)
-                # Move new file
-                shutil.move(abs_path, fixfile)
+                new_file.write(contents)
+            # Remove original file
+            os.remove(filepath)
+            # Move new file
+            shutil.move(abs_path, filepath)
+        finally:
+            if os.path.exists(abs_path):
+                os.remove(abs_path)
 
 
     def _generate_hash(self, text):
@@ -1667,16 +2275,499 @@ class Tasks:
         truncated_hash = hash[:6]
         return truncated_hash
 
+    def _context_hash(self, rootid, hash_contexts=False):
+        # Returns (hash, segment) for a :parent-of-context-<hash>: attribute written to an assembly, and
+        # the segment that the :context: attribute appends. The hash is taken from the context registry,
+        # which extends it where needed to keep it unique across the repository.
+        if self.context_registry is not None:
+            hash = self.context_registry.hash_of(rootid)
+        else:
+            hash = self._generate_hash(rootid)
+        if hash_contexts:
+            return hash, hash
+        return hash, rootid
+
+    def _context_registry(self):
+        # Returns the context registry. When the registry file does not exist yet, it is seeded with the
+        # hashes that the assemblies already use, so that new hashes cannot collide with them.
+        registry = nebel.registry.ContextRegistry(self.context)
+        if not registry.exists:
+            filelist = set(self._scan_for_bookfiles())
+            for root, dirs, files in os.walk(self.context.ASSEMBLIES_DIR):
+                for file in files:
+                    if file.endswith('.adoc'):
+                        filelist.add(os.path.join(root, file))
+            for filepath in sorted(filelist):
+                for rootid, hash in self._scan_for_context_hashes(filepath):
+                    registry.register(rootid, hash, filepath)
+            # Save the registry even if it is empty, so that the assemblies are only scanned once (the
+            # 'contexts' command does not save it)
+            registry.dirty = True
+            log.info('Seeded the context registry ' + registry.path + ' with ' + str(len(registry.hashes)) + ' hash(es) from ' + str(len(filelist)) + ' file(s)')
+        return registry
+
+    def _scan_for_context_hashes(self, filepath):
+        # Yields (rootid, hash) for each :parent-of-context-<HASH>: attribute in 'filepath', where the
+        # root ID is the ID of the enclosing heading, without _{context}, as in _add_contexts_to_file()
+        with nebel.scan.mapped(filepath) as buf:
+            if buf.find(b':parent-of-context-') == -1:
+                return
+        regexp_id_line1 = re.compile(r'^\s*\[\[\s*(\S+)\s*\]\]\s*$')
+        regexp_id_line2 = re.compile(r'^\s*\[id\s*=\s*[\'"]\s*(\S+)\s*[\'"]\]\s*$')
+        regexp_title = re.compile(r'^(=+)\s+(\S.*)')
+        regexp_parent_of_context = re.compile(r'^:parent-of-context-([^:\s]+):')
+        most_recent_root_id = ''
+        title_id = ''
+        for lineno, line in nebel.scan.interesting_lines(filepath, self.prefilter_contexts):
+            if line is None:
+                continue
+            found_id = ''
+            result = regexp_id_line1.search(line)
+            if result is not None:
+                found_id = result.group(1)
+            result = regexp_id_line2.search(line)
+            if result is not None:
+                found_id = result.group(1)
+            if found_id:
+                most_recent_root_id = found_id.replace('_{context}', '')
+                continue
+            if regexp_title.search(line) is not None:
+                title_id = most_recent_root_id
+                continue
+            result = regexp_parent_of_context.search(line)
+            if (result is not None) and title_id:
+                yield title_id, result.group(1)
+
+    def contexts(self, args):
+        registry = self._context_registry()
+        if args.ROOT_ID:
+            rootidlist = args.ROOT_ID
+        else:
+            rootidlist = sorted(registry.hashes)
+        nebel.log.flush()
+        for rootid in rootidlist:
+            hash = registry.lookup(rootid)
+            if hash is None:
+                log.warning('No context hash registered for: ' + rootid)
+                continue
+            sys.stdout.write(hash + ' ' + rootid + '\n')
+
+
+    def refs(self, args):
+        # Lists the links to an ID, with or without _{context}. Only the files that contain the root ID
+        # (according to the trigram index) are scanned, together with any book, assembly, or module
+        # that the index does not cover.
+        rootid = args.ID.strip().replace('_{context}', '')
+        index = self._trigram_index()
+        candidates = index.candidates(rootid)
+        if candidates is None:
+            candidates = index.files()
+        index.save()
+        categoryset = self.scan_for_categories(self.context.ASSEMBLIES_DIR)
+        filelist = self.scan_for_categorised_files(self.context.ASSEMBLIES_DIR, categoryset, filefilter='assembly')
+        categoryset = self.scan_for_categories(self.context.MODULES_DIR)
+        filelist.extend(self.scan_for_categorised_files(self.context.MODULES_DIR, categoryset, filefilter='module'))
+        filelist.extend(self._scan_for_bookfiles())
+        candidates = set(candidates)
+        candidates.update(os.path.normpath(filepath) for filepath in filelist if not index.covers(filepath))
+        refs = []
+        for filepath in sorted(candidates):
+            with open(filepath, 'r') as f:
+                for lineno, line in enumerate(f, 1):
+                    if rootid not in line:
+                        continue
+                    for match_obj in self.regexp_link_targets.finditer(line):
+                        anchorid = match_obj.group('angleid') or match_obj.group('xrefid') or match_obj.group('linkid')
+                        if anchorid.strip().replace('_{context}', '') == rootid:
+                            refs.append({'file': filepath, 'line': lineno, 'id': anchorid.strip(), 'link': match_obj.group(0)})
+        nebel.log.flush()
+        if args.format == 'json':
+            json.dump(refs, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        else:
+            sys.stdout.writelines(ref['file'] + ':' + str(ref['line']) + ': ' + ref['link'] + '\n' for ref in refs)
 
     def toc(self, args):
-        pass
+        filepath = args.ASSEMBLY_OR_BOOK_FILE
+        if not os.path.exists(filepath):
+            log.error('File does not exist: ' + filepath)
+            sys.exit()
+        self.context.clear_attributes()
+        if args.attribute_files:
+            self.context.parse_attribute_files(args.attribute_files.strip().split(','))
+        self.outline_cache = self._file_cache('outline', version=2)
+        outline = []
+        self._build_outline(os.path.relpath(os.path.realpath(filepath)), 0, None, outline)
+        self.outline_cache.save()
+        if args.max_level is not None:
+            outline = [entry for entry in outline if entry['level'] <= args.max_level + 1]
+        nebel.log.flush()
+        if args.format == 'json':
+            json.dump(outline, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+            return
+        tocbuffer = []
+        for entry in outline:
+            tocline = '  ' * max(entry['level'] - 1, 0) + entry['title']
+            if args.ids and entry['id']:
+                tocline += '  [' + entry['id'] + ']'
+            if args.files:
+                tocline += '  (' + entry['file'] + ':' + str(entry['line']) + ')'
+            tocbuffer.append(tocline + '\n')
+        sys.stdout.writelines(tocbuffer)
+
+    def _outline_fragment(self, filepath):
+        # Returns the outline-relevant entries of a single file (without following includes):
+        #   ('attribute', name, value), ('title', equalssigncount, rawtitle, rawid, lineno),
+        #   ('include', rawincludefile, options), ('image', rawtarget, lineno), ('tag', tagname) and ('end', tagname)
+        stamp = self.outline_cache.stamp(filepath)
+        fragment = self.outline_cache.get(filepath, stamp)
+        if fragment is not None:
+            return fragment
+        regexp_attribute = re.compile(r'^:([\w\-]+):\s+(.*)')
+        regexp_include = re.compile(r'^\s*include::([^\[]+)\[([^\]]*)\]')
+        regexp_title = re.compile(r'^(=+)\s+(\S.*)')
+        regexp_tag_begin = re.compile(r'tag::([^\[]+)\[\]')
+        regexp_tag_end   = re.compile(r'end::([^\[]+)\[\]')
+        regexp_id_line1 = re.compile(r'^\s*\[\[\s*(\S+)\s*\]\]\s*$')
+        regexp_id_line2 = re.compile(r'^\s*\[id\s*=\s*[\'"]\s*(\S+)\s*[\'"]\]\s*$')
+        # Matches both block images (image::) and inline images (image:)
+        regexp_image = re.compile(r'(?<![\w\\])image::?([^\s\[\]]+)\[')
+        fragment = []
+        rawid = None
+        with open(filepath, 'r') as f:
+            for lineno, line in enumerate(f, 1):
+                if ('image:' in line) and not line.lstrip().startswith('//'):
+                    for result in regexp_image.finditer(line):
+                        fragment.append(('image', result.group(1), lineno))
+                result = regexp_tag_begin.search(line)
+                if result is not None:
+                    fragment.append(('tag', result.group(1)))
+                    continue
+                result = regexp_tag_end.search(line)
+                if result is not None:
+                    fragment.append(('end', result.group(1)))
+                    continue
+                result = regexp_attribute.search(line)
+                if result is not None:
+                    fragment.append(('attribute', result.group(1), result.group(2).strip()))
+                    continue
+                result = regexp_title.search(line)
+                if result is not None:
+                    fragment.append(('title', len(result.group(1)), result.group(2), rawid, lineno))
+                    rawid = None
+                    continue
+                result = regexp_include.search(line)
+                if result is not None:
+                    fragment.append(('include', result.group(1), result.group(2)))
+                    rawid = None
+                    continue
+                result = regexp_id_line1.search(line) or regexp_id_line2.search(line)
+                if result is not None:
+                    rawid = result.group(1)
+                    continue
+                if line.strip() and not line.lstrip().startswith('//') and not line.startswith('['):
+                    # An ordinary line separates an ID from any later heading
+                    rawid = None
+        self.outline_cache.put(filepath, fragment, stamp)
+        return fragment
+
+    def _build_outline(self, filepath, baselevel, selectedtags, outline):
+        # Walks the cached outline fragments, following includes with the same
+        # leveloffset and tag semantics as _resolve_includes()
+        if not os.path.exists(filepath):
+            log.warning('Include file not found: ' + filepath)
+            return
+        if (selectedtags is not None) and (len(selectedtags) > 0):
+            istaggingactive = True
+            showcontent = False
+        else:
+            istaggingactive = False
+            showcontent = True
+        currtagname = ''
+        for entry in self._outline_fragment(filepath):
+            kind = entry[0]
+            if kind == 'tag' or kind == 'end':
+                if istaggingactive:
+                    tagname = entry[1]
+                    if kind == 'tag' and (not currtagname) and (tagname in selectedtags):
+                        showcontent = True
+                        currtagname = tagname
+                    elif kind == 'end' and tagname == currtagname:
+                        showcontent = False
+                        currtagname = ''
+                continue
+            if not showcontent:
+                continue
+            if kind == 'attribute':
+                self.context.update_attribute(entry[1], entry[2])
+            elif kind == 'title':
+                equalssigncount, rawtitle, rawid, lineno = entry[1:]
+                outline.append({
+                    'level': equalssigncount + baselevel,
+                    'title': self.context.resolve_raw_attribute_value(rawtitle),
+                    'id': self.context.resolve_raw_attribute_value(rawid) if rawid else None,
+                    'file': filepath,
+                    'line': lineno
+                })
+            elif kind == 'include':
+                path_to_included_file, childbaselevel, taglist = self._include_target(filepath, entry[1], entry[2], baselevel)
+                self._build_outline(path_to_included_file, childbaselevel, taglist, outline)
+
+
+    def affected(self, args):
+        if args.PATH:
+            paths = args.PATH
+        else:
+            # Read the changed paths from stdin, one per line (for example, from git diff --name-only)
+            paths = [line.strip() for line in sys.stdin if line.strip()]
+        if args.attribute_files:
+            attrfilelist = args.attribute_files.strip().split(',')
+        else:
+            attrfilelist = None
+        changedfiles = set(os.path.relpath(os.path.realpath(path)) for path in paths)
+        graph = self._build_include_graph(attrfilelist)
+        for changedfile in sorted(changedfiles):
+            if not graph.has_node(changedfile):
+                log.debug('Not included in any book: %s', changedfile, extra={'file': changedfile})
+        affectedfiles = []
+        for filepath in sorted(graph.ancestors(changedfiles)):
+            if graph.is_root(filepath):
+                affectedfiles.append(filepath)
+            elif (not args.books) and (self.type_of_file(os.path.basename(filepath)) == 'assembly'):
+                affectedfiles.append(filepath)
+        nebel.log.flush()
+        if args.format == 'json':
+            json.dump(affectedfiles, sys.stdout, indent=2)
+            sys.stdout.write('\n')
+        else:
+            sys.stdout.writelines(filepath + '\n' for filepath in affectedfiles)
+
+    def _build_include_graph(self, attrfilelist=None, images=None):
+        # Returns the IncludeGraph of every book, where each book also depends on the attribute files.
+        # If an ImageIndex 'images' is provided, it collects the image references of every book.
+        # The last graph is kept in memory, for a long-lived Tasks instance (see nebel.api): it is only built
+        # again if a book was added or removed, or if any file in the graph changed, appeared, or disappeared.
+        bookfiles = sorted(self._scan_for_bookfiles())
+        key = (bookfiles, attrfilelist)
+        memo = self._include_graph_memo
+        if (memo is None) or (memo[0] != key) or not nebel.cache.unchanged(memo[1]):
+            self.outline_cache = self._file_cache('outline', version=2)
+            graph = nebel.graph.IncludeGraph()
+            graphimages = nebel.graph.ImageIndex()
+            for bookfile in bookfiles:
+                bookfile = os.path.relpath(os.path.realpath(bookfile))
+                graph.add_root(bookfile)
+                self.context.clear_attributes()
+                if attrfilelist is not None:
+                    self.context.parse_attribute_files(attrfilelist)
+                    for attrfile in attrfilelist:
+                        graph.add_edge(bookfile, os.path.relpath(os.path.realpath(attrfile)))
+                self._add_includes_to_graph(graph, bookfile, 0, None, set(), graphimages, os.path.dirname(bookfile))
+            self.outline_cache.save()
+            stamps = dict((filepath, nebel.cache.stamp(filepath) if os.path.exists(filepath) else None) for filepath in graph.paths.strings)
+            memo = self._include_graph_memo = (key, stamps, graph, graphimages)
+        if images is not None:
+            images.extend(memo[3])
+        return memo[2]
+
+    def _add_includes_to_graph(self, graph, filepath, baselevel, selectedtags, visiting, images=None, basedir=None):
+        # Walks the cached outline fragments like _build_outline(), adding an edge for every include.
+        # Included files that are not AsciiDoc files (such as code samples) are added, but not parsed.
+        # Image references are added to 'images' (if provided), relative to the book directory 'basedir'.
+        if (selectedtags is not None) and (len(selectedtags) > 0):
+            istaggingactive = True
+            showcontent = False
+        else:
+            istaggingactive = False
+            showcontent = True
+        currtagname = ''
+        visiting.add(filepath)
+        for entry in self._outline_fragment(filepath):
+            kind = entry[0]
+            if kind == 'tag' or kind == 'end':
+                if istaggingactive:
+                    tagname = entry[1]
+                    if kind == 'tag' and (not currtagname) and (tagname in selectedtags):
+                        showcontent = True
+                        currtagname = tagname
+                    elif kind == 'end' and tagname == currtagname:
+                        showcontent = False
+                        currtagname = ''
+                continue
+            if not showcontent:
+                continue
+            if kind == 'attribute':
+                self.context.update_attribute(entry[1], entry[2])
+            elif kind == 'include':
+                path_to_included_file, childbaselevel, taglist = self._include_target(filepath, entry[1], entry[2], baselevel)
+                graph.add_edge(filepath, path_to_included_file)
+                if path_to_included_file in visiting:
+                    log.warning('Circular include of ' + path_to_included_file + ' in ' + filepath, extra={'file': filepath})
+                elif path_to_included_file.endswith('.adoc') and os.path.exists(path_to_included_file):
+                    self._add_includes_to_graph(graph, path_to_included_file, childbaselevel, taglist, visiting, images, basedir)
+            elif kind == 'image' and images is not None:
+                imagepath = self._image_path(basedir, entry[1])
+                if imagepath is not None:
+                    images.add_reference(imagepath, filepath, entry[2])
+        visiting.discard(filepath)
+
+    def _image_path(self, basedir, rawtarget):
+        # Resolves an image target against the imagesdir attribute, like Asciidoctor does: relative to the
+        # directory of the book, not of the file that references the image. Returns None for remote images
+        # and for targets with attributes that cannot be resolved.
+        target = self.context.resolve_raw_attribute_value(rawtarget)
+        if ('{' in target) or ('://' in target) or target.startswith('data:'):
+            return None
+        imagesdir = self.context.lookup_attribute('imagesdir')
+        if imagesdir and not os.path.isabs(target):
+            if ('{' in imagesdir) or ('://' in imagesdir):
+                return None
+            target = os.path.join(imagesdir, target)
+        return os.path.relpath(os.path.realpath(os.path.normpath(os.path.join(basedir, target))))
+
+    def fingerprint(self, args):
+        if args.attribute_files:
+            attrfilelist = args.attribute_files.strip().split(',')
+        else:
+            attrfilelist = None
+        images = nebel.graph.ImageIndex()
+        graph = self._build_include_graph(attrfilelist, images)
+        # Images are part of the fingerprint of each file that references them
+        imagesoffile = {}
+        for imagepath in images.images():
+            for filepath, lineno in images.references(imagepath):
+                imagesoffile.setdefault(filepath, set()).add(imagepath)
+        if args.FILE:
+            filelist = [os.path.relpath(os.path.realpath(filepath)) for filepath in args.FILE]
+            for filepath in filelist:
+                if not os.path.exists(filepath):
+                    log.error('File does not exist: ' + filepath)
+                    sys.exit()
+        else:
+            filelist = sorted(graph.roots)
+            if args.assemblies:
+                filelist.extend(sorted(filepath for filepath in graph.descendants(graph.roots)
+                                       if self.type_of_file(os.path.basename(filepath)) == 'assembly'))
+        self.fingerprint_cache = self._file_cache('fingerprints')
+        memo = {}
+        fingerprints = [(filepath, self._merkle_fingerprint(graph, filepath, memo, set(), imagesoffile)) for filepath in filelist]
+        self.fingerprint_cache.save()
+        nebel.log.flush()
+        if args.format == 'json':
+            json.dump(dict(fingerprints), sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+        else:
+            sys.stdout.writelines(fingerprint + '  ' + filepath + '\n' for filepath, fingerprint in fingerprints)
 
+    def _file_fingerprint(self, filepath):
+        # SHA-256 of the contents of a single file, memoized by modification time and size
+        if not os.path.exists(filepath):
+            return 'missing'
+        stamp = self.fingerprint_cache.stamp(filepath)
+        fingerprint = self.fingerprint_cache.get(filepath, stamp)
+        if fingerprint is None:
+            sha = hashlib.sha256()
+            with open(filepath, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+            fingerprint = sha.hexdigest()
+            self.fingerprint_cache.put(filepath, fingerprint, stamp)
+        return fingerprint
+
+    def _merkle_fingerprint(self, graph, filepath, memo, visiting, imagesoffile=None):
+        # Hash over the file's own fingerprint, the path and fingerprint of every image it references
+        # (from 'imagesoffile', which maps file paths to image paths), and the path and Merkle fingerprint
+        # of every file it includes
+        if filepath in memo:
+            return memo[filepath]
+        visiting.add(filepath)
+        sha = hashlib.sha256()
+        sha.update(('file ' + self._file_fingerprint(filepath) + '\n').encode('UTF-8'))
+        if imagesoffile is not None:
+            for imagepath in sorted(imagesoffile.get(filepath, ())):
+                sha.update(('image ' + imagepath + ' ' + self._file_fingerprint(imagepath) + '\n').encode('UTF-8'))
+        for child in sorted(graph.children(filepath)):
+            if child in visiting:
+                # Circular include: the file is already part of this hash
+                childfingerprint = 'cycle'
+            else:
+                childfingerprint = self._merkle_fingerprint(graph, child, memo, visiting, imagesoffile)
+            sha.update(('include ' + child + ' ' + childfingerprint + '\n').encode('UTF-8'))
+        visiting.discard(filepath)
+        memo[filepath] = sha.hexdigest()
+        return memo[filepath]
+
+    def flatten(self, args):
+        bookfile = args.ASSEMBLY_OR_BOOK_FILE
+        if not os.path.exists(bookfile):
+            log.error('File does not exist: ' + bookfile)
+            sys.exit()
+        self.context.clear_attributes()
+        if args.attribute_files:
+            self.context.parse_attribute_files(args.attribute_files.strip().split(','))
+        sourcemapfile = args.source_map
+        if sourcemapfile is None and args.output:
+            sourcemapfile = args.output + '.map.json'
+        # The source map has one [first output line, source index, first source line, line count]
+        # entry for each range of consecutive output lines that come from consecutive source lines
+        sources = []
+        sourceindex = {}
+        mappings = []
+        outlineno = 0
+        outbuffer = []
+        nebel.log.flush()
+        # Write to a temp file in the target directory first, so that a failed run (for example, because of a
+        # missing include) cannot leave a truncated output file
+        abs_path = None
+        if args.output:
+            fh, abs_path = tempfile.mkstemp(dir=os.path.dirname(args.output) or os.curdir)
+            output = os.fdopen(fh, 'w')
+        else:
+            output = sys.stdout
+        try:
+            for line, sourcefile, lineno in self._iter_resolved_lines(os.path.relpath(os.path.realpath(bookfile))):
+                if not line.endswith('\n'):
+                    line += '\n'
+                outbuffer.append(line)
+                if len(outbuffer) >= 4096:
+                    output.writelines(outbuffer)
+                    outbuffer = []
+                outlineno += 1
+                if sourcemapfile is None:
+                    continue
+                index = sourceindex.get(sourcefile)
+                if index is None:
+                    index = sourceindex[sourcefile] = len(sources)
+                    sources.append(sourcefile)
+                if mappings:
+                    lastmapping = mappings[-1]
+                    if (lastmapping[1] == index) and (lastmapping[0] + lastmapping[3] == outlineno) and (lastmapping[2] + lastmapping[3] == lineno):
+                        lastmapping[3] += 1
+                        continue
+                mappings.append([outlineno, index, lineno, 1])
+            output.writelines(outbuffer)
+            if abs_path is not None:
+                output.close()
+                os.replace(abs_path, args.output)
+        finally:
+            if abs_path is not None:
+                output.close()
+                if os.path.exists(abs_path):
+                    os.remove(abs_path)
+        self._fragment_cache().save()
+        if sourcemapfile is not None:
+            with open(sourcemapfile, 'w') as f:
+                json.dump({'version': 1, 'file': args.output, 'sources': sources, 'mappings': mappings}, f, separators=(',', ':'))
+                f.write('\n')
+        if args.output:
+            log.info('Wrote ' + str(outlineno) + ' lines from ' + str(len(sources)) + ' files to ' + args.output)
 
     def atom(self, args):
         head, tail = os.path.split(args.FILE)
         type = self.type_of_file(tail)
         if type not in ['assembly', 'procedure', 'concept', 'reference']:
-            print('ERROR: File must be a module or an assembly: ' + args.FILE)
+            log.error('File must be a module or an assembly: ' + args.FILE)
             sys.exit()
         if type in ['procedure', 'concept', 'reference']:
             type = 'module'
@@ -1697,68 +2788,142 @@ class Tasks:
         categoryset = self.scan_for_categories(self.context.ASSEMBLIES_DIR)
         assemblyfiles = self.scan_for_categorised_files(self.context.ASSEMBLIES_DIR, categoryset, filefilter='assembly')
         assemblyfiles.extend(self._scan_for_bookfiles())
-        parentassemblies, assemblyincludes = self._scan_for_parent_assemblies(assemblyfiles)
+        includegraph = self._scan_for_parent_assemblies(assemblyfiles)
         # Assemble the list of files to edit
         targetfilelist = []
         if edit_parent or edit_siblings:
-            if args.FILE in parentassemblies:
-                for parentassembly in parentassemblies[args.FILE]:
+            if includegraph.parents(args.FILE):
+                for parentassembly in includegraph.parents(args.FILE):
                     if edit_parent:
                         targetfilelist.append(parentassembly)
-                    if edit_siblings and (parentassembly in assemblyincludes):
-                        targetfilelist.extend(assemblyincludes[parentassembly])
+                    if edit_siblings:
+                        targetfilelist.extend(includegraph.children(parentassembly))
             else:
-                print('WARN: Could not find parent assembly')
+                log.warning('Could not find parent assembly')
         if not edit_siblings:
             targetfilelist.append(args.FILE)
         if edit_children and type == 'assembly':
-            if args.FILE in assemblyincludes:
-                targetfilelist.extend(assemblyincludes[args.FILE])
+            if args.FILE in assemblyfiles:
+                targetfilelist.extend(includegraph.children(args.FILE))
         subprocess.check_call(['atom'] + targetfilelist)
 
     def csv(self, args):
-        filepath = args.ASSEMBLY_OR_BOOK_FILE
-        if not os.path.exists(filepath):
-            print('ERROR: File does not exist: ' + args.FILE)
+        if args.all_books:
+            filelist = sorted(self._scan_for_bookfiles())
+        else:
+            filelist = args.ASSEMBLY_OR_BOOK_FILE
+        if not filelist:
+            log.error('Specify at least one assembly or book file, or --all-books')
             sys.exit()
+        for filepath in filelist:
+            if not os.path.exists(filepath):
+                log.error('File does not exist: ' + filepath)
+                sys.exit()
         if args.cols:
             col_header_list = args.cols.split(',')
         else:
             col_header_list = None
-        # Initialize anchor ID dictionary, legacy ID, and root of ID lookup
-        anchorid_dict = {}
-        legacyid_dict = {}
-        rootofid_dict = {}
-        metadata_list = []
-        # Process the book or assembly
+        # Books are processed in parallel, but their rows are output in the order of 'filelist'
+        harvests = nebel.parallel.map_tasks(self, '_harvest_metadata', [(filepath,) for filepath in filelist], nebel.parallel.jobs_count(args.jobs))
+        if len(filelist) > 1:
+            harvests = self._tag_rows_with_book(filelist, harvests)
+            if col_header_list is not None and 'Book' not in col_header_list:
+                col_header_list = ['Book'] + col_header_list
+        self._export_csv(harvests, col_header_list)
+
+    def export(self, args):
+        if not args.sqlite and not args.parquet:
+            log.error('Specify at least one export target: --sqlite or --parquet')
+            sys.exit()
+        if args.BOOK_FILE:
+            filelist = args.BOOK_FILE
+        else:
+            filelist = sorted(self._scan_for_bookfiles())
+        for filepath in filelist:
+            if not os.path.exists(filepath):
+                log.error('File does not exist: ' + filepath)
+                sys.exit()
+        exporters = []
+        if args.sqlite:
+            sqliteexport = nebel.export.SqliteExport(self.context, args.sqlite)
+            exporters.append(sqliteexport.upsert)
+        else:
+            sqliteexport = None
+        if args.parquet:
+            parquetexport = nebel.export.ParquetExport(self.context, args.parquet)
+            exporters.append(parquetexport.append)
+        else:
+            parquetexport = None
+        # Only the books with a changed (or new) file are parsed again: the rows of the others are cached
+        metadata_cache = self._file_cache('metadata', version=2)
+        harvests = [None] * len(filelist)
+        stale = []
+        for k, filepath in enumerate(filelist):
+            entry = metadata_cache.stale(filepath)
+            if (entry is not None) and nebel.cache.unchanged(entry[0]):
+                harvests[k] = entry[1]
+            else:
+                stale.append(k)
+        log.info('Parsing ' + str(len(stale)) + ' of ' + str(len(filelist)) + ' books')
+        results = nebel.parallel.map_tasks(self, '_harvest_metadata_with_stamps', [(filelist[k],) for k in stale], nebel.parallel.jobs_count(args.jobs))
+        for k, (stamps, metadata_list) in zip(stale, results):
+            metadata_cache.put(filelist[k], (stamps, metadata_list))
+            harvests[k] = metadata_list
+        metadata_cache.save()
+        for filepath, metadata_list in zip(filelist, self._tag_rows_with_book(filelist, harvests)):
+            log.info('Exporting metadata for book: %s', filepath, extra={'book': filepath})
+            for exporter in exporters:
+                exporter(filepath, metadata_list)
+        if sqliteexport is not None:
+            if not args.BOOK_FILE:
+                # Without explicit books, the database mirrors the whole repository
+                sqliteexport.prune_books(set(filelist))
+            log.info('Updated ' + str(sqliteexport.changed) + ' files in ' + args.sqlite + ' (' + str(sqliteexport.unchanged) + ' unchanged)')
+            sqliteexport.close()
+        if parquetexport is not None:
+            parquetexport.close()
+            log.info('Wrote ' + args.parquet)
+
+    def _harvest_metadata(self, filepath, visited=None):
+        # Returns the list of metadata rows for every heading with an ID in the book or assembly.
+        # If a 'visited' set is provided, it collects the path of every file parsed.
         booktitle = self._scan_for_title(filepath)
         booktitle_slug = self._convert_title_to_slug(booktitle)
-        #print 'Title URL slug: ' + booktitle_slug
         self.context.clear_attributes()
-        anchorid_dict, legacyid_dict, rootofid_dict, metadata_list = self._parse_file_for_anchorids(anchorid_dict, legacyid_dict, rootofid_dict, metadata_list, booktitle_slug, filepath)
-        #print(metadata_list)
-        self._export_csv(metadata_list, col_header_list)
-        # TODO - Also need to extract 'Category' and 'Level' metadata
-
-    def _export_csv(self, metadata_list, col_header_list = None):
-        # Initialize 'col_header_list'
+        metadata_list = []
+        self._parse_file_for_anchorids(nebel.graph.AnchorIndex(), metadata_list, booktitle_slug, filepath, visited=visited)
+        return metadata_list
+
+    def _harvest_metadata_with_stamps(self, filepath):
+        # Returns the stamps of the files that the book includes (see nebel.cache.unchanged) and its metadata rows
+        visited = set()
+        metadata_list = self._harvest_metadata(filepath, visited)
+        return dict((path, nebel.cache.stamp(path)) for path in visited), metadata_list
+
+    def _tag_rows_with_book(self, filelist, harvests):
+        for filepath, metadata_list in zip(filelist, harvests):
+            for metadata in metadata_list:
+                metadata['Book'] = filepath
+            yield metadata_list
+
+    def _export_csv(self, harvests, col_header_list = None):
+        # Writes each batch of metadata rows from 'harvests' as it arrives. Without an explicit
+        # 'col_header_list', the columns are the union of the keys of all rows, in order of appearance.
+        writer = csv.writer(sys.stdout, lineterminator='\n')
         if col_header_list is None:
-            # By default, use all the keys from the first row of metadata
-            col_header_list = list(metadata_list[0].keys())
-        #print(col_header_list)
-        #print(','.join(map(lambda s: '"' + s + '"', col_header_list)))
-        print(','.join(col_header_list))
-        for metadata in metadata_list:
-            for col_header in col_header_list:
-                if col_header in metadata:
-                    value = metadata[col_header]
-                    if value is not None:
-                        if ' ' in value:
-                            print('"' + value + '"', end='')
-                        else:
-                            print(value, end='')
-                print(',', end='')
-            print()
+            metadata_list = [metadata for batch in harvests for metadata in batch]
+            col_header_list = []
+            for metadata in metadata_list:
+                col_header_list.extend(key for key in metadata if key not in col_header_list)
+            if 'Book' in col_header_list:
+                col_header_list.remove('Book')
+                col_header_list.insert(0, 'Book')
+            harvests = [metadata_list]
+        nebel.log.flush()
+        writer.writerow(col_header_list)
+        for metadata_list in harvests:
+            writer.writerows([metadata.get(col_header) for col_header in col_header_list] for metadata in metadata_list)
+        sys.stdout.flush()
 
 def version(self, args):
         pass
@@ -1773,114 +2938,199 @@ def add_module_arguments(parser):
     parser.add_argument('-p', '--parent-assemblies', help='List of assemblies that include this module, specified as a space-separated list (enclose in quotes)')
 
 
+def new_context(configfile='nebel.cfg'):
+    # Creates the context of the content repository configured by 'configfile'
+    context = nebel.context.NebelContext()
+    context.initializeFromFile(configfile)
+    this_script_path = os.path.dirname(os.path.abspath(__file__))
+    context.templatePath = os.path.abspath(os.path.join(this_script_path, '..', 'template'))
+    context.moduleFactory = nebel.factory.ModuleFactory(context)
+    return context
+
+
+def build_parser(tasks):
+    # Creates the command-line parser, with each sub-command bound to a method of 'tasks'
+    context = tasks.context
+
+    # Create the top-level parser
+    parser = argparse.ArgumentParser(prog='nebel')
+    parser.add_argument('-v', '--version', action='version', version='Nebel 3.0.x (dev release)')
+    parser.add_argument('-q', '--quiet', help='Only log warnings and errors', action='store_true')
+    parser.add_argument('--verbose', help='Also log debugging messages', action='store_true')
+    parser.add_argument('--log-format', help='Format of log messages: plain text lines, or one JSON object per line', choices=['text', 'json'], default='text')
+    subparsers = parser.add_subparsers()
+
+    # Create the sub-parser for the 'assembly' command
+    assembly_parser = subparsers.add_parser('assembly', help='Generate an assembly')
+    add_module_arguments(assembly_parser)
+    assembly_parser.set_defaults(func=tasks.create_assembly)
+
+    # Create the sub-parser for the 'procedure' command
+    procedure_parser = subparsers.add_parser('procedure', help='Generate a procedure module')
+    add_module_arguments(procedure_parser)
+    procedure_parser.set_defaults(func=tasks.create_procedure)
+
+    # Create the sub-parser for the 'concept' command
+    concept_parser = subparsers.add_parser('concept', help='Generate a concept module')
+    add_module_arguments(concept_parser)
+    concept_parser.set_defaults(func=tasks.create_concept)
+
+    # Create the sub-parser for the 'reference' command
+    reference_parser = subparsers.add_parser('reference', help='Generate a reference module')
+    add_module_arguments(reference_parser)
+    reference_parser.set_defaults(func=tasks.create_reference)
+
+    # Create the sub-parser for the 'create-from' command
+    create_parser = subparsers.add_parser('create-from', help='Create multiple assemblies/modules from a CSV file, or an assembly file')
+    create_parser.add_argument('FROM_FILE', help='Can be either a comma-separated values (CSV) file (ending with .csv), or an assembly file (starting with {}/ and ending with .adoc)'.format(context.ASSEMBLIES_DIR))
+    create_parser.set_defaults(func=tasks.create_from)
+
+    # Create the sub-parser for the 'split' command
+    split_parser = subparsers.add_parser('split', help='Split an annotated AsciiDoc file into multiple assemblies and modules')
+    split_parser.add_argument('FROM_FILE', help='Annotated AsciiDoc file (ending with .adoc, including optional wildcard braces, {})')
+    split_parser.add_argument('--legacybasedir', help='Base directory for annotated file content. Subdirectories of this directory are used as default categories.')
+    split_parser.add_argument('--category-prefix', help='When splitting an annotated file, add this prefix to default categories.')
+    split_parser.add_argument('-a', '--attribute-files', help='Specify a comma-separated list of attribute files')
+    split_parser.add_argument('--conditions', help='Define a comma-separated list of condition attributes, for resolving ifdef and ifndef directives')
+    split_parser.add_argument('--timestamp', help='Generate a timestamp in the generated module and assembly files', action='store_true')
+    split_parser.add_argument('-j', '--jobs', help='Number of worker processes (default: 1)', type=int, default=1)
+    split_parser.set_defaults(func=tasks.adoc_split)
+
+    # Create the sub-parser for the 'book' command
+    book_parser = subparsers.add_parser('book', help='Create and manage book directories')
+    book_parser.add_argument('BOOK_DIR', help='The book directory')
+    book_parser.add_argument('--create', help='Create a new book directory', action='store_true')
+    book_parser.add_argument('-c', '--category-list', help='Comma-separated list of categories to add to book (enclose in quotes)')
+    book_parser.set_defaults(func=tasks.book)
+
+    # Create the sub-parser for the 'mv' command
+    book_parser = subparsers.add_parser('mv', help='Move (or rename) module or assembly files. You can optionally use a single instance of braces for globbing/substituting. For example, to change a file prefix from p_ to proc_ you could enter: nebel mv p_{}.adoc proc_{}.adoc')
+    book_parser.add_argument('FROM_FILE', help='File origin. Optionally use {} for globbing.')
+    book_parser.add_argument('TO_FILE', help='File destination. Optionally use {} to substitute captured glob content')
+    book_parser.set_defaults(func=tasks.mv)
+
+    # Create the sub-parser for the 'update' command
+    update_parser = subparsers.add_parser('update', help='Update metadata in modules and assemblies')
+    update_parser.add_argument('--fix-includes', help='Fix erroneous include directives in assemblies', action='store_true')
+    update_parser.add_argument('--fix-links', help='Fix erroneous cross-reference links', action='store_true')
+    update_parser.add_argument('-p','--parent-assemblies', help='Update ParentAssemblies property in modules and assemblies', action='store_true')
+    update_parser.add_argument('--generate-ids', help='Generate missing IDs for headings', action='store_true')
+    update_parser.add_argument('--id-prefix', help='Customize ID prefix for IDs generated using --generate-ids')
+    update_parser.add_argument('-j', '--jobs', help='Number of worker processes for --generate-ids (default: one per CPU)', type=int, default=0)
+    update_parser.add_argument('--add-contexts', help='Add _{context} to IDs and add boilerplate around include directives', action='store_true')
+    update_parser.add_argument('--hash-contexts', help='Use together with --add-contexts if you want contexts to contain hashes instead of literal IDs', action='store_true')
+    update_parser.add_argument('-c', '--category-list', help='Apply update only to this comma-separated list of categories (enclose in quotes)')
+    update_parser.add_argument('-b', '--book', help='Apply update only to the specified book')
+    update_parser.add_argument('-a', '--attribute-files', help='Specify a comma-separated list of attribute files')
+    update_parser.add_argument('--resolve', help='Comma-separated list of heuristics for resolving ambiguous include paths and link targets without prompting, applied in order: category, nearest, book, skip')
+    update_parser.add_argument('--decisions', help='JSON file of recorded choices for ambiguous include paths and link targets. Disables interactive prompts')
+    update_parser.add_argument('--collect', help='Use together with --decisions to record unresolved choices in the decisions file, without changing any files', action='store_true')
+    update_parser.add_argument('--resume', help='Continue an interrupted --fix-links or --add-contexts run with the same options, skipping the files it already updated', action='store_true')
+    update_parser.add_argument('FILE', help='File to update OR you can omit this argument and use --book or --category-list instead', nargs='?')
+    update_parser.set_defaults(func=tasks.update)
+
+    # Create the sub-parser for the 'orphan' command
+    orphan_parser = subparsers.add_parser('orphan', help='Search for orphaned module and assembly files')
+    orphan_parser.add_argument('-c', '--category-list', help='Filter for orphan files belonging to this comma-separated list of categories')
+    orphan_parser.add_argument('-a', '--attribute-files', help='Specify a comma-separated list of attribute files')
+    orphan_parser.add_argument('--images', help='Search for image files that no book references, and report references to missing images', action='store_true')
+    orphan_parser.set_defaults(func=tasks.orphan_search)
+
+    # Create the sub-parser for the 'validate' command
+    validate_parser = subparsers.add_parser('validate', help='Check includes and links in books, without changing any files. Exits with status 1 if any problems are found')
+    validate_parser.add_argument('BOOK_FILE', help='Book files to check (default: every master.adoc file)', nargs='*')
+    validate_parser.add_argument('-a', '--attribute-files', help='Specify a comma-separated list of attribute files')
+    validate_parser.add_argument('-j', '--jobs', help='Number of worker processes (default: one per CPU)', type=int, default=0)
+    validate_parser.add_argument('--format', help='Output format for the report', choices=['text', 'json'], default='text')
+    validate_parser.set_defaults(func=tasks.validate)
+
+    # Create the sub-parser for the 'flatten' command
+    flatten_parser = subparsers.add_parser('flatten', help='Write a book or assembly as a single file with all includes resolved')
+    flatten_parser.add_argument('ASSEMBLY_OR_BOOK_FILE', help='Path of the book or assembly file to flatten')
+    flatten_parser.add_argument('-a', '--attribute-files', help='Specify a comma-separated list of attribute files')
+    flatten_parser.add_argument('-o', '--output', help='Output file (default: standard output)')
+    flatten_parser.add_argument('--source-map', help='Source map file (default: OUTPUT.map.json, or none when writing to standard output)')
+    flatten_parser.set_defaults(func=tasks.flatten)
+
+    # Create the sub-parser for the 'affected' command
+    affected_parser = subparsers.add_parser('affected', help='List the books and assemblies that include any of the specified files, directly or indirectly')
+    affected_parser.add_argument('PATH', help='Paths of changed files. If omitted, the paths are read from standard input, one per line', nargs='*')
+    affected_parser.add_argument('-a', '--attribute-files', help='Specify a comma-separated list of attribute files. Every book depends on these files')
+    affected_parser.add_argument('-b', '--books', help='List only the affected books (master.adoc files)', action='store_true')
+    affected_parser.add_argument('--format', help='Output format (default: text)', choices=['text', 'json'], default='text')
+    affected_parser.set_defaults(func=tasks.affected)
+
+    # Create the sub-parser for the 'fingerprint' command
+    fingerprint_parser = subparsers.add_parser('fingerprint', help='Print a content fingerprint of books and assemblies, covering every file they include')
+    fingerprint_parser.add_argument('FILE', help='Paths of the book or assembly files to fingerprint. Default is every book (every master.adoc file)', nargs='*')
+    fingerprint_parser.add_argument('-a', '--attribute-files', help='Specify a comma-separated list of attribute files. Every book depends on these files')
+    fingerprint_parser.add_argument('--assemblies', help='Also fingerprint every assembly included in a book', action='store_true')
+    fingerprint_parser.add_argument('--format', help='Output format (default: text)', choices=['text', 'json'], default='text')
+    fingerprint_parser.set_defaults(func=tasks.fingerprint)
+
+    # Create the sub-parser for the 'contexts' command
+    contexts_parser = subparsers.add_parser('contexts', help='List the context hashes assigned to root IDs by update --add-contexts')
+    contexts_parser.add_argument('ROOT_ID', help='Root IDs (IDs without _{context}) to look up. Default is every registered root ID', nargs='*')
+    contexts_parser.set_defaults(func=tasks.contexts)
+
+    # Create the sub-parser for the 'refs' command
+    refs_parser = subparsers.add_parser('refs', help='List the cross-references and links to an anchor ID')
+    refs_parser.add_argument('ID', help='Anchor ID, with or without _{context}')
+    refs_parser.add_argument('--format', help='Output format (default: text)', choices=['text', 'json'], default='text')
+    refs_parser.set_defaults(func=tasks.refs)
+
+    # Create the sub-parser for the 'toc' command
+    toc_parser = subparsers.add_parser('toc', help='List TOC for assembly or book')
+    toc_parser.add_argument('ASSEMBLY_OR_BOOK_FILE', help='Path to the assembly or book file whose table of contents you want to list')
+    toc_parser.add_argument('-a', '--attribute-files', help='Specify a comma-separated list of attribute files')
+    toc_parser.add_argument('-l', '--max-level', help='List only headings down to this section level (the title is level 0)', type=int)
+    toc_parser.add_argument('-i', '--ids', help='Show the ID of each heading', action='store_true')
+    toc_parser.add_argument('-f', '--files', help='Show the source file and line of each heading', action='store_true')
+    toc_parser.add_argument('--format', help='Output format', choices=['text', 'json'], default='text')
+    toc_parser.set_defaults(func=tasks.toc)
+
+    # Create the sub-parser for the 'atom' command
+    atom_parser = subparsers.add_parser('atom', help='Open a module or an assembly using the atom editor')
+    atom_parser.add_argument('FILE', help='Pathname of the assembly or module file to edit')
+    atom_parser.add_argument('-p', '--parent', help='Open the parent assembly of the specified assembly or module', action='store_true')
+    atom_parser.add_argument('-s', '--siblings', help='Open the siblings of the specified assembly or module', action='store_true')
+    atom_parser.add_argument('-c', '--children', help='Open the children of the specified assembly', action='store_true')
+    atom_parser.set_defaults(func=tasks.atom)
+
+    # Create the sub-parser for the 'csv' command
+    csv_parser = subparsers.add_parser('csv', help='Generate CSV of metadata for assembly or book')
+    csv_parser.add_argument('ASSEMBLY_OR_BOOK_FILE', help='Paths of the assembly or book files whose metadata you want to generate as a CSV file', nargs='*')
+    csv_parser.add_argument('--all-books', help='Generate metadata for every book (every master.adoc file)', action='store_true')
+    csv_parser.add_argument('-c', '--cols', help='Specify a comma-separated list of column headers. Rows are then written as soon as each book is processed; otherwise the columns are the union of all metadata fields found')
+    csv_parser.add_argument('-j', '--jobs', help='Number of worker processes (default: one per CPU)', type=int, default=0)
+    csv_parser.set_defaults(func=tasks.csv)
+
+    # Create the sub-parser for the 'export' command
+    export_parser = subparsers.add_parser('export', help='Export metadata for books into an SQLite database or a Parquet file')
+    export_parser.add_argument('BOOK_FILE', help='Paths of the book (or assembly) files to export. Default is every book (every master.adoc file)', nargs='*')
+    export_parser.add_argument('--sqlite', help='SQLite database to create or update. Only files that have changed since the last export are rewritten')
+    export_parser.add_argument('--parquet', help='Parquet file to write (requires the pyarrow package)')
+    export_parser.add_argument('-j', '--jobs', help='Number of worker processes (default: one per CPU)', type=int, default=0)
+    export_parser.set_defaults(func=tasks.export)
+
+    return parser
+
+
+def main(argv=None):
+    # Basic initialization
+    if not os.path.exists('nebel.cfg'):
+        log.warning('No nebel.cfg file found in this directory.')
+        sys.exit()
+    tasks = Tasks(new_context('nebel.cfg'))
+    parser = build_parser(tasks)
+
+    # Now, parse the args and call the relevant sub-command
+    args = parser.parse_args(argv)
+    nebel.log.configure(quiet=args.quiet, verbose=args.verbose, format=args.log_format)
+    args.func(args)
+
+
 # MAIN CODE - PROGRAM STARTS HERE!
 # --------------------------------
-
-# Basic initialization
-if not os.path.exists('nebel.cfg'):
-  print('WARN: No nebel.cfg file found in this directory.')
-  sys.exit()
-context = nebel.context.NebelContext()
-context.initializeFromFile('nebel.cfg')
-this_script_path = os.path.dirname(os.path.abspath(__file__))
-context.templatePath = os.path.abspath(os.path.join(this_script_path, '..', 'template'))
-context.moduleFactory = nebel.factory.ModuleFactory(context)
-tasks = Tasks(context)
-
-# Create the top-level parser
-parser = argparse.ArgumentParser(prog='nebel')
-parser.add_argument('-v', '--version', action='version', version='Nebel 3.0.x (dev release)')
-subparsers = parser.add_subparsers()
-
-# Create the sub-parser for the 'assembly' command
-assembly_parser = subparsers.add_parser('assembly', help='Generate an assembly')
-add_module_arguments(assembly_parser)
-assembly_parser.set_defaults(func=tasks.create_assembly)
-
-# Create the sub-parser for the 'procedure' command
-procedure_parser = subparsers.add_parser('procedure', help='Generate a procedure module')
-add_module_arguments(procedure_parser)
-procedure_parser.set_defaults(func=tasks.create_procedure)
-
-# Create the sub-parser for the 'concept' command
-concept_parser = subparsers.add_parser('concept', help='Generate a concept module')
-add_module_arguments(concept_parser)
-concept_parser.set_defaults(func=tasks.create_concept)
-
-# Create the sub-parser for the 'reference' command
-reference_parser = subparsers.add_parser('reference', help='Generate a reference module')
-add_module_arguments(reference_parser)
-reference_parser.set_defaults(func=tasks.create_reference)
-
-# Create the sub-parser for the 'create-from' command
-create_parser = subparsers.add_parser('create-from', help='Create multiple assemblies/modules from a CSV file, or an assembly file')
-create_parser.add_argument('FROM_FILE', help='Can be either a comma-separated values (CSV) file (ending with .csv), or an assembly file (starting with {}/ and ending with .adoc)'.format(context.ASSEMBLIES_DIR))
-create_parser.set_defaults(func=tasks.create_from)
-
-# Create the sub-parser for the 'split' command
-split_parser = subparsers.add_parser('split', help='Split an annotated AsciiDoc file into multiple assemblies and modules')
-split_parser.add_argument('FROM_FILE', help='Annotated AsciiDoc file (ending with .adoc, including optional wildcard braces, {})')
-split_parser.add_argument('--legacybasedir', help='Base directory for annotated file content. Subdirectories of this directory are used as default categories.')
-split_parser.add_argument('--category-prefix', help='When splitting an annotated file, add this prefix to default categories.')
-split_parser.add_argument('-a', '--attribute-files', help='Specify a comma-separated list of attribute files')
-split_parser.add_argument('--conditions', help='Define a comma-separated list of condition attributes, for resolving ifdef and ifndef directives')
-split_parser.add_argument('--timestamp', help='Generate a timestamp in the generated module and assembly files', action='store_true')
-split_parser.set_defaults(func=tasks.adoc_split)
-
-# Create the sub-parser for the 'book' command
-book_parser = subparsers.add_parser('book', help='Create and manage book directories')
-book_parser.add_argument('BOOK_DIR', help='The book directory')
-book_parser.add_argument('--create', help='Create a new book directory', action='store_true')
-book_parser.add_argument('-c', '--category-list', help='Comma-separated list of categories to add to book (enclose in quotes)')
-book_parser.set_defaults(func=tasks.book)
-
-# Create the sub-parser for the 'mv' command
-book_parser = subparsers.add_parser('mv', help='Move (or rename) module or assembly files. You can optionally use a single instance of braces for globbing/substituting. For example, to change a file prefix from p_ to proc_ you could enter: nebel mv p_{}.adoc proc_{}.adoc')
-book_parser.add_argument('FROM_FILE', help='File origin. Optionally use {} for globbing.')
-book_parser.add_argument('TO_FILE', help='File destination. Optionally use {} to substitute captured glob content')
-book_parser.set_defaults(func=tasks.mv)
-
-# Create the sub-parser for the 'update' command
-update_parser = subparsers.add_parser('update', help='Update metadata in modules and assemblies')
-update_parser.add_argument('--fix-includes', help='Fix erroneous include directives in assemblies', action='store_true')
-update_parser.add_argument('--fix-links', help='Fix erroneous cross-reference links', action='store_true')
-update_parser.add_argument('-p','--parent-assemblies', help='Update ParentAssemblies property in modules and assemblies', action='store_true')
-update_parser.add_argument('--generate-ids', help='Generate missing IDs for headings', action='store_true')
-update_parser.add_argument('--id-prefix', help='Customize ID prefix for IDs generated using --generate-ids')
-update_parser.add_argument('--add-contexts', help='Add _{context} to IDs and add boilerplate around include directives', action='store_true')
-update_parser.add_argument('--hash-contexts', help='Use together with --add-contexts if you want contexts to contain hashes instead of literal IDs', action='store_true')
-update_parser.add_argument('-c', '--category-list', help='Apply update only to this comma-separated list of categories (enclose in quotes)')
-update_parser.add_argument('-b', '--book', help='Apply update only to the specified book')
-update_parser.add_argument('-a', '--attribute-files', help='Specify a comma-separated list of attribute files')
-update_parser.add_argument('FILE', help='File to update OR you can omit this argument and use --book or --category-list instead', nargs='?')
-update_parser.set_defaults(func=tasks.update)
-
-# Create the sub-parser for the 'orphan' command
-orphan_parser = subparsers.add_parser('orphan', help='Search for orphaned module and assembly files')
-orphan_parser.add_argument('-c', '--category-list', help='Filter for orphan files belonging to this comma-separated list of categories')
-orphan_parser.add_argument('-a', '--attribute-files', help='Specify a comma-separated list of attribute files')
-orphan_parser.set_defaults(func=tasks.orphan_search)
-
-# Create the sub-parser for the 'toc' command
-toc_parser = subparsers.add_parser('toc', help='List TOC for assembly or book')
-toc_parser.add_argument('ASSEMBLY_OR_BOOK_FILE', help='Path to the assembly or book file whose table of contents you want to list')
-toc_parser.set_defaults(func=tasks.toc)
-
-# Create the sub-parser for the 'atom' command
-atom_parser = subparsers.add_parser('atom', help='Open a module or an assembly using the atom editor')
-atom_parser.add_argument('FILE', help='Pathname of the assembly or module file to edit')
-atom_parser.add_argument('-p', '--parent', help='Open the parent assembly of the specified assembly or module', action='store_true')
-atom_parser.add_argument('-s', '--siblings', help='Open the siblings of the specified assembly or module', action='store_true')
-atom_parser.add_argument('-c', '--children', help='Open the children of the specified assembly', action='store_true')
-atom_parser.set_defaults(func=tasks.atom)
-
-# Create the sub-parser for the 'csv' command
-csv_parser = subparsers.add_parser('csv', help='Generate CSV of metadata for assembly or book')
-csv_parser.add_argument('ASSEMBLY_OR_BOOK_FILE', help='Path to the assembly or book file whose metadata you want to generate as a CSV file')
-csv_parser.add_argument('-c', '--cols', help='Specify a comma-separated list of column headers')
-csv_parser.set_defaults(func=tasks.csv)
-
-
-# Now, parse the args and call the relevant sub-command
-args = parser.parse_args()
-args.func(args)
+if __name__ == '__main__':
+    main()
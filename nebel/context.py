@@ -9,6 +9,9 @@ from __future__ import print_function
 import re
 import sys
 import six.moves.configparser
+import nebel.log
+
+log = nebel.log.logger
 
 
 class NebelContext:
@@ -42,6 +45,8 @@ class NebelContext:
         self.ASSEMBLIES_DIR = 'assemblies'
         self.MODULES_DIR = 'modules'
         self.IMAGES_DIR = 'images'
+        self.CACHE_DIR = '.nebel'
+        self.CONTEXTS_FILE = 'contexts.json'
         self.ASSEMBLY_PREFIX = 'assembly-'
         self.PROCEDURE_PREFIX = 'proc-'
         self.CONCEPT_PREFIX = 'con-'
@@ -53,6 +58,8 @@ class NebelContext:
             {'dir.assemblies': self.ASSEMBLIES_DIR,
              'dir.modules': self.MODULES_DIR,
              'dir.images': self.IMAGES_DIR,
+             'dir.cache': self.CACHE_DIR,
+             'file.contexts': self.CONTEXTS_FILE,
              'prefix.assembly': self.ASSEMBLY_PREFIX,
              'prefix.procedure': self.PROCEDURE_PREFIX,
              'prefix.concept': self.CONCEPT_PREFIX,
@@ -63,6 +70,8 @@ class NebelContext:
             self.ASSEMBLIES_DIR   = config.get('Nebel', 'dir.assemblies')
             self.MODULES_DIR      = config.get('Nebel', 'dir.modules')
             self.IMAGES_DIR       = config.get('Nebel', 'dir.images')
+            self.CACHE_DIR        = config.get('Nebel', 'dir.cache')
+            self.CONTEXTS_FILE    = config.get('Nebel', 'file.contexts')
             self.ASSEMBLY_PREFIX  = config.get('Nebel', 'prefix.assembly')
             self.PROCEDURE_PREFIX = config.get('Nebel', 'prefix.procedure')
             self.CONCEPT_PREFIX   = config.get('Nebel', 'prefix.concept')
@@ -117,7 +126,7 @@ class NebelContext:
     def replace_matching_attribute(self, match_obj):
         name = match_obj.group(1)
         if name not in self.attributeDict:
-            print('WARNING: Attribute {' + name + '} cannot be resolved.')
+            log.warning('Attribute {' + name + '} cannot be resolved.')
             # Treat it as a literal value in braces
             value = '{' + name + '}'
             self.attributeDict[name] = [value, value]
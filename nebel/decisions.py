@@ -0,0 +1,150 @@
+'''
+Created on October 19, 2026
+
+Non-interactive disambiguation of include paths and anchor IDs.
+'''
+
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import sys
+import json
+import nebel.log
+
+log = nebel.log.logger
+
+
+class Disambiguator:
+    HEURISTICS = ['category', 'nearest', 'book', 'skip']
+
+    def __init__(self, context, heuristics=None, decisionsfile=None, collect=False):
+        self.context = context
+        self.heuristics = heuristics if heuristics is not None else []
+        for heuristic in self.heuristics:
+            if heuristic not in self.HEURISTICS:
+                log.error('Unknown resolution heuristic: ' + heuristic + ' (choose from ' + ','.join(self.HEURISTICS) + ')')
+                sys.exit()
+        self.decisionsfile = decisionsfile
+        self.collect = collect
+        # Decisions are keyed by (kind, file, key), where file is None for global decisions
+        self.decisions = {}
+        # Ambiguities that could not be resolved, in the order they were encountered
+        self.unresolved = []
+        self._recorded = set()
+        # The entries of the decisions file as loaded, answered or not, which save() keeps
+        self.entries = {'includes': [], 'anchors': []}
+        if decisionsfile:
+            if os.path.exists(decisionsfile):
+                self.load(decisionsfile)
+            elif not collect:
+                # Otherwise, every ambiguity would be skipped without notice
+                log.error('Decisions file not found: ' + decisionsfile)
+                sys.exit()
+
+    def is_interactive(self):
+        # Prompt only when the user has not asked for an unattended run
+        return (not self.collect) and (not self.decisionsfile) and ('skip' not in self.heuristics)
+
+    def load(self, decisionsfile):
+        with open(decisionsfile, 'r') as f:
+            data = json.load(f)
+        for kind in ['includes', 'anchors']:
+            for entry in data.get(kind, []):
+                self.entries[kind].append(entry)
+                choice = entry.get('choice')
+                if choice is None or choice == '':
+                    continue
+                if isinstance(choice, bool) or not isinstance(choice, (str, int)):
+                    log.warning('Decision for ' + entry['key'] + ' in ' + decisionsfile + ' must be a candidate or its index, not: ' + json.dumps(choice))
+                    continue
+                candidates = entry.get('candidates', [])
+                if isinstance(choice, int):
+                    if not (0 <= choice < len(candidates)):
+                        log.warning('Decision index out of range for ' + entry['key'] + ' in ' + decisionsfile)
+                        continue
+                    choice = candidates[choice]
+                self.decisions[(kind, entry.get('file'), entry['key'])] = choice
+
+    def save(self, decisionsfile=None):
+        # Writes the loaded entries, with the choices already made, followed by the new unresolved entries.
+        # An unanswered entry that is still unresolved is updated in place with the current candidates.
+        if decisionsfile is None:
+            decisionsfile = self.decisionsfile
+        data = dict((kind, list(entries)) for kind, entries in self.entries.items())
+        positions = {}
+        for kind, entries in data.items():
+            for k, entry in enumerate(entries):
+                positions[(kind, entry.get('file'), entry.get('key'))] = k
+        for kind, fixfile, key, candidates in self.unresolved:
+            newentry = {'file': fixfile, 'key': key, 'candidates': candidates, 'choice': None}
+            k = positions.get((kind, fixfile, key))
+            if k is None:
+                positions[(kind, fixfile, key)] = len(data[kind])
+                data[kind].append(newentry)
+            elif data[kind][k].get('choice') in (None, ''):
+                data[kind][k] = newentry
+        with open(decisionsfile, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.write('\n')
+
+    def resolve(self, kind, fixfile, key, candidates, candidatefiles=None, candidatebooks=None, filebooks=None):
+        # Returns the chosen candidate, or None if the ambiguity remains unresolved
+        choice = self.decisions.get((kind, fixfile, key))
+        if choice is None:
+            choice = self.decisions.get((kind, None, key))
+        if choice is not None:
+            if choice in candidates:
+                return choice
+            log.warning('Recorded decision ' + str(choice) + ' is not a candidate for ' + key + ' in ' + str(fixfile))
+        if candidatefiles is None:
+            candidatefiles = dict((candidate, [candidate]) for candidate in candidates)
+        remaining = list(candidates)
+        for heuristic in self.heuristics:
+            if heuristic == 'category':
+                narrowed = self._narrow_by_category(fixfile, remaining, candidatefiles)
+            elif heuristic == 'nearest':
+                narrowed = self._narrow_by_distance(fixfile, remaining, candidatefiles)
+            elif heuristic == 'book':
+                narrowed = self._narrow_by_book(remaining, candidatebooks, filebooks)
+            else:
+                narrowed = remaining
+            if narrowed:
+                remaining = narrowed
+            if len(remaining) == 1:
+                return remaining[0]
+        return None
+
+    def record(self, kind, fixfile, key, candidates):
+        if (kind, fixfile, key) not in self._recorded:
+            self._recorded.add((kind, fixfile, key))
+            self.unresolved.append((kind, fixfile, key, list(candidates)))
+
+    def category_of_file(self, filepath):
+        file_pieces = os.path.normpath(filepath).split(os.sep)
+        if (file_pieces[0] == self.context.ASSEMBLIES_DIR) or (file_pieces[0] == self.context.MODULES_DIR):
+            return os.sep.join(file_pieces[1:-1])
+        return None
+
+    def _narrow_by_category(self, fixfile, candidates, candidatefiles):
+        category = self.category_of_file(fixfile)
+        if category is None:
+            return []
+        return [candidate for candidate in candidates
+                if any(self.category_of_file(path) == category for path in candidatefiles.get(candidate, []))]
+
+    def _narrow_by_distance(self, fixfile, candidates, candidatefiles):
+        basedir = os.path.dirname(fixfile)
+        distances = {}
+        for candidate in candidates:
+            paths = candidatefiles.get(candidate, [])
+            if paths:
+                distances[candidate] = min(len(os.path.relpath(path, basedir).split(os.sep)) for path in paths)
+        if not distances:
+            return []
+        nearest = min(distances.values())
+        return [candidate for candidate in candidates if distances.get(candidate) == nearest]
+
+    def _narrow_by_book(self, candidates, candidatebooks, filebooks):
+        if not candidatebooks or not filebooks:
+            return []
+        return [candidate for candidate in candidates if candidatebooks.get(candidate, set()) & filebooks]
@@ -0,0 +1,132 @@
+'''
+Created on October 19, 2026
+
+Columnar export of module metadata, to an SQLite database or (if the
+optional pyarrow package is installed) to a Parquet file.
+'''
+
+from __future__ import absolute_import
+import os
+import sys
+import hashlib
+import sqlite3
+import nebel.log
+
+log = nebel.log.logger
+
+
+def metadata_columns(context):
+    # Fixed leading columns, followed by the remaining optional metadata fields
+    columns = ['Book', 'FilePath', 'ModuleID', 'Type', 'Category', 'Title', 'Context', 'Level']
+    columns.extend(sorted(context.optionalMetadataFields - set(columns)))
+    return columns
+
+
+class SqliteExport:
+    INDEXED_COLUMNS = ['FilePath', 'ModuleID', 'Type', 'Category', 'ConversionStatus']
+
+    def __init__(self, context, dbpath):
+        self.columns = metadata_columns(context)
+        self.connection = sqlite3.connect(dbpath)
+        self.changed = 0
+        self.unchanged = 0
+        self._create_schema()
+
+    def _create_schema(self):
+        coldefs = []
+        for column in self.columns:
+            if column == 'Level':
+                coldefs.append('Level INTEGER')
+            else:
+                coldefs.append(column + ' TEXT')
+        cursor = self.connection.cursor()
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS modules (' + ', '.join(coldefs) + ', PRIMARY KEY (Book, FilePath, ModuleID))'
+        )
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS files (Book TEXT, FilePath TEXT, MTime INTEGER, Size INTEGER, Digest TEXT, PRIMARY KEY (Book, FilePath))'
+        )
+        for column in self.INDEXED_COLUMNS:
+            cursor.execute('CREATE INDEX IF NOT EXISTS modules_' + column + ' ON modules (' + column + ')')
+        self.connection.commit()
+
+    def _row(self, metadata):
+        row = []
+        for column in self.columns:
+            value = metadata.get(column)
+            if column == 'Level' and value is not None:
+                value = int(value)
+            row.append(value)
+        return tuple(row)
+
+    def upsert(self, book, metadata_list):
+        # Replaces the rows of each file in the book, but only if the file or its rows have changed
+        rowsbyfile = {}
+        for metadata in metadata_list:
+            rowsbyfile.setdefault(metadata['FilePath'], []).append(self._row(metadata))
+        cursor = self.connection.cursor()
+        stored = {}
+        for filepath, mtime, size, digest in cursor.execute('SELECT FilePath, MTime, Size, Digest FROM files WHERE Book = ?', (book,)):
+            stored[filepath] = (mtime, size, digest)
+        placeholders = ', '.join(['?'] * len(self.columns))
+        for filepath, rows in rowsbyfile.items():
+            st = os.stat(filepath)
+            digest = hashlib.sha256(repr(sorted(rows, key=repr)).encode('UTF-8')).hexdigest()
+            if stored.get(filepath) == (st.st_mtime_ns, st.st_size, digest):
+                self.unchanged += 1
+                continue
+            cursor.execute('DELETE FROM modules WHERE Book = ? AND FilePath = ?', (book, filepath))
+            cursor.executemany('INSERT OR REPLACE INTO modules VALUES (' + placeholders + ')', rows)
+            cursor.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', (book, filepath, st.st_mtime_ns, st.st_size, digest))
+            self.changed += 1
+        # Remove files that the book no longer includes
+        for filepath in set(stored) - set(rowsbyfile):
+            cursor.execute('DELETE FROM modules WHERE Book = ? AND FilePath = ?', (book, filepath))
+            cursor.execute('DELETE FROM files WHERE Book = ? AND FilePath = ?', (book, filepath))
+            self.changed += 1
+        self.connection.commit()
+
+    def prune_books(self, books):
+        # Remove all rows of books that are not in 'books'
+        cursor = self.connection.cursor()
+        for (book,) in cursor.execute('SELECT DISTINCT Book FROM files').fetchall():
+            if book not in books:
+                cursor.execute('DELETE FROM modules WHERE Book = ?', (book,))
+                cursor.execute('DELETE FROM files WHERE Book = ?', (book,))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+class ParquetExport:
+    def __init__(self, context, parquetpath):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            log.error('Parquet export requires the pyarrow package (pip install pyarrow)')
+            sys.exit()
+        self.pyarrow = pyarrow
+        self.columns = metadata_columns(context)
+        self.parquetpath = parquetpath
+        self.data = dict((column, []) for column in self.columns)
+
+    def append(self, book, metadata_list):
+        for metadata in metadata_list:
+            for column in self.columns:
+                value = metadata.get(column)
+                if column == 'Level' and value is not None:
+                    value = int(value)
+                self.data[column].append(value)
+
+    def close(self):
+        import pyarrow.parquet
+        fields = []
+        for column in self.columns:
+            if column == 'Level':
+                fields.append(self.pyarrow.field(column, self.pyarrow.int32()))
+            else:
+                fields.append(self.pyarrow.field(column, self.pyarrow.string()))
+        table = self.pyarrow.Table.from_pydict(self.data, schema=self.pyarrow.schema(fields))
+        pyarrow.parquet.write_table(table, self.parquetpath)
@@ -9,10 +9,18 @@ from __future__ import print_function
 import os
 import sys
 import re
+import nebel.log
+
+log = nebel.log.logger
 
 class ModuleFactory:
     def __init__(self, context):
         self.context = context
+        # When set to a list, 'create' appends (filepath, contents) pairs to it instead of writing files
+        self.collector = None
+        # Template lines by module type, and directories already created, for the current run
+        self._templates = {}
+        self._createddirs = set()
 
     def lreplace(self, pat, sub, target):
         if target.startswith(pat):
@@ -30,7 +38,7 @@ class ModuleFactory:
             regexp = re.compile(r'[_\-]+$')
             result = regexp.search(tmpstr)
             if result is None:
-                print('ERROR: Cannot parse ModuleID: ' + moduleid)
+                log.error('Cannot parse ModuleID: ' + moduleid)
                 sys.exit()
             coremoduleid = regexp.sub('', tmpstr)
         coremoduleid = coremoduleid.replace('_', '-')
@@ -59,7 +67,7 @@ class ModuleFactory:
         elif type in ['procedure', 'concept', 'reference', 'module']:
             return os.path.join(self.context.MODULES_DIR, category)
         else:
-            print('ERROR: Unknown module Type: ' + str(type))
+            log.error('Unknown module Type: ' + str(type))
             sys.exit()
 
     def module_or_assembly_path(self, metadata):
@@ -69,42 +77,69 @@ class ModuleFactory:
         type = metadata['Type'].lower()
         filename = self.name_of_file(metadata)
         dirpath = self.module_dirpath(metadata)
-        if not os.path.exists(dirpath):
-            os.makedirs(dirpath)
         filepath = os.path.join(dirpath, filename)
-        if os.path.exists(filepath) and not clobber:
-            print('INFO: File already exists, skipping: ' + filename)
+        if self.collector is not None:
+            # Collect the file contents instead of writing the file (see Tasks.adoc_split)
+            self.collector.append((filepath, self.render(metadata, type, dirpath, filecontents)))
             return filepath
-        with open(filepath, 'w') as filehandle:
-            filehandle.write('// Metadata created by nebel\n')
-            filehandle.write('//\n')
-            for field in self.context.optionalMetadataFields:
-                if (field in metadata) and (field.lower() != 'title') and (field.lower() != 'includefiles'):
-                    filehandle.write('// ' + field + ': ' + metadata[field] + '\n')
-            filehandle.write('\n')
-            filehandle.write('[id="' + metadata['ModuleID'] + '"]\n')
-            if filecontents is not None:
-                # If filecontents is provided, write the contents verbatim
-                filehandle.write('= ' + metadata['Title'] + '\n')
-                filehandle.writelines(filecontents)
-                return filepath
-            elif type == 'module':
-                # Cannot use a template, because we do not know the exact module type
-                filehandle.write('= ' + metadata['Title'] + '\n')
-                return filepath
-            else:
-                # Generate contents from template
-                templatefile = os.path.join(self.context.templatePath, type + '.adoc')
-                with open(templatefile, 'r') as templatehandle:
-                    if 'Title' in metadata:
-                        # Replace the title from the first line of the template
-                        templatehandle.readline()
-                        filehandle.write('= ' + metadata['Title'] + '\n')
-                    # Process the rest of the file
-                    for line in templatehandle:
-                        if line.startswith('//INCLUDE') and ('IncludeFiles' in metadata):
-                            for includedfilepath in metadata['IncludeFiles'].split(','):
-                                filehandle.write('include::' + os.path.relpath(includedfilepath, dirpath) + '[leveloffset=+1]\n\n')
-                        else:
-                            filehandle.write(line)
+        self._makedirs(dirpath)
+        if (not clobber) and os.path.exists(filepath):
+            log.info('File already exists, skipping: ' + filename)
+            return filepath
+        self._write_file(filepath, self.render(metadata, type, dirpath, filecontents))
         return filepath
+
+    def render(self, metadata, type, dirpath, filecontents = None):
+        # Returns the complete contents of the module or assembly file as a single string
+        chunks = ['// Metadata created by nebel\n', '//\n']
+        # Sorted, because the iteration order of a set of strings changes from one process to another
+        for field in sorted(self.context.optionalMetadataFields):
+            if (field in metadata) and (field.lower() != 'title') and (field.lower() != 'includefiles'):
+                chunks.append('// ' + field + ': ' + metadata[field] + '\n')
+        chunks.append('\n')
+        chunks.append('[id="' + metadata['ModuleID'] + '"]\n')
+        if filecontents is not None:
+            # If filecontents is provided, write the contents verbatim
+            chunks.append('= ' + metadata['Title'] + '\n')
+            chunks.extend(filecontents)
+        elif type == 'module':
+            # Cannot use a template, because we do not know the exact module type
+            chunks.append('= ' + metadata['Title'] + '\n')
+        else:
+            # Generate contents from template
+            templatelines = self._template_lines(type)
+            if 'Title' in metadata:
+                # Replace the title from the first line of the template
+                chunks.append('= ' + metadata['Title'] + '\n')
+                templatelines = templatelines[1:]
+            for line in templatelines:
+                if line.startswith('//INCLUDE') and ('IncludeFiles' in metadata):
+                    for includedfilepath in metadata['IncludeFiles'].split(','):
+                        chunks.append('include::' + os.path.relpath(includedfilepath, dirpath) + '[leveloffset=+1]\n\n')
+                else:
+                    chunks.append(line)
+        return ''.join(chunks)
+
+    def _template_lines(self, type):
+        # Each template file is read only once
+        if type not in self._templates:
+            templatefile = os.path.join(self.context.templatePath, type + '.adoc')
+            with open(templatefile, 'r') as templatehandle:
+                self._templates[type] = templatehandle.readlines()
+        return self._templates[type]
+
+    def _makedirs(self, dirpath):
+        # Remembers the directories that are known to exist
+        if dirpath and dirpath not in self._createddirs:
+            if not os.path.exists(dirpath):
+                os.makedirs(dirpath)
+            self._createddirs.add(dirpath)
+
+    def _write_file(self, filepath, contents):
+        with open(filepath, 'w') as filehandle:
+            filehandle.write(contents)
+
+    def write_collected(self, filepath, contents):
+        # Writes file contents that were collected by 'create'
+        self._makedirs(os.path.dirname(filepath))
+        self._write_file(filepath, contents)
@@ -0,0 +1,360 @@
+'''
+Created on October 19, 2026
+
+Compact in-memory tables of a content repository: the include graph, the
+image references, the anchor IDs defined in each book, and the metadata of
+each heading. Paths and IDs are interned as small integers and stored only
+once, and adjacency lists are arrays of integers, so that repositories with
+100k+ files fit in memory.
+'''
+
+from __future__ import absolute_import
+from array import array
+
+_MISSING = object()
+
+
+class InternTable:
+    # Numbers each distinct string in order of arrival, so that it is stored only once
+    __slots__ = ('strings', 'numbers')
+
+    def __init__(self):
+        self.strings = []
+        self.numbers = {}
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __contains__(self, string):
+        return string in self.numbers
+
+    def __getitem__(self, number):
+        return self.strings[number]
+
+    def intern(self, string):
+        number = self.numbers.get(string)
+        if number is None:
+            number = self.numbers[string] = len(self.strings)
+            self.strings.append(string)
+        return number
+
+    def number(self, string):
+        # Returns the number of 'string', or None if it is not in the table
+        return self.numbers.get(string)
+
+
+class IncludeGraph:
+    def __init__(self):
+        self.paths = InternTable()
+        # Node number -> array of the nodes that it includes, and array of the nodes that include it,
+        # in the order in which the edges were added
+        self._children = []
+        self._parents = []
+        self._roots = set()
+        # Set of (parent node, child node) pairs, so that a unique edge is found without scanning the arrays
+        self._edges = set()
+
+    def node(self, filepath):
+        # Returns the node number of 'filepath', adding the node if necessary
+        number = self.paths.intern(filepath)
+        if number == len(self._children):
+            self._children.append(array('i'))
+            self._parents.append(array('i'))
+        return number
+
+    def add_root(self, filepath):
+        self._roots.add(self.node(filepath))
+
+    @property
+    def roots(self):
+        return set(self.paths[node] for node in self._roots)
+
+    def is_root(self, filepath):
+        return self.paths.number(filepath) in self._roots
+
+    def add_edge(self, parent, child, unique=True):
+        # With unique=False, an edge that is added twice is also listed twice, as for a file that includes another file twice
+        parentnode = self.node(parent)
+        childnode = self.node(child)
+        edge = (parentnode, childnode)
+        if unique and (edge in self._edges):
+            return
+        self._edges.add(edge)
+        self._children[parentnode].append(childnode)
+        self._parents[childnode].append(parentnode)
+
+    def has_node(self, filepath):
+        return filepath in self.paths
+
+    def children(self, filepath):
+        # Returns the files that 'filepath' includes, in order
+        return self._neighbours(filepath, self._children)
+
+    def parents(self, filepath):
+        # Returns the files that include 'filepath', in order
+        return self._neighbours(filepath, self._parents)
+
+    def parent_nodes(self, filepath):
+        # Returns the node numbers of the files that include 'filepath'
+        node = self.paths.number(filepath)
+        if node is None:
+            return ()
+        return self._parents[node]
+
+    def ancestors(self, filepaths):
+        # Returns the set of files that transitively include any of 'filepaths', including those files themselves
+        return self._closure(filepaths, self._parents)
+
+    def descendants(self, filepaths):
+        # Returns the set of files transitively included by any of 'filepaths', including those files themselves
+        return self._closure(filepaths, self._children)
+
+    def _neighbours(self, filepath, adjacency):
+        node = self.paths.number(filepath)
+        if node is None:
+            return []
+        return [self.paths[neighbour] for neighbour in adjacency[node]]
+
+    def _closure(self, filepaths, adjacency):
+        result = set(filepaths)
+        seen = set()
+        for filepath in result:
+            node = self.paths.number(filepath)
+            if node is not None:
+                seen.add(node)
+        stack = list(seen)
+        while stack:
+            node = stack.pop()
+            for neighbour in adjacency[node]:
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    stack.append(neighbour)
+        result.update(self.paths[node] for node in seen)
+        return result
+
+
+class ImageIndex:
+    def __init__(self):
+        self.paths = InternTable()
+        # Image number -> list of (file number, line number) for each reference to the image
+        self._references = {}
+
+    def add_reference(self, imagepath, filepath, lineno):
+        reference = (self.paths.intern(filepath), lineno)
+        references = self._references.setdefault(self.paths.intern(imagepath), [])
+        if reference not in references:
+            references.append(reference)
+
+    def extend(self, other):
+        # Adds the references of 'other', after those of this index
+        for imagenumber, references in other._references.items():
+            for filenumber, lineno in references:
+                self.add_reference(other.paths[imagenumber], other.paths[filenumber], lineno)
+
+    def images(self):
+        # Returns the referenced image files, in order of their first reference
+        return [self.paths[number] for number in self._references]
+
+    def is_referenced(self, imagepath):
+        number = self.paths.number(imagepath)
+        return (number is not None) and (number in self._references)
+
+    def references(self, imagepath):
+        # Returns (filepath, lineno) for each reference to 'imagepath'
+        number = self.paths.number(imagepath)
+        return [(self.paths[filenumber], lineno) for filenumber, lineno in self._references.get(number, ())]
+
+
+class Anchor:
+    # Definition of an anchor ID in one book, where 'book' and 'file' are numbers in the
+    # book and path tables of the AnchorIndex. The title and context are only set for headings.
+    __slots__ = ('book', 'file', 'title', 'context')
+
+    def __init__(self, book, file, title=None, context=None):
+        self.book = book
+        self.file = file
+        self.title = title
+        self.context = context
+
+
+class AnchorIndex:
+    def __init__(self):
+        self.ids = InternTable()
+        self.books = InternTable()
+        self.paths = InternTable()
+        # ID number -> list of Anchor records (one per book), legacy ID number -> ID number,
+        # and root ID number -> array of the ID numbers that have _{context} appended to the root ID
+        self._anchors = {}
+        self._legacy = {}
+        self._roots = {}
+        # (ID number, book number) -> position of the Anchor record in the list of the ID
+        self._positions = {}
+        self._booksoffile = None
+
+    def __contains__(self, anchorid):
+        number = self.ids.number(anchorid)
+        return (number is not None) and (number in self._anchors)
+
+    def path(self, filepath):
+        # Returns the interned copy of 'filepath'
+        return self.paths[self.paths.intern(filepath)]
+
+    def add(self, anchorid, book, filepath, title=None, context=None):
+        # Returns False (and adds nothing) if 'anchorid' is already defined in 'book'
+        number = self.ids.intern(anchorid)
+        booknumber = self.books.intern(book)
+        if (number, booknumber) in self._positions:
+            return False
+        anchors = self._anchors.setdefault(number, [])
+        self._positions[(number, booknumber)] = len(anchors)
+        anchors.append(Anchor(booknumber, self.paths.intern(filepath), title, context))
+        self._booksoffile = None
+        return True
+
+    def add_legacy_id(self, legacyid, anchorid):
+        self._legacy[self.ids.intern(legacyid)] = self.ids.intern(anchorid)
+
+    def legacy_target(self, legacyid):
+        # Returns the ID that replaced 'legacyid', or None
+        number = self.ids.number(legacyid)
+        if (number is None) or (number not in self._legacy):
+            return None
+        return self.ids[self._legacy[number]]
+
+    def add_to_root(self, rootid, anchorid):
+        number = self.ids.intern(rootid)
+        if number not in self._roots:
+            self._roots[number] = array('i')
+        self._roots[number].append(self.ids.intern(anchorid))
+
+    def has_root(self, rootid):
+        number = self.ids.number(rootid)
+        return (number is not None) and (number in self._roots)
+
+    def ids_of_root(self, rootid):
+        # Returns the IDs that have _{context} appended to 'rootid', or an empty list for an unknown root ID
+        number = self.ids.number(rootid)
+        if (number is None) or (number not in self._roots):
+            return []
+        return [self.ids[number] for number in self._roots[number]]
+
+    def files_of(self, anchorid):
+        # Returns the files that define 'anchorid', one for each book that it is defined in
+        number = self.ids.number(anchorid)
+        return [self.paths[anchor.file] for anchor in self._anchors.get(number, ())]
+
+    def books_of(self, anchorid):
+        number = self.ids.number(anchorid)
+        return set(self.books[anchor.book] for anchor in self._anchors.get(number, ()))
+
+    def books_of_file(self, filepath):
+        # Returns the books in which 'filepath' defines any anchor
+        if self._booksoffile is None:
+            # Lazily invert the anchor table
+            self._booksoffile = {}
+            for anchors in self._anchors.values():
+                for anchor in anchors:
+                    self._booksoffile.setdefault(anchor.file, set()).add(anchor.book)
+        number = self.paths.number(filepath)
+        return set(self.books[book] for book in self._booksoffile.get(number, ()))
+
+    def extend(self, other):
+        # Adds the tables of 'other' as if its anchors had been added after those of this index: an anchor
+        # that is already defined in the same book is skipped, together with its legacy and root IDs.
+        # Returns the skipped anchor IDs.
+        skipped = []
+        added = set()
+        for number, otheranchors in other._anchors.items():
+            for otheranchor in otheranchors:
+                if self.add(other.ids[number], other.books[otheranchor.book], other.paths[otheranchor.file], otheranchor.title, otheranchor.context):
+                    added.add(number)
+                else:
+                    skipped.append(other.ids[number])
+        for legacynumber, number in other._legacy.items():
+            if number in added:
+                self.add_legacy_id(other.ids[legacynumber], other.ids[number])
+        for rootnumber, othernumbers in other._roots.items():
+            for number in othernumbers:
+                if number in added:
+                    self.add_to_root(other.ids[rootnumber], other.ids[number])
+        return skipped
+
+    def merge(self, other):
+        # Adds the tables of 'other': an anchor that both define in the same book takes the
+        # definition from 'other', and root ID lists only gain IDs that they do not contain yet
+        for number, otheranchors in other._anchors.items():
+            number = self.ids.intern(other.ids[number])
+            anchors = self._anchors.setdefault(number, [])
+            for otheranchor in otheranchors:
+                anchor = Anchor(self.books.intern(other.books[otheranchor.book]), self.paths.intern(other.paths[otheranchor.file]), otheranchor.title, otheranchor.context)
+                k = self._positions.get((number, anchor.book))
+                if k is not None:
+                    anchors[k] = anchor
+                else:
+                    self._positions[(number, anchor.book)] = len(anchors)
+                    anchors.append(anchor)
+        for legacynumber, number in other._legacy.items():
+            self._legacy[self.ids.intern(other.ids[legacynumber])] = self.ids.intern(other.ids[number])
+        for rootnumber, othernumbers in other._roots.items():
+            rootnumber = self.ids.intern(other.ids[rootnumber])
+            if rootnumber not in self._roots:
+                self._roots[rootnumber] = array('i')
+            numbers = self._roots[rootnumber]
+            present = set(numbers)
+            for number in othernumbers:
+                number = self.ids.intern(other.ids[number])
+                if number not in present:
+                    present.add(number)
+                    numbers.append(number)
+        self._booksoffile = None
+
+
+class MetadataRecord:
+    # Metadata of a heading with an ID, with the read and write access of a dict. The fields that
+    # every heading has are slots, and any other metadata fields (from '// Name: value' comments)
+    # are kept in a dict, which is None for headings without such comments.
+    FIXED_FIELDS = ('Type', 'Title', 'ModuleID', 'Context', 'Level', 'FilePath', 'Category', 'Book')
+    __slots__ = FIXED_FIELDS + ('fields',)
+
+    def __init__(self, fields=None):
+        self.fields = fields or None
+        # A comment can also set a fixed field (such as '// Level: 2'), which is kept in the dict for its order
+        if self.fields is not None:
+            for name in self.FIXED_FIELDS:
+                if name in self.fields:
+                    setattr(self, name, self.fields[name])
+
+    def get(self, name, default=None):
+        if name in self.FIXED_FIELDS:
+            return getattr(self, name, default)
+        if self.fields is None:
+            return default
+        return self.fields.get(name, default)
+
+    def __getitem__(self, name):
+        value = self.get(name, _MISSING)
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
+
+    def __setitem__(self, name, value):
+        if name in self.FIXED_FIELDS:
+            setattr(self, name, value)
+            if (self.fields is not None) and (name in self.fields):
+                self.fields[name] = value
+        else:
+            if self.fields is None:
+                self.fields = {}
+            self.fields[name] = value
+
+    def __contains__(self, name):
+        return self.get(name, _MISSING) is not _MISSING
+
+    def keys(self):
+        # In the same order as the keys of a dict with the same history: comment fields first
+        keys = list(self.fields) if self.fields is not None else []
+        keys.extend(name for name in self.FIXED_FIELDS if (name not in keys) and hasattr(self, name))
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
@@ -0,0 +1,132 @@
+'''
+Created on October 19, 2026
+
+Logging surface for Nebel. Messages are buffered in memory and written in
+batches, either as plain text lines (the default) or as JSON lines.
+'''
+
+from __future__ import absolute_import
+import sys
+import json
+import logging
+import contextlib
+
+logger = logging.getLogger('nebel')
+
+# Structured fields that callers can attach to a message with extra={...}
+FIELDS = ('file', 'line', 'book', 'id')
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        message = record.getMessage()
+        if record.levelno <= logging.INFO:
+            return message
+        return record.levelname + ': ' + message
+
+
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'level': record.levelname.lower(), 'message': record.getMessage()}
+        for field in FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        return json.dumps(entry)
+
+
+class BufferedStreamHandler(logging.StreamHandler):
+    # Unlike logging.StreamHandler, does not flush the stream after every record
+    def __init__(self, stream, capacity=1024):
+        logging.StreamHandler.__init__(self, stream)
+        self.capacity = capacity
+        self.buffer = []
+
+    def emit(self, record):
+        try:
+            self.buffer.append(self.format(record) + self.terminator)
+            if (len(self.buffer) >= self.capacity) or (record.levelno >= logging.ERROR):
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.buffer:
+                self.stream.write(''.join(self.buffer))
+                self.buffer = []
+            if self.stream and hasattr(self.stream, 'flush'):
+                self.stream.flush()
+        finally:
+            self.release()
+
+
+def configure(quiet=False, verbose=False, format='text', stream=None, capacity=1024):
+    # Quiet mode only shows warnings and errors; errors are written out immediately. Messages go to
+    # standard error by default, so that they do not mix with the output of commands such as 'toc'.
+    if stream is None:
+        stream = sys.stderr
+    handler = BufferedStreamHandler(stream, capacity)
+    if format == 'json':
+        handler.setFormatter(JsonLinesFormatter())
+    else:
+        handler.setFormatter(TextFormatter())
+    logger.handlers = [handler]
+    logger.propagate = False
+    if quiet:
+        logger.setLevel(logging.WARNING)
+    elif verbose:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+
+def flush():
+    # Write out buffered messages, for example before prompting or writing results
+    for handler in logger.handlers:
+        handler.flush()
+
+
+@contextlib.contextmanager
+def configured(**options):
+    # Configures logging as configure(**options) does for the duration of a 'with' block, then writes out
+    # the buffered messages and restores the previous configuration (for example, that of a host program)
+    saved = (logger.handlers, logger.propagate, logger.level)
+    configure(**options)
+    try:
+        yield
+    finally:
+        flush()
+        logger.handlers, logger.propagate, level = saved
+        logger.setLevel(level)
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self, level):
+        logging.Handler.__init__(self, level)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@contextlib.contextmanager
+def recorded(level=logging.WARNING):
+    # Yields a list that collects the messages of at least 'level' that are logged in a 'with' block (they
+    # are also logged as usual), as picklable (level, message, fields) tuples that replay() logs again
+    handler = RecordingHandler(level)
+    messages = []
+    logger.addHandler(handler)
+    try:
+        yield messages
+    finally:
+        logger.removeHandler(handler)
+        for record in handler.records:
+            fields = dict((field, getattr(record, field)) for field in FIELDS if hasattr(record, field))
+            messages.append((record.levelno, record.getMessage(), fields))
+
+
+def replay(messages):
+    # Logs the messages collected by recorded() again
+    for level, message, fields in messages:
+        logger.log(level, message, extra=fields)
@@ -0,0 +1,52 @@
+'''
+Created on October 19, 2026
+
+Runs Tasks methods in a pool of worker processes. Each worker builds its
+own Tasks instance (and hence its own attribute context) once, so that
+only the method arguments and results cross process boundaries.
+'''
+
+from __future__ import absolute_import
+import os
+from concurrent.futures import ProcessPoolExecutor
+import nebel.log
+
+_worker_tasks = None
+
+
+def _init_worker(taskclass, context):
+    global _worker_tasks
+    _worker_tasks = taskclass(context)
+
+
+def _call_worker(methodname, args):
+    try:
+        return getattr(_worker_tasks, methodname)(*args)
+    finally:
+        # Worker processes exit without running atexit handlers, so flush log messages here
+        nebel.log.flush()
+
+
+def jobs_count(jobs):
+    # A jobs value of 0 (or None) means one job per CPU
+    if not jobs:
+        return os.cpu_count() or 1
+    return jobs
+
+
+def map_tasks(tasks, methodname, arglist, jobs=1, chunksize=1):
+    # Generator that yields the results of tasks.<methodname>(*args) for each
+    # args tuple in arglist, in the same order as arglist
+    arglist = list(arglist)
+    if jobs <= 1 or len(arglist) <= 1:
+        method = getattr(tasks, methodname)
+        for args in arglist:
+            yield method(*args)
+        return
+    with ProcessPoolExecutor(
+            max_workers=min(jobs, len(arglist)),
+            initializer=_init_worker,
+            initargs=(type(tasks), tasks.context)
+    ) as executor:
+        for result in executor.map(_call_worker, [methodname] * len(arglist), arglist, chunksize=chunksize):
+            yield result
@@ -0,0 +1,94 @@
+'''
+Created on October 19, 2026
+
+Persistent registry of the context hashes assigned to root IDs by
+'update --add-contexts', which keeps hashes unique across the repository.
+The registry is part of the content (it lives outside the cache directory),
+since a hash that has been used in an assembly must never change.
+'''
+
+from __future__ import absolute_import
+import os
+import json
+import hashlib
+import tempfile
+import nebel.log
+
+log = nebel.log.logger
+
+
+class ContextRegistry:
+    # Length of a hash when it does not collide with the hash of another root ID
+    HASH_LENGTH = 6
+
+    def __init__(self, context):
+        self.path = context.CONTEXTS_FILE
+        # Root ID -> hash, and hash -> root ID
+        self.hashes = {}
+        self.rootids = {}
+        self.dirty = False
+        self.exists = os.path.exists(self.path)
+        self.load()
+
+    def load(self):
+        if not self.exists:
+            return
+        with open(self.path, 'r') as f:
+            data = json.load(f)
+        for rootid, hash in data.get('hashes', {}).items():
+            if hash in self.rootids:
+                log.warning('Context hash ' + hash + ' is registered for both ' + self.rootids[hash] + ' and ' + rootid + ' in ' + self.path)
+                continue
+            self.hashes[rootid] = hash
+            self.rootids[hash] = rootid
+
+    def save(self):
+        if not self.dirty:
+            return
+        registrydir = os.path.dirname(self.path)
+        if registrydir and not os.path.exists(registrydir):
+            os.makedirs(registrydir)
+        # Write to a temp file first, so that an interrupted run cannot corrupt the registry
+        fh, abs_path = tempfile.mkstemp(dir=registrydir or os.curdir)
+        with os.fdopen(fh, 'w') as f:
+            json.dump({'version': 1, 'hashes': self.hashes}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        os.replace(abs_path, self.path)
+        self.dirty = False
+
+    def register(self, rootid, hash, filepath):
+        # Registers an existing 'hash' of 'rootid', found in 'filepath'. Returns False (and registers
+        # nothing) if either the root ID or the hash is already registered with something else.
+        if self.rootids.get(hash, rootid) != rootid:
+            log.warning('Context hash ' + hash + ' is used for both ' + self.rootids[hash] + ' and ' + rootid, extra={'file': filepath})
+            return False
+        if self.hashes.get(rootid, hash) != hash:
+            log.warning('Root ID ' + rootid + ' has both context hashes ' + self.hashes[rootid] + ' and ' + hash, extra={'file': filepath})
+            return False
+        if rootid not in self.hashes:
+            self.hashes[rootid] = hash
+            self.rootids[hash] = rootid
+            self.dirty = True
+        return True
+
+    def lookup(self, rootid):
+        # Returns the registered hash for 'rootid', or None
+        return self.hashes.get(rootid)
+
+    def hash_of(self, rootid):
+        # Returns the hash registered for 'rootid', registering a new one if necessary. A new hash is
+        # the first HASH_LENGTH hex digits of the SHA-256 of the root ID, extended by one digit at a
+        # time for as long as it collides with the hash of another root ID.
+        hash = self.hashes.get(rootid)
+        if hash is not None:
+            return hash
+        digest = hashlib.sha256(rootid.encode('UTF-8')).hexdigest()
+        length = self.HASH_LENGTH
+        while digest[:length] in self.rootids:
+            log.info('Context hash ' + digest[:length] + ' of ' + rootid + ' collides with ' + self.rootids[digest[:length]] + ': extending it')
+            length += 1
+        hash = digest[:length]
+        self.hashes[rootid] = hash
+        self.rootids[hash] = rootid
+        self.dirty = True
+        return hash
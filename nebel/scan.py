@@ -0,0 +1,119 @@
+'''
+Created on October 19, 2026
+
+Fast scanning of AsciiDoc files. Each file is memory-mapped and searched
+with compiled regular expressions, so that only the lines that can matter
+to a scanner are decoded and passed to its per-line state machine.
+'''
+
+from __future__ import absolute_import
+import re
+import mmap
+import heapq
+import locale
+import contextlib
+
+# Lines are decoded with the same encoding that open() uses by default
+ENCODING = locale.getpreferredencoding(False)
+
+# Leading whitespace, as matched by \s in a str regular expression. Any non-ASCII byte is
+# accepted, so that no Unicode space is missed; scanners check the decoded line exactly.
+_LEADING_SPACE = rb'(?:[^\S\n]|[\x1c-\x1f\x80-\xff])*'
+
+# Line types recognised by the scanners, as (at_line_start, pattern) pairs
+TITLE = (True, rb'=')
+ATTRIBUTE = (True, rb':')
+COMMENT = (True, _LEADING_SPACE + rb'//')
+INCLUDE = (True, _LEADING_SPACE + rb'include::')
+ANCHOR = (False, rb'\[(?:\[|id)')
+
+# A character that is certainly not whitespace
+_NONBLANK = re.compile(rb'[^\s\x1c-\x1f\x80-\xff]')
+
+
+class Prefilter:
+    # Patterns at the start of a line are searched for as a newline followed by the pattern,
+    # which lets the regular expression engine skip quickly from one newline to the next.
+    # Other patterns should start with a literal character, for the same reason.
+    def __init__(self, patterns):
+        linestart = [pattern for at_line_start, pattern in patterns if at_line_start]
+        inline = [pattern for at_line_start, pattern in patterns if not at_line_start]
+        self.linestart = re.compile(rb'\n(?:' + b'|'.join(linestart) + b')') if linestart else None
+        self.inline = re.compile(b'|'.join(inline)) if inline else None
+
+    def line_starts(self, buf):
+        # Yields the start offset of each candidate line, in increasing order (possibly repeated).
+        # The first line is always a candidate, because it does not follow a newline.
+        streams = []
+        if self.linestart is not None:
+            streams.append(match.start() + 1 for match in self.linestart.finditer(buf))
+        if self.inline is not None:
+            streams.append(buf.rfind(b'\n', 0, match.start()) + 1 for match in self.inline.finditer(buf))
+        yield 0
+        for start in heapq.merge(*streams):
+            yield start
+
+
+def prefilter(*patterns):
+    # Combines line types into a prefilter for interesting_lines()
+    return Prefilter(patterns)
+
+
+@contextlib.contextmanager
+def mapped(filepath):
+    # Yields the contents of the file as a read-only memory map (or b'' for an empty file)
+    with open(filepath, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            yield b''
+            return
+        try:
+            yield buf
+        finally:
+            buf.close()
+
+
+def interesting_lines(filepath, prefilter):
+    # Yields (lineno, line) for each line that 'prefilter' selects, decoded as by open(), and
+    # yields (lineno, None) in place of each run of other lines that contains non-blank text.
+    # Files that contain carriage returns are read line by line, yielding every line.
+    with mapped(filepath) as buf:
+        if buf.find(b'\r') == -1:
+            for entry in _interesting_lines_in_buffer(buf, prefilter):
+                yield entry
+            return
+    with open(filepath, 'r') as f:
+        for lineno, line in enumerate(f, 1):
+            yield lineno, line
+
+
+def _interesting_lines_in_buffer(buf, prefilter):
+    lineno = 1
+    pos = 0
+    for start in prefilter.line_starts(buf):
+        if start < pos or start >= len(buf):
+            # A line that was already yielded, or the end of the file
+            continue
+        if start > pos:
+            if _has_text(buf, pos, start):
+                yield lineno, None
+            lineno += buf[pos:start].count(b'\n')
+        end = buf.find(b'\n', start)
+        if end == -1:
+            end = len(buf)
+        else:
+            end += 1
+        yield lineno, buf[start:end].decode(ENCODING)
+        lineno += 1
+        pos = end
+    if pos < len(buf) and _has_text(buf, pos, len(buf)):
+        yield lineno, None
+
+
+def _has_text(buf, start, end):
+    if _NONBLANK.search(buf, start, end) is not None:
+        return True
+    # Only whitespace, control, or non-ASCII characters: decide on the decoded text
+    return buf[start:end].decode(ENCODING).strip() != ''
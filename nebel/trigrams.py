@@ -0,0 +1,185 @@
+'''
+Created on October 19, 2026
+
+Persistent trigram index of the AsciiDoc files in a repository. It narrows
+a search for a literal string (such as a file name or an anchor ID) down to
+the few files that can contain it, before they are parsed. The index is
+updated incrementally: only files whose modification time or size changed
+are read again.
+'''
+
+from __future__ import absolute_import
+import os
+import re
+import bisect
+import pickle
+import tempfile
+from array import array
+import nebel.log
+import nebel.scan
+from nebel.graph import InternTable
+
+log = nebel.log.logger
+
+# Trigrams are taken from runs of the characters that occur in file names and IDs
+_TOKEN = re.compile(rb'[\w.\-]{3,}')
+
+
+def trigrams_of(data):
+    # Returns the set of trigrams of 'data' (bytes), taken from each run of token characters
+    result = set()
+    for token in set(_TOKEN.findall(data)):
+        for k in range(len(token) - 2):
+            result.add(token[k:k + 3])
+    return result
+
+
+class TrigramIndex:
+    VERSION = 1
+
+    def __init__(self, context):
+        self.path = os.path.join(context.CACHE_DIR, 'trigrams.pickle')
+        self.paths = InternTable()
+        self.trigrams = InternTable()
+        # File number -> (stamp, sorted array of its trigram numbers), or None for a file that is not
+        # indexed (any more). Trigram number -> array of the numbers of the files that contain it, which
+        # can also list files that have since changed: candidates are checked against the file's own array.
+        self._files = []
+        self._postings = []
+        # Number of entries in the postings that belong to changed or removed files
+        self._garbage = 0
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                version, tables = pickle.load(f)
+        except Exception:
+            log.warning('Ignoring unreadable cache file: ' + self.path)
+            return
+        if version == self.VERSION:
+            self.paths, self.trigrams, self._files, self._postings, self._garbage = tables
+
+    def save(self):
+        if not self.dirty:
+            return
+        if self._garbage > sum(len(postings) for postings in self._postings) // 2:
+            self._compact()
+        cachedir = os.path.dirname(self.path)
+        if cachedir and not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+        # Write to a temp file first, so that an interrupted run cannot corrupt the index
+        fh, abs_path = tempfile.mkstemp(dir=cachedir or os.curdir)
+        with os.fdopen(fh, 'wb') as f:
+            tables = (self.paths, self.trigrams, self._files, self._postings, self._garbage)
+            pickle.dump((self.VERSION, tables), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(abs_path, self.path)
+        self.dirty = False
+
+    def refresh(self, rootdir=os.curdir):
+        # Brings the index up to date with every AsciiDoc file under 'rootdir', except in hidden directories
+        # (such as the cache directory). Symbolic links to directories outside of 'rootdir' are followed, as
+        # the other commands follow them. Links within 'rootdir' (such as the category links in a book
+        # directory) are not, so that each file is indexed under its own path, and no directory is walked twice.
+        found = set()
+        realroot = os.path.realpath(rootdir)
+        walked = set([realroot])
+        for root, dirs, files in os.walk(rootdir, followlinks=True):
+            subdirs = []
+            for dir in sorted(dirs):
+                dirpath = os.path.join(root, dir)
+                realdir = os.path.realpath(dirpath)
+                if dir.startswith('.') or (realdir in walked):
+                    continue
+                if os.path.islink(dirpath) and (os.path.commonpath([realroot, realdir]) == realroot):
+                    continue
+                walked.add(realdir)
+                subdirs.append(dir)
+            dirs[:] = subdirs
+            for file in files:
+                if file.endswith('.adoc'):
+                    filepath = os.path.relpath(os.path.join(root, file))
+                    found.add(filepath)
+                    self.update(filepath)
+        for number, entry in enumerate(self._files):
+            if (entry is not None) and (self.paths[number] not in found):
+                self._remove(number)
+
+    def update(self, filepath):
+        # Indexes the file again if it changed, and removes it from the index if it no longer exists
+        number = self.paths.intern(filepath)
+        if number == len(self._files):
+            self._files.append(None)
+        if not os.path.isfile(filepath):
+            self._remove(number)
+            return
+        st = os.stat(filepath)
+        stamp = (st.st_mtime_ns, st.st_size)
+        entry = self._files[number]
+        if (entry is not None) and (entry[0] == stamp):
+            return
+        self._remove(number)
+        with nebel.scan.mapped(filepath) as buf:
+            filetrigrams = array('i', sorted(self.trigrams.intern(trigram) for trigram in trigrams_of(buf)))
+        for trigram in filetrigrams:
+            if trigram == len(self._postings):
+                self._postings.append(array('i'))
+            self._postings[trigram].append(number)
+        self._files[number] = (stamp, filetrigrams)
+        self.dirty = True
+
+    def covers(self, filepath):
+        # Returns True if 'filepath' is indexed under this path
+        number = self.paths.number(os.path.normpath(filepath))
+        return (number is not None) and (self._files[number] is not None)
+
+    def files(self):
+        # Returns the indexed files
+        return set(self.paths[number] for number, entry in enumerate(self._files) if entry is not None)
+
+    def candidates(self, text):
+        # Returns the set of indexed files that can contain 'text', or None if 'text' is too short to
+        # narrow the search (in which case any file can contain it)
+        querytrigrams = trigrams_of(text.encode(nebel.scan.ENCODING))
+        if not querytrigrams:
+            return None
+        numbers = []
+        for trigram in querytrigrams:
+            number = self.trigrams.number(trigram)
+            if number is None:
+                return set()
+            numbers.append(number)
+        # Start from the shortest postings, and check the others against the arrays of the candidates
+        numbers.sort(key=lambda number: len(self._postings[number]))
+        result = set()
+        for filenumber in set(self._postings[numbers[0]]):
+            entry = self._files[filenumber]
+            if entry is None:
+                continue
+            filetrigrams = entry[1]
+            for number in numbers:
+                k = bisect.bisect_left(filetrigrams, number)
+                if (k == len(filetrigrams)) or (filetrigrams[k] != number):
+                    break
+            else:
+                result.add(self.paths[filenumber])
+        return result
+
+    def _remove(self, number):
+        entry = self._files[number]
+        if entry is not None:
+            self._files[number] = None
+            self._garbage += len(entry[1])
+            self.dirty = True
+
+    def _compact(self):
+        # Rebuilds the postings without the entries of changed and removed files
+        self._postings = [array('i') for trigram in range(len(self.trigrams))]
+        for number, entry in enumerate(self._files):
+            if entry is not None:
+                for trigram in entry[1]:
+                    self._postings[trigram].append(number)
+        self._garbage = 0
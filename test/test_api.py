@@ -0,0 +1,56 @@
+"""
+Tests for the Python API in nebel.api.
+
+    py.test test/test_api.py
+"""
+
+import io
+import os
+import logging
+import pytest
+import nebel.api
+
+
+@pytest.fixture
+def repo(tmp_path):
+    os.makedirs(str(tmp_path / 'book'))
+    os.makedirs(str(tmp_path / 'modules'))
+    os.makedirs(str(tmp_path / 'assemblies'))
+    (tmp_path / 'nebel.cfg').write_text('[Nebel]\n')
+    (tmp_path / 'book' / 'master.adoc').write_text('= The Book\n\ninclude::../modules/con-module.adoc[leveloffset=+1]\n')
+    (tmp_path / 'modules' / 'con-module.adoc').write_text('[id="module"]\n= Module\n\nText.\n')
+    (tmp_path / 'modules' / 'con-draft.adoc').write_text('[id="draft"]\n= Draft\n\nText.\n')
+    return tmp_path
+
+
+def test_run_logs_to_chosen_stream(repo, caplog):
+    log_stream = io.StringIO()
+    repository = nebel.api.Repository(str(repo), log_stream=log_stream)
+    with caplog.at_level(logging.DEBUG):
+        repository.run('update', '--fix-links', 'modules/con-module.adoc')
+    assert 'Title: The Book' in log_stream.getvalue()
+    # Nothing reaches the handlers of the host program, and its configuration is restored
+    assert caplog.records == []
+    assert nebel.log.logger.propagate
+    # Logging options apply to a single call
+    log_stream.seek(0)
+    log_stream.truncate()
+    repository.run('-q', 'update', '--fix-links', 'modules/con-module.adoc')
+    assert log_stream.getvalue() == ''
+    # The anchors of the book are kept from the previous call, as the book does not include the draft
+    repository.run('--verbose', 'update', '--fix-links', 'modules/con-draft.adoc')
+    assert 'Using the cached anchors of book: book/master.adoc' in log_stream.getvalue()
+
+
+def test_scanned_state_persists(repo):
+    repository = nebel.api.Repository(str(repo), log_stream=io.StringIO())
+    graph = repository.include_graph()
+    assert graph.children('book/master.adoc') == ['modules/con-module.adoc']
+    assert repository.include_graph() is graph
+    # A changed file, or a file that appears where an include pointed to nothing, makes a new graph
+    (repo / 'modules' / 'con-module.adoc').write_text('= Module\n\ninclude::snippet.adoc[]\n')
+    graph = repository.include_graph()
+    assert graph.children('modules/con-module.adoc') == ['modules/snippet.adoc']
+    assert repository.include_graph() is graph
+    (repo / 'modules' / 'snippet.adoc').write_text('include::other.adoc[]\n')
+    assert repository.include_graph().children('modules/snippet.adoc') == ['modules/other.adoc']
@@ -0,0 +1,150 @@
+"""
+Tests for interrupting and resuming 'update --fix-links --resume'.
+
+    py.test test/test_checkpoint.py
+"""
+
+import os
+import pytest
+import nebel.checkpoint
+import nebel.commands
+import nebel.context
+import nebel.log
+
+MODULES = ['modules/cat1/con-%d.adoc' % k for k in range(1, 5)]
+
+FILES = {
+    'nebel.cfg': '[Nebel]\n',
+    'book-a/master.adoc': ':context: a\n\n= Book A\n\ninclude::../assemblies/cat1/assembly-a.adoc[leveloffset=+1]\n',
+    'assemblies/cat1/assembly-a.adoc': '[id="assembly-a_{context}"]\n= Assembly A\n\n'
+                                       'include::../../modules/cat1/con-target.adoc[leveloffset=+1]\n',
+    'modules/cat1/con-target.adoc': '[id="con-target_{context}"]\n= Target\n',
+}
+for modulefile in MODULES:
+    FILES[modulefile] = 'See xref:con-target[the target].\n'
+
+# The files whose links are fixed, in the order they are updated
+FIXFILES = ['assemblies/cat1/assembly-a.adoc'] + MODULES + ['modules/cat1/con-target.adoc']
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for filepath, contents in FILES.items():
+        if not os.path.exists(os.path.dirname(filepath) or os.curdir):
+            os.makedirs(os.path.dirname(filepath))
+        write(filepath, contents)
+    return tmp_path
+
+
+def write(filepath, contents):
+    with open(filepath, 'w') as f:
+        f.write(contents)
+
+
+def read(filepath):
+    with open(filepath) as f:
+        return f.read()
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    # Records the files whose links are rewritten, and the runs that harvest the anchors of the books.
+    # The run is interrupted when it reaches the file in calls['interrupt'].
+    calls = {'rewritten': [], 'harvested': 0, 'interrupt': None}
+    rewrite_links = nebel.commands.Tasks._rewrite_links
+    harvest_anchors = nebel.commands.Tasks._harvest_anchors
+
+    def spy_rewrite_links(self, line, fixfile):
+        if fixfile == calls['interrupt']:
+            raise Interrupted()
+        if fixfile not in calls['rewritten']:
+            calls['rewritten'].append(fixfile)
+        return rewrite_links(self, line, fixfile)
+
+    def spy_harvest_anchors(self, *args, **kwargs):
+        calls['harvested'] += 1
+        return harvest_anchors(self, *args, **kwargs)
+
+    monkeypatch.setattr(nebel.commands.Tasks, '_rewrite_links', spy_rewrite_links)
+    monkeypatch.setattr(nebel.commands.Tasks, '_harvest_anchors', spy_harvest_anchors)
+    return calls
+
+
+def fix_links(calls, *args, **kwargs):
+    calls['rewritten'] = []
+    calls['harvested'] = 0
+    calls['interrupt'] = kwargs.get('interrupt')
+    try:
+        nebel.commands.main(['update', '--fix-links'] + list(args))
+    finally:
+        nebel.log.flush()
+
+
+def interrupted_run(calls, *args):
+    # Interrupts a run at the third module, after the assembly and the first two modules were updated
+    with pytest.raises(Interrupted):
+        fix_links(calls, *args, interrupt=MODULES[2])
+    assert calls['rewritten'] == FIXFILES[:3]
+    assert calls['harvested'] == 1
+    for modulefile in MODULES[:2]:
+        assert read(modulefile) == 'See xref:con-target_a[the target].\n'
+    for modulefile in MODULES[2:]:
+        assert read(modulefile) == FILES[modulefile]
+
+
+def test_resume_skips_files_done_and_reuses_tables(repo, calls):
+    interrupted_run(calls)
+    fix_links(calls, '--resume')
+    # The interrupted run rewrote the assembly, which the tables were built from, but the tables are still valid
+    assert calls['rewritten'] == FIXFILES[3:]
+    assert calls['harvested'] == 0
+    for modulefile in MODULES:
+        assert read(modulefile) == 'See xref:con-target_a[the target].\n'
+    # The checkpoint is removed when the run completes, so there is nothing left to resume
+    fix_links(calls, '--resume')
+    assert calls['rewritten'] == FIXFILES
+    assert calls['harvested'] == 1
+
+
+def test_resume_rebuilds_tables_of_changed_books(repo, calls):
+    interrupted_run(calls)
+    write('book-a/master.adoc', FILES['book-a/master.adoc'].replace(':context: a', ':context: c'))
+    fix_links(calls, '--resume')
+    # The tables are built again, but the files that were already updated are still skipped
+    assert calls['rewritten'] == FIXFILES[3:]
+    assert calls['harvested'] == 1
+    for modulefile in MODULES[2:]:
+        assert read(modulefile) == 'See xref:con-target_c[the target].\n'
+
+
+def test_resume_with_other_options_starts_over(repo, calls):
+    interrupted_run(calls)
+    fix_links(calls, '--resume', '--resolve', 'skip')
+    assert calls['rewritten'] == FIXFILES
+    assert calls['harvested'] == 1
+
+
+def test_journal_line_cut_short(repo):
+    context = nebel.context.NebelContext()
+    checkpoint = nebel.checkpoint.Checkpoint(context, 'test', ('test', 1))
+    assert not checkpoint.start(resume=True)
+    checkpoint.done('a.adoc')
+    checkpoint.journal.write('b.ad')
+    checkpoint.close()
+    # An interrupted write leaves the last line without a newline, so that file is not done
+    checkpoint = nebel.checkpoint.Checkpoint(context, 'test', ('test', 1))
+    assert checkpoint.start(resume=True)
+    assert checkpoint.is_done('a.adoc')
+    assert not checkpoint.is_done('b.ad')
+    checkpoint.close()
+    # A run with another key starts over
+    checkpoint = nebel.checkpoint.Checkpoint(context, 'test', ('test', 2))
+    assert not checkpoint.start(resume=True)
+    assert not checkpoint.is_done('a.adoc')
+    checkpoint.finish()
+    assert not os.path.exists(checkpoint.path)
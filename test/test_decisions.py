@@ -0,0 +1,70 @@
+"""
+Tests for the recorded decisions of 'update --resolve/--decisions'.
+
+    py.test test/test_decisions.py
+"""
+
+import json
+import pytest
+import nebel.context
+from nebel.decisions import Disambiguator
+
+
+@pytest.fixture
+def context(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return nebel.context.NebelContext()
+
+
+def write_decisions(entries):
+    with open('choices.json', 'w') as f:
+        json.dump({'includes': entries, 'anchors': []}, f)
+
+
+def read_decisions():
+    with open('choices.json') as f:
+        return json.load(f)['includes']
+
+
+def test_collect_keeps_answered_choices(context):
+    write_decisions([
+        {'file': 'a.adoc', 'key': 'con-x.adoc', 'candidates': ['cat1/con-x.adoc', 'cat2/con-x.adoc'], 'choice': 1},
+        {'file': 'a.adoc', 'key': 'con-y.adoc', 'candidates': ['cat1/con-y.adoc', 'cat2/con-y.adoc'], 'choice': None},
+    ])
+    disambiguator = Disambiguator(context, decisionsfile='choices.json', collect=True)
+    # An answered ambiguity is resolved, and so is not recorded again
+    assert disambiguator.resolve('includes', 'a.adoc', 'con-x.adoc', ['cat1/con-x.adoc', 'cat2/con-x.adoc']) == 'cat2/con-x.adoc'
+    assert disambiguator.resolve('includes', 'a.adoc', 'con-y.adoc', ['cat1/con-y.adoc', 'cat3/con-y.adoc']) is None
+    disambiguator.record('includes', 'a.adoc', 'con-y.adoc', ['cat1/con-y.adoc', 'cat3/con-y.adoc'])
+    disambiguator.record('includes', 'b.adoc', 'con-z.adoc', ['cat1/con-z.adoc', 'cat2/con-z.adoc'])
+    disambiguator.save()
+    assert read_decisions() == [
+        {'file': 'a.adoc', 'key': 'con-x.adoc', 'candidates': ['cat1/con-x.adoc', 'cat2/con-x.adoc'], 'choice': 1},
+        {'file': 'a.adoc', 'key': 'con-y.adoc', 'candidates': ['cat1/con-y.adoc', 'cat3/con-y.adoc'], 'choice': None},
+        {'file': 'b.adoc', 'key': 'con-z.adoc', 'candidates': ['cat1/con-z.adoc', 'cat2/con-z.adoc'], 'choice': None},
+    ]
+
+
+def test_collect_creates_decisions_file(context):
+    disambiguator = Disambiguator(context, decisionsfile='choices.json', collect=True)
+    disambiguator.record('includes', 'a.adoc', 'con-x.adoc', ['cat1/con-x.adoc', 'cat2/con-x.adoc'])
+    disambiguator.save()
+    assert len(read_decisions()) == 1
+
+
+def test_missing_decisions_file(context):
+    with pytest.raises(SystemExit):
+        Disambiguator(context, decisionsfile='choices.json')
+
+
+def test_choice_of_wrong_type_is_ignored(context):
+    write_decisions([
+        {'file': None, 'key': 'con-x.adoc', 'candidates': ['cat1/con-x.adoc', 'cat2/con-x.adoc'], 'choice': ['cat1/con-x.adoc']},
+        {'file': None, 'key': 'con-y.adoc', 'candidates': ['cat1/con-y.adoc', 'cat2/con-y.adoc'], 'choice': 1.0},
+        {'file': None, 'key': 'con-z.adoc', 'candidates': ['cat1/con-z.adoc', 'cat2/con-z.adoc'], 'choice': 'cat1/con-z.adoc'},
+    ])
+    disambiguator = Disambiguator(context, decisionsfile='choices.json')
+    assert disambiguator.resolve('includes', 'a.adoc', 'con-x.adoc', ['cat1/con-x.adoc', 'cat2/con-x.adoc']) is None
+    assert disambiguator.resolve('includes', 'a.adoc', 'con-y.adoc', ['cat1/con-y.adoc', 'cat2/con-y.adoc']) is None
+    # A recorded choice that is no longer a candidate is reported, and ignored
+    assert disambiguator.resolve('includes', 'a.adoc', 'con-z.adoc', ['cat2/con-z.adoc', 'cat3/con-z.adoc']) is None
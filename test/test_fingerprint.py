@@ -0,0 +1,52 @@
+"""
+Tests for the 'fingerprint' command.
+
+    py.test test/test_fingerprint.py
+"""
+
+import os
+import pytest
+import nebel.commands
+import nebel.log
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('book/images')
+    os.makedirs('modules')
+    with open('nebel.cfg', 'w') as f:
+        f.write('[Nebel]\n')
+    with open('book/master.adoc', 'w') as f:
+        f.write('= Book\n:imagesdir: images\n\ninclude::../modules/con-module.adoc[leveloffset=+1]\n')
+    with open('modules/con-module.adoc', 'w') as f:
+        f.write('[id="module"]\n= Module\n\nimage::diagram.png[Diagram]\n')
+    with open('book/images/diagram.png', 'wb') as f:
+        f.write(b'first')
+    with open('book/images/unused.png', 'wb') as f:
+        f.write(b'first')
+    return tmp_path
+
+
+def fingerprints(capsys):
+    nebel.commands.main(['fingerprint'])
+    nebel.log.flush()
+    return capsys.readouterr().out
+
+
+def test_fingerprint_follows_includes_and_images(repo, capsys):
+    first = fingerprints(capsys)
+    assert first.endswith('  book/master.adoc\n')
+    assert fingerprints(capsys) == first
+    with open('book/images/unused.png', 'wb') as f:
+        f.write(b'second')
+    assert fingerprints(capsys) == first
+    with open('book/images/diagram.png', 'wb') as f:
+        f.write(b'second')
+    second = fingerprints(capsys)
+    assert second != first
+    os.remove('book/images/diagram.png')
+    assert fingerprints(capsys) not in (first, second)
+    with open('modules/con-module.adoc', 'a') as f:
+        f.write('More text.\n')
+    assert fingerprints(capsys) not in (first, second)
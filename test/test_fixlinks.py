@@ -0,0 +1,81 @@
+"""
+Tests for 'update --fix-links', run on every file and on a single FILE,
+where only the anchors of the books in scope are checked for changes.
+
+    py.test test/test_fixlinks.py
+"""
+
+import os
+import pytest
+import nebel.commands
+import nebel.log
+
+FILES = {
+    'nebel.cfg': '[Nebel]\n',
+    'book-a/master.adoc': ':context: a\n\n= Book A\n\ninclude::../assemblies/cat1/assembly-a.adoc[leveloffset=+1]\n',
+    'book-b/master.adoc': ':context: b\n\n= Book B\n\ninclude::../assemblies/cat1/assembly-b.adoc[leveloffset=+1]\n',
+    'assemblies/cat1/assembly-a.adoc': '[id="assembly-a_{context}"]\n= Assembly A\n\n'
+                                       'include::../../modules/cat1/con-m.adoc[leveloffset=+1]\n\n'
+                                       'include::../../modules/cat1/con-target.adoc[leveloffset=+1]\n',
+    'assemblies/cat1/assembly-b.adoc': '[id="assembly-b_{context}"]\n= Assembly B\n\n'
+                                       'include::../../modules/cat2/con-other.adoc[leveloffset=+1]\n',
+    # A module that includes another module, whose links are fixed
+    'modules/cat1/con-m.adoc': '[id="con-m_{context}"]\n= M\n\ninclude::con-snippet.adoc[]\n',
+    'modules/cat1/con-snippet.adoc': 'See xref:con-target[the target].\n',
+    'modules/cat1/con-target.adoc': '[id="con-target_{context}"]\n= Target\n',
+    'modules/cat2/con-other.adoc': '[id="con-other_{context}"]\n= Other\n',
+}
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for filepath, contents in FILES.items():
+        write(filepath, contents)
+    return tmp_path
+
+
+def write(filepath, contents):
+    if os.path.dirname(filepath) and not os.path.exists(os.path.dirname(filepath)):
+        os.makedirs(os.path.dirname(filepath))
+    with open(filepath, 'w') as f:
+        f.write(contents)
+
+
+def read(filepath):
+    with open(filepath) as f:
+        return f.read()
+
+
+def fix_links(*args):
+    nebel.commands.main(['update', '--fix-links'] + list(args))
+    nebel.log.flush()
+
+
+def test_fix_links(repo):
+    fix_links()
+    assert read('modules/cat1/con-snippet.adoc') == 'See xref:con-target_a[the target].\n'
+
+
+@pytest.mark.parametrize('args', [[], ['modules/cat1/con-snippet.adoc']])
+def test_scoped_fix_links_checks_books_that_include_file_through_modules(repo, args):
+    # Cache the anchors of every book, then change the context of the book that includes the file through
+    # another module: the book is in scope, so its anchors are parsed again in both full and scoped runs
+    fix_links()
+    write('modules/cat1/con-snippet.adoc', FILES['modules/cat1/con-snippet.adoc'])
+    write('book-a/master.adoc', FILES['book-a/master.adoc'].replace(':context: a', ':context: c'))
+    fix_links(*args)
+    assert read('modules/cat1/con-snippet.adoc') == 'See xref:con-target_c[the target].\n'
+
+
+def test_scoped_fix_links_uses_cached_anchors_of_other_books(repo):
+    fix_links()
+    write('modules/cat1/con-snippet.adoc', FILES['modules/cat1/con-snippet.adoc'])
+    # Book B is out of scope, so its cached anchors are used even though the module changed
+    write('modules/cat2/con-other.adoc', '[id="con-target_{context}"]\n= Other target\n')
+    fix_links('modules/cat1/con-snippet.adoc')
+    assert read('modules/cat1/con-snippet.adoc') == 'See xref:con-target_a[the target].\n'
+    # A full run checks every book, so the link is now ambiguous and left unchanged without prompting
+    write('modules/cat1/con-snippet.adoc', FILES['modules/cat1/con-snippet.adoc'])
+    fix_links('--resolve', 'skip')
+    assert read('modules/cat1/con-snippet.adoc') == FILES['modules/cat1/con-snippet.adoc']
@@ -0,0 +1,51 @@
+"""
+Tests for 'nebel flatten'.
+
+    py.test test/test_flatten.py
+"""
+
+import os
+import json
+import pytest
+import nebel.commands
+import nebel.log
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('book')
+    with open('nebel.cfg', 'w') as f:
+        f.write('[Nebel]\n')
+    with open('book/master.adoc', 'w') as f:
+        f.write('= Book\n\ninclude::chapter.adoc[]\n')
+    with open('book/chapter.adoc', 'w') as f:
+        f.write('== Chapter\n\nText.\n')
+    return tmp_path
+
+
+def flatten(*args):
+    try:
+        nebel.commands.main(['flatten'] + list(args))
+    finally:
+        nebel.log.flush()
+
+
+def test_flatten_with_source_map(repo):
+    flatten('--output', 'flat.adoc', 'book/master.adoc')
+    with open('flat.adoc') as f:
+        assert f.read() == '= Book\n\n== Chapter\n\nText.\n'
+    with open('flat.adoc.map.json') as f:
+        sourcemap = json.load(f)
+    assert sourcemap['sources'] == ['book/master.adoc', 'book/chapter.adoc']
+    assert sourcemap['mappings'] == [[1, 0, 1, 2], [3, 1, 1, 3]]
+
+
+def test_failed_flatten_leaves_output_unchanged(repo):
+    flatten('--output', 'flat.adoc', 'book/master.adoc')
+    os.remove('book/chapter.adoc')
+    with pytest.raises(SystemExit):
+        flatten('--output', 'flat.adoc', 'book/master.adoc')
+    with open('flat.adoc') as f:
+        assert f.read() == '= Book\n\n== Chapter\n\nText.\n'
+    assert sorted(os.listdir(str(repo))) == ['.nebel', 'book', 'flat.adoc', 'flat.adoc.map.json', 'nebel.cfg']
@@ -0,0 +1,153 @@
+"""
+Tests for the in-memory tables of nebel.graph.
+
+    py.test test/test_graph.py
+"""
+
+import pickle
+import pytest
+from nebel.graph import AnchorIndex, IncludeGraph, MetadataRecord
+
+
+def test_anchor_defined_twice_in_book():
+    anchors = AnchorIndex()
+    assert anchors.add('intro', 'book-a', 'modules/con-intro.adoc', 'Introduction')
+    assert not anchors.add('intro', 'book-a', 'modules/con-other.adoc')
+    assert anchors.add('intro', 'book-b', 'modules/con-intro-b.adoc')
+    assert 'intro' in anchors
+    assert 'missing' not in anchors
+    assert anchors.files_of('intro') == ['modules/con-intro.adoc', 'modules/con-intro-b.adoc']
+    assert anchors.books_of('intro') == {'book-a', 'book-b'}
+    assert anchors.books_of_file('modules/con-intro.adoc') == {'book-a'}
+    assert anchors.books_of_file('modules/con-other.adoc') == set()
+
+
+def test_anchor_legacy_and_root_lookups():
+    anchors = AnchorIndex()
+    anchors.add('installing_cloud', 'book-a', 'modules/proc-installing.adoc')
+    anchors.add('installing_local', 'book-b', 'modules/proc-installing.adoc')
+    anchors.add_legacy_id('old-installing', 'installing_cloud')
+    anchors.add_to_root('installing', 'installing_cloud')
+    anchors.add_to_root('installing', 'installing_local')
+    assert anchors.legacy_target('old-installing') == 'installing_cloud'
+    assert anchors.legacy_target('installing_cloud') is None
+    assert anchors.legacy_target('unknown') is None
+    assert anchors.has_root('installing')
+    assert not anchors.has_root('installing_cloud')
+    assert not anchors.has_root('unknown')
+    assert anchors.ids_of_root('installing') == ['installing_cloud', 'installing_local']
+    # An unknown root, whether or not the ID itself is known
+    assert anchors.ids_of_root('unknown') == []
+    assert anchors.ids_of_root('installing_cloud') == []
+
+
+def book_index(book, filepath, anchorids, root=None):
+    anchors = AnchorIndex()
+    for anchorid in anchorids:
+        anchors.add(anchorid, book, filepath)
+        if root is not None:
+            anchors.add_to_root(root, anchorid)
+    return anchors
+
+
+def test_anchor_extend():
+    anchors = book_index('book-a', 'a.adoc', ['one_a', 'two'], root='one')
+    other = book_index('book-a', 'b.adoc', ['two', 'three'])
+    other.add_legacy_id('old-two', 'two')
+    other.add_legacy_id('old-three', 'three')
+    other.add_to_root('root', 'two')
+    other.add_to_root('root', 'three')
+    assert anchors.extend(other) == ['two']
+    # The first definition in the book is kept, with none of the tables of the skipped anchor
+    assert anchors.files_of('two') == ['a.adoc']
+    assert anchors.files_of('three') == ['b.adoc']
+    assert anchors.legacy_target('old-two') is None
+    assert anchors.legacy_target('old-three') == 'three'
+    assert anchors.ids_of_root('root') == ['three']
+    # An anchor that was added by extend() is also found as a duplicate afterwards
+    assert not anchors.add('three', 'book-a', 'c.adoc')
+    assert anchors.extend(book_index('book-b', 'b.adoc', ['two'])) == []
+    assert anchors.books_of('two') == {'book-a', 'book-b'}
+
+
+def test_anchor_merge():
+    anchors = book_index('book-a', 'a.adoc', ['one_x', 'two'], root='one')
+    anchors.add('two', 'book-b', 'b.adoc')
+    other = book_index('book-a', 'c.adoc', ['two', 'one_x', 'one_y'], root='one')
+    anchors.merge(other)
+    # The definition from 'other' replaces the one in the same book, in place
+    assert anchors.files_of('two') == ['c.adoc', 'b.adoc']
+    assert anchors.books_of_file('a.adoc') == set()
+    assert anchors.books_of_file('c.adoc') == {'book-a'}
+    assert anchors.ids_of_root('one') == ['one_x', 'two', 'one_y']
+    # A merged anchor is found as a duplicate afterwards
+    assert not anchors.add('one_y', 'book-a', 'd.adoc')
+
+
+def test_anchor_index_pickles():
+    anchors = book_index('book-a', 'a.adoc', ['one_x'], root='one')
+    copy = pickle.loads(pickle.dumps(anchors))
+    assert copy.ids_of_root('one') == ['one_x']
+    assert not copy.add('one_x', 'book-a', 'b.adoc')
+
+
+def test_include_graph_parents_and_children():
+    graph = IncludeGraph()
+    graph.add_root('master.adoc')
+    graph.add_edge('master.adoc', 'assembly.adoc')
+    graph.add_edge('assembly.adoc', 'con-a.adoc')
+    graph.add_edge('assembly.adoc', 'con-b.adoc')
+    graph.add_edge('assembly.adoc', 'con-a.adoc')
+    graph.add_edge('other.adoc', 'con-a.adoc')
+    assert graph.children('assembly.adoc') == ['con-a.adoc', 'con-b.adoc']
+    assert graph.parents('con-a.adoc') == ['assembly.adoc', 'other.adoc']
+    assert graph.children('con-a.adoc') == []
+    assert graph.parents('unknown.adoc') == []
+    assert list(graph.parent_nodes('unknown.adoc')) == []
+    assert graph.roots == {'master.adoc'}
+    assert graph.is_root('master.adoc')
+    assert not graph.is_root('assembly.adoc')
+    assert graph.has_node('con-b.adoc')
+    assert not graph.has_node('unknown.adoc')
+    assert graph.ancestors(['con-a.adoc']) == {'con-a.adoc', 'assembly.adoc', 'master.adoc', 'other.adoc'}
+    assert graph.descendants(['master.adoc', 'unknown.adoc']) == {'master.adoc', 'unknown.adoc', 'assembly.adoc', 'con-a.adoc', 'con-b.adoc'}
+
+
+def test_include_graph_repeated_edges():
+    graph = IncludeGraph()
+    graph.add_edge('assembly.adoc', 'con-a.adoc', unique=False)
+    graph.add_edge('assembly.adoc', 'con-a.adoc', unique=False)
+    assert graph.children('assembly.adoc') == ['con-a.adoc', 'con-a.adoc']
+    # A unique edge is not added again, however the existing edges were added
+    graph.add_edge('assembly.adoc', 'con-a.adoc')
+    assert graph.parents('con-a.adoc') == ['assembly.adoc', 'assembly.adoc']
+
+
+def test_metadata_record():
+    record = MetadataRecord({'Audience': 'admin'})
+    record['Type'] = 'concept'
+    record['Title'] = 'About things'
+    record['Level'] = 2
+    assert record['Type'] == 'concept'
+    assert record.get('Audience') == 'admin'
+    assert record.get('Category') is None
+    assert record.get('Missing', 'default') == 'default'
+    assert 'Title' in record
+    assert 'Category' not in record
+    assert 'Missing' not in record
+    assert list(record) == ['Audience', 'Type', 'Title', 'Level']
+    record['Status'] = 'draft'
+    assert record.keys() == ['Audience', 'Status', 'Type', 'Title', 'Level']
+    with pytest.raises(KeyError):
+        record['ModuleID']
+    # A fixed field that was set by a comment
+    record = MetadataRecord({'Level': '3', 'Audience': 'admin'})
+    assert record['Level'] == '3'
+    record['Type'] = 'concept'
+    record['Level'] = '2'
+    assert record.get('Level') == '2'
+    assert record.keys() == ['Level', 'Audience', 'Type']
+    empty = MetadataRecord()
+    assert empty.fields is None
+    assert empty.keys() == []
+    assert empty.get('Audience') is None
@@ -0,0 +1,31 @@
+"""
+Tests for the metadata rows of 'nebel csv' and 'nebel export'.
+
+    py.test test/test_metadata.py
+"""
+
+import os
+import pytest
+import nebel.commands
+import nebel.log
+
+
+@pytest.fixture
+def tasks(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('book')
+    with open('nebel.cfg', 'w') as f:
+        f.write('[Nebel]\n')
+    with open('book/master.adoc', 'w') as f:
+        f.write('[id="book"]\n= Book\n\ninclude::chapter.adoc[leveloffset=+1]\n')
+    with open('book/chapter.adoc', 'w') as f:
+        f.write('[id="chapter"]\n= Chapter\n\n// Level: 3\n[id="planned"]\n== Planned\n\n[id="section"]\n== Section\n')
+    return nebel.commands.Tasks(nebel.commands.new_context('nebel.cfg'))
+
+
+def test_level_of_headings(tasks, caplog):
+    rows = tasks._harvest_metadata('book/master.adoc')
+    nebel.log.flush()
+    assert [(row['ModuleID'], row['Level']) for row in rows] == [('book', '0'), ('chapter', '1'), ('planned', '3'), ('section', '2')]
+    # A Level comment is kept, but a level that differs from the level in the book is reported
+    assert 'Level 3 of planned differs from its level in the book: 2' in caplog.text
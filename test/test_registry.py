@@ -0,0 +1,87 @@
+"""
+Tests for the context registry of 'update --add-contexts'.
+
+    py.test test/test_registry.py
+"""
+
+import os
+import json
+import hashlib
+import pytest
+import nebel.commands
+
+
+ASSEMBLY = '''[id="{rootid}_{{context}}"]
+= Assembly
+
+:parent-of-context-{hash}: {{context}}
+:context: {{context}}-{rootid}
+include::../modules/con-module.adoc[leveloffset=+1]
+:context: {{parent-of-context-{hash}}}
+'''
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('assemblies')
+    with open('nebel.cfg', 'w') as f:
+        f.write('[Nebel]\nfile.contexts = content/contexts.json\n')
+    return tmp_path
+
+
+def tasks():
+    return nebel.commands.Tasks(nebel.commands.new_context('nebel.cfg'))
+
+
+def sha(text):
+    return hashlib.sha256(text.encode('UTF-8')).hexdigest()
+
+
+def test_registry_is_seeded_from_assemblies(repo):
+    # 'other-root' uses the hash that 'new-root' would get, so 'new-root' must get a longer one
+    with open('assemblies/assembly-other.adoc', 'w') as f:
+        f.write(ASSEMBLY.format(rootid='other-root', hash=sha('new-root')[:6]))
+    registry = tasks()._context_registry()
+    assert registry.path == 'content/contexts.json'
+    assert registry.lookup('other-root') == sha('new-root')[:6]
+    assert registry.hash_of('new-root') == sha('new-root')[:7]
+    registry.save()
+    with open('content/contexts.json') as f:
+        assert json.load(f)['hashes'] == {'other-root': sha('new-root')[:6], 'new-root': sha('new-root')[:7]}
+    # Once the registry exists, it is not seeded again
+    os.remove('assemblies/assembly-other.adoc')
+    assert tasks()._context_registry().lookup('other-root') == sha('new-root')[:6]
+
+
+def test_seeding_skips_conflicting_hashes(repo):
+    with open('assemblies/assembly-a.adoc', 'w') as f:
+        f.write(ASSEMBLY.format(rootid='root-a', hash='abc123'))
+    with open('assemblies/assembly-b.adoc', 'w') as f:
+        f.write(ASSEMBLY.format(rootid='root-b', hash='abc123'))
+    registry = tasks()._context_registry()
+    assert registry.lookup('root-a') == 'abc123'
+    assert registry.lookup('root-b') is None
+    assert not registry.register('root-a', 'def456', 'assemblies/assembly-c.adoc')
+    assert registry.register('root-a', 'abc123', 'assemblies/assembly-c.adoc')
+
+
+def test_module_ids_are_not_registered(repo):
+    os.makedirs('modules')
+    with open('modules/con-module.adoc', 'w') as f:
+        f.write('[id="con-module"]\n= Module\n\n[id="con-section"]\n== Section\n\nText.\n')
+    with open('assemblies/assembly-a.adoc', 'w') as f:
+        f.write('[id="root-a"]\n= Assembly\n\ninclude::../modules/con-module.adoc[leveloffset=+1]\n\n[id="root-a-section"]\n== Section without includes\n')
+    nebel.commands.main(['update', '--add-contexts'])
+    with open('content/contexts.json') as f:
+        assert json.load(f)['hashes'] == {'root-a': sha('root-a')[:6]}
+    with open('modules/con-module.adoc') as f:
+        assert f.read().startswith('[id="con-module_{context}"]\n')
+
+
+def test_contexts_command_does_not_write_registry(repo, capsys):
+    with open('assemblies/assembly-other.adoc', 'w') as f:
+        f.write(ASSEMBLY.format(rootid='other-root', hash='abc123'))
+    nebel.commands.main(['contexts'])
+    assert capsys.readouterr().out == 'abc123 other-root\n'
+    assert not os.path.exists('content/contexts.json')
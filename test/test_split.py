@@ -0,0 +1,109 @@
+"""
+Tests for the 'split' command. The expected files under split/expected were
+generated by the original recursive splitter, from the annotated files under
+split/legacy, so these tests check that the output has not changed.
+
+    py.test test/test_split.py
+"""
+
+import os
+import shutil
+import pytest
+import nebel.cache
+import nebel.commands
+import nebel.log
+
+SPLIT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'split')
+
+LEGACY_FILES = ['legacy/a/nested.adoc', 'legacy/b/conditions.adoc']
+
+
+def normalized(filepath):
+    # Returns the contents of a generated file. The order of the metadata comments at the top of the
+    # file is not significant (it used to depend on set ordering), so they are sorted.
+    with open(filepath, 'r') as f:
+        lines = f.readlines()
+    k = 0
+    while (k < len(lines)) and lines[k].startswith('//'):
+        k += 1
+    return sorted(lines[:k]) + lines[k:]
+
+
+def generated_files(rootdir):
+    # Returns the relative paths of the files generated under 'rootdir'
+    result = set()
+    for subdir in ['assemblies', 'modules']:
+        for root, dirs, files in os.walk(os.path.join(rootdir, subdir)):
+            for file in files:
+                result.add(os.path.relpath(os.path.join(root, file), rootdir))
+    return result
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    # Copies the annotated files into an empty repository, and makes it the working directory
+    shutil.copy(os.path.join(SPLIT_DIR, 'nebel.cfg'), str(tmp_path))
+    shutil.copytree(os.path.join(SPLIT_DIR, 'legacy'), str(tmp_path / 'legacy'))
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def split(*args):
+    nebel.commands.main(['split'] + list(args))
+    nebel.log.flush()
+
+
+@pytest.mark.parametrize('name, options', [
+    ('default', []),
+    ('cloud', ['--conditions', 'cloud']),
+    ('beta', ['--legacybasedir', 'legacy', '--conditions', 'beta']),
+])
+def test_split_matches_original(repo, name, options):
+    for fromfile in LEGACY_FILES:
+        split(*(options + [fromfile]))
+    expecteddir = os.path.join(SPLIT_DIR, 'expected', name)
+    expected = generated_files(expecteddir)
+    assert generated_files(str(repo)) == expected
+    for file in sorted(expected):
+        assert normalized(os.path.join(str(repo), file)) == normalized(os.path.join(expecteddir, file)), file
+
+
+def test_split_with_jobs(repo):
+    # Splitting several files in worker processes gives the same files as splitting them one by one
+    split('--jobs', '2', '--conditions', 'cloud', 'legacy/{}/{}.adoc')
+    expecteddir = os.path.join(SPLIT_DIR, 'expected', 'cloud')
+    expected = generated_files(expecteddir)
+    assert generated_files(str(repo)) == expected
+    for file in sorted(expected):
+        assert normalized(os.path.join(str(repo), file)) == normalized(os.path.join(expecteddir, file)), file
+    # The fragments parsed by the workers are saved by the parent process
+    cache = nebel.cache.FileCache(nebel.commands.new_context('nebel.cfg'), 'resolved', version=2)
+    assert sorted(cache.entries) == LEGACY_FILES
+
+
+@pytest.mark.parametrize('content, message', [
+    ('// Type: concept\n== No identifier\n\nText.\n',
+     'Heading No identifier must have a module ID.'),
+    ('// Type: concept\n[id="stray"]\n== Stray\n\nText.\nendif::cloud[]\n',
+     'Unmatched endif::cloud[]'),
+    ('// Type: tutorial\n[id="odd-type"]\n== Odd type\n\nText.\n',
+     'Unknown module Type: tutorial'),
+])
+def test_split_error(repo, capsys, content, message):
+    # A file that cannot be split generates no files, and makes the command fail
+    with open('legacy/bad.adoc', 'w') as f:
+        f.write('// Type: assembly\n// ModuleID: bad-book\n= Bad book\n\n' + content)
+    with pytest.raises(SystemExit) as excinfo:
+        split('--conditions', 'cloud', 'legacy/bad.adoc')
+    assert excinfo.value.code == 1
+    assert generated_files(str(repo)) == set()
+    assert message in capsys.readouterr().err
+
+
+def test_split_error_does_not_stop_other_files(repo):
+    with open('legacy/a/bad.adoc', 'w') as f:
+        f.write('// Type: assembly\n// ModuleID: bad-book\n= Bad book\n\n// Type: concept\n== No identifier\n')
+    with pytest.raises(SystemExit):
+        split('legacy/a/{}.adoc')
+    assert 'assemblies/default/assembly-nested-book.adoc' in generated_files(str(repo))
+    assert 'assemblies/default/assembly-bad-book.adoc' not in generated_files(str(repo))
@@ -0,0 +1,58 @@
+"""
+Tests for the trigram index, which narrows the files that the 'mv' and
+'refs' commands scan.
+
+    py.test test/test_trigrams.py
+"""
+
+import os
+import pytest
+import nebel.commands
+from nebel.trigrams import TrigramIndex
+
+
+@pytest.fixture
+def tasks(tmp_path, monkeypatch):
+    # A repository whose assemblies directory is a symbolic link to a directory outside of it
+    repodir = tmp_path / 'repo'
+    realdir = tmp_path / 'real' / 'assemblies' / 'cat1'
+    os.makedirs(str(repodir / 'modules' / 'cat1'))
+    os.makedirs(str(realdir))
+    os.symlink(str(tmp_path / 'real' / 'assemblies'), str(repodir / 'assemblies'))
+    # A link back up the tree must not be walked again
+    os.symlink(str(tmp_path / 'real'), str(realdir / 'loop'))
+    with open(str(realdir / 'assembly-a.adoc'), 'w') as f:
+        f.write('include::../../modules/cat1/con-y.adoc[leveloffset=+1]\n')
+    with open(str(repodir / 'modules' / 'cat1' / 'con-y.adoc'), 'w') as f:
+        f.write('[id="con-y"]\n= Y\n')
+    # A book directory that links to a category, which is indexed under its own path only
+    os.makedirs(str(repodir / 'a-book' / 'modules'))
+    os.symlink(str(repodir / 'modules' / 'cat1'), str(repodir / 'a-book' / 'modules' / 'cat1'))
+    monkeypatch.chdir(repodir)
+    with open('nebel.cfg', 'w') as f:
+        f.write('[Nebel]\n')
+    return nebel.commands.Tasks(nebel.commands.new_context('nebel.cfg'))
+
+
+def test_refresh_follows_symlinked_directories(tasks):
+    index = TrigramIndex(tasks.context)
+    index.refresh()
+    assert index.files() == {'assemblies/cat1/assembly-a.adoc', 'modules/cat1/con-y.adoc'}
+    assert index.covers('./assemblies/cat1/assembly-a.adoc')
+    assert index.candidates('con-y.adoc') == {'assemblies/cat1/assembly-a.adoc'}
+
+
+def test_unindexed_files_are_candidates(tasks):
+    index = TrigramIndex(tasks.context)
+    index.update('modules/cat1/con-y.adoc')
+    filelist = ['assemblies/cat1/assembly-a.adoc', 'modules/cat1/con-y.adoc']
+    # The assembly is not in the index, so it can contain anything
+    assert not index.covers('assemblies/cat1/assembly-a.adoc')
+    assert tasks._files_containing(index, 'con-y.adoc', filelist) == ['assemblies/cat1/assembly-a.adoc']
+    assert tasks._files_containing(index, 'con-y', filelist) == filelist
+
+
+def test_mv_updates_include_under_symlinked_directory(tasks):
+    nebel.commands.main(['mv', 'modules/cat1/con-y.adoc', 'modules/cat1/con-z.adoc'])
+    with open('assemblies/cat1/assembly-a.adoc', 'r') as f:
+        assert f.read() == 'include::../../modules/cat1/con-z.adoc[leveloffset=+1]\n'